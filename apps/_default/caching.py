@@ -0,0 +1,129 @@
+"""
+This file defines the response cache used by the read-only API actions.
+
+Responses are stored in the app's LRU cache (common.cache, bounded in size, with a
+per-entry expiration) under a key made of the request path, its normalized query
+parameters and the current data version.  The data version is a counter in the
+data_version table that is bumped whenever checklists or sightings change
+(save_checklist, load-data), so stale entries are simply never looked up again
+and age out of the LRU.
+
+Usage:
+
+    @action('api/something')
+    @action.uses(db)
+    @cached(expiration=300)
+    def something():
+        ...
+"""
+import functools
+import threading
+import time
+
+from py4web import request
+from .common import cache, db
+
+# How often a worker re-reads the data version written by other processes
+VERSION_CHECK_INTERVAL = 1.0
+
+DATA_VERSION = "data"
+# Bumped when the density grid is rebuilt, but not by the saves that update it:
+# the version of the heat tiles cached on disk (see heat_tiles.py)
+GRID_VERSION = "grid"
+# Bumped when species are added by load-data: reloads the typeahead index
+SPECIES_VERSION = "species"
+
+
+class DataVersion:
+    """Reads and bumps the data version counter, re-reading it at most every interval."""
+
+    def __init__(self, db, name=DATA_VERSION, interval=VERSION_CHECK_INTERVAL):
+        self.db = db
+        self.name = name
+        self.interval = interval
+        self.value = None
+        self.checked_on = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        now = time.time()
+        if self.value is None or now - self.checked_on > self.interval:
+            table = self.db.data_version
+            row = self.db(table.name == self.name).select(table.version).first()
+            with self.lock:
+                self.value = row.version if row else 0
+                self.checked_on = now
+        return self.value
+
+    def bump(self):
+        table = self.db.data_version
+        if not self.db(table.name == self.name).update(version=table.version + 1):
+            table.insert(name=self.name, version=1)
+        row = self.db(table.name == self.name).select(table.version).first()
+        with self.lock:
+            self.value = row.version
+            self.checked_on = time.time()
+        return self.value
+
+
+class ResponseCache:
+    """Caches action outputs by normalized request parameters and data version."""
+
+    def __init__(self, cache, version):
+        self.cache = cache
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, vary=""):
+        # Parameters are sorted and empty ones dropped (the actions treat them as missing),
+        # so ?a=1&b=2, ?b=2&a=1 and ?a=1&b=2&c= share an entry.  vary separates the
+        # entries of responses that also depend on something else, e.g. the user.
+        query = sorted((k, v) for k, v in request.query.items() if v)
+        return f"{request.path}:{self.version.get()}:{query}:{vary}"
+
+    def get(self, key, callback, expiration):
+        computed = []
+
+        def compute():
+            computed.append(True)
+            return callback()
+
+        value = self.cache.get(key, compute, expiration)
+        if computed:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / total if total else 0,
+            data_version=self.version.get(),
+        )
+
+
+data_version = DataVersion(db)
+grid_version = DataVersion(db, GRID_VERSION)
+species_version = DataVersion(db, SPECIES_VERSION)
+response_cache = ResponseCache(cache, data_version)
+
+
+def cached(expiration=300, vary=None):
+    """
+    Decorator caching the output of a read-only action, see module docstring.
+    vary is an optional function returning what else the response depends on.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = response_cache.key(vary() if vary else "")
+            return response_cache.get(key, lambda: func(*args, **kwargs), expiration)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,366 @@
+"""
+This file defines the write path for the checklists entered through the app.
+
+A checklist is saved with a handful of queries whatever its size: all the species
+names are resolved with one query, sightings and user_checklists rows are written
+with multi-row INSERTs, and when an existing checklist is updated only the species
+whose count changed are deleted and re-inserted.  Everything, including the derived
+data (density grid, trend rollup, clusters, data version), is written in one
+transaction; the columnar snapshot, if enabled, and the cached heat tiles of the
+saved positions are updated once it is committed.
+
+save_checklists saves a batch of checklists (api/checklists/bulk) the same way:
+they are validated together, with one query for all their species, and saved in
+one transaction, or not at all if any is invalid.  A checklist sent with a key
+(chosen by the client, e.g. a UUID) is saved once per user: a retried upload
+gets the id saved the first time back instead of creating a duplicate.
+"""
+import datetime
+import uuid
+
+from . import clusters, density_grid, heat_tiles, tasks, trends
+from .caching import data_version, grid_version
+from .ingest import bulk_insert
+from .instrumentation import fetched
+from .snapshot import snapshot
+
+# Largest batch of save_checklists, in checklists and in sightings
+MAX_BATCH_CHECKLISTS = 1000
+MAX_BATCH_SIGHTINGS = 50000
+MAX_KEY_LENGTH = 128
+
+
+class ChecklistError(Exception):
+    """Raised when a checklist cannot be saved; status is the HTTP status to report."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def parse_species(species_data):
+    # Returns {common_name: count}, adding up the counts of repeated species
+    counts = {}
+    for item in species_data:
+        try:
+            name = item["common_name"]
+            count = int(item["count"])
+        except (KeyError, TypeError, ValueError):
+            raise ChecklistError(400, f"Invalid species entry: {item}")
+        if count < 0:
+            raise ChecklistError(400, f"Invalid count for {name}: {count}")
+        counts[name] = counts.get(name, 0) + count
+    return counts
+
+
+def resolve_species(db, names):
+    # Returns {common_name: species id} for the known names, in one query
+    query = db.species.common_name.belongs(set(names))
+    return dict(fetched(db.executesql(db(query)._select(db.species.common_name, db.species.id))))
+
+
+def diff_counts(old_rows, new_counts):
+    """
+    Compares the rows (id, species_id, count) stored for a checklist with the new
+    {species_id: count}.  Returns the ids of the rows to delete, and the lists of
+    (species_id, count) removed and added.  Unchanged species are left alone.
+    """
+    old = {}
+    for row_id, species_id, count in old_rows:
+        old.setdefault(species_id, []).append((row_id, count))
+    delete_ids, removed, added = [], [], []
+    for species_id, entries in old.items():
+        if [count for _, count in entries] != [new_counts.get(species_id)]:
+            delete_ids.extend(row_id for row_id, _ in entries)
+            removed.extend((species_id, count) for _, count in entries)
+    for species_id, count in new_counts.items():
+        if [c for _, c in old.get(species_id, [])] != [count]:
+            added.append((species_id, count))
+    return delete_ids, removed, added
+
+
+def parse_checklist(item):
+    """
+    Validates one checklist of a submission, a dict with the species list of
+    {"common_name", "count"} and the optional checklist_id (to update it), key
+    (idempotency key), latitude, longitude, observation_date (YYYY-MM-DD),
+    time_started (HH:MM[:SS]) and duration_minutes.  Returns the checklist with
+    the species as {common_name: count}, or raises ChecklistError.
+    """
+    if not isinstance(item, dict):
+        raise ChecklistError(400, "A checklist must be a JSON object.")
+    counts = parse_species(item.get("species") or [])
+    if not counts:
+        raise ChecklistError(400, "Species data is required.")
+    checklist = dict(counts=counts, checklist_id=None, key=None, latitude=None, longitude=None)
+    try:
+        if item.get("checklist_id"):
+            checklist["checklist_id"] = int(item["checklist_id"])
+        if item.get("key") is not None:
+            checklist["key"] = str(item["key"])
+        if item.get("latitude") is not None or item.get("longitude") is not None:
+            checklist["latitude"] = float(item["latitude"])
+            checklist["longitude"] = float(item["longitude"])
+        date = item.get("observation_date")
+        checklist["observation_date"] = datetime.date.fromisoformat(date) if date else None
+        time = item.get("time_started")
+        checklist["time_started"] = datetime.time.fromisoformat(time) if time else None
+        duration = item.get("duration_minutes")
+        checklist["duration_minutes"] = float(duration) if duration is not None else None
+    except (KeyError, TypeError, ValueError):
+        raise ChecklistError(400, "Invalid checklist id, key, position, date, time or duration.")
+    if checklist["key"] is not None and not 0 < len(checklist["key"]) <= MAX_KEY_LENGTH:
+        raise ChecklistError(400, f"The key must have 1 to {MAX_KEY_LENGTH} characters.")
+    if checklist["latitude"] is not None and not (
+        -90 <= checklist["latitude"] <= 90 and -180 <= checklist["longitude"] <= 180
+    ):
+        raise ChecklistError(400, "Invalid latitude or longitude.")
+    # a day of margin for the observers ahead of UTC
+    tomorrow = datetime.datetime.utcnow().date() + datetime.timedelta(days=1)
+    if checklist["observation_date"] and checklist["observation_date"] > tomorrow:
+        raise ChecklistError(400, "The observation date is in the future.")
+    if checklist["duration_minutes"] is not None and not 0 <= checklist["duration_minutes"] <= 24 * 60:
+        raise ChecklistError(400, "The duration must be 0 to 1440 minutes.")
+    return checklist
+
+
+def save_checklist(db, user_email, species_data, checklist_id=None, **fields):
+    """
+    Creates (or, given checklist_id, updates) a checklist of user_email with the
+    species_data list of {"common_name", "count"} and the optional fields of
+    parse_checklist (position, date, ...).  Returns the checklist id.
+    Raises ChecklistError if the checklist cannot be saved.
+    """
+    item = dict(fields, species=species_data, checklist_id=checklist_id)
+    [result] = save_checklists(db, user_email, [item])
+    if result["status"] == "invalid":
+        raise ChecklistError(result["code"], result["error"])
+    return result["checklist_id"]
+
+
+def save_checklists(db, user_email, items):
+    """
+    Validates the checklists items of user_email (see parse_checklist) all
+    together and, if they are all valid, saves them in one transaction.  Returns
+    one result per item, in order: {"status": "created", "updated" or
+    "duplicate" (its key was already saved), "checklist_id"}.  If any item is
+    invalid nothing is written: those get {"status": "invalid", "code" (HTTP
+    status), "error"} and the others {"status": "valid"}, or "duplicate" with
+    the checklist_id if their key was saved by an earlier request.
+    """
+    if len(items) > MAX_BATCH_CHECKLISTS:
+        raise ChecklistError(413, f"At most {MAX_BATCH_CHECKLISTS} checklists can be saved at once.")
+    results, checklists = [None] * len(items), {}
+    for index, item in enumerate(items):
+        try:
+            checklists[index] = parse_checklist(item)
+        except ChecklistError as e:
+            results[index] = dict(status="invalid", code=e.status, error=e.message)
+    if sum(len(checklist["counts"]) for checklist in checklists.values()) > MAX_BATCH_SIGHTINGS:
+        raise ChecklistError(413, f"At most {MAX_BATCH_SIGHTINGS} sightings can be saved at once.")
+
+    # One query for each of: the species of all the checklists, the keys
+    # already saved, and the checklists to update
+    species_ids = resolve_species(db, {
+        name for checklist in checklists.values() for name in checklist["counts"]
+    })
+    keys = {checklist["key"] for checklist in checklists.values() if checklist["key"]}
+    saved_keys = dict(fetched(db.executesql(db(
+        (db.checklists.observer_id == user_email) & db.checklists.idempotency_key.belongs(keys)
+    )._select(db.checklists.idempotency_key, db.checklists.id)))) if keys else {}
+    update_ids = {checklist["checklist_id"] for checklist in checklists.values() if checklist["checklist_id"]}
+    existing = {
+        row.id: row for row in fetched(db(db.checklists.id.belongs(update_ids)).select())
+    } if update_ids else {}
+
+    first_with_key = {}
+    for index, checklist in checklists.items():
+        if checklist["key"] in saved_keys:
+            results[index] = dict(status="duplicate", checklist_id=saved_keys[checklist["key"]])
+            continue
+        if checklist["key"]:
+            # a key repeated in the batch is saved once, by its first checklist
+            if checklist["key"] in first_with_key:
+                results[index] = dict(status="duplicate", duplicate_of=first_with_key[checklist["key"]])
+                continue
+            first_with_key[checklist["key"]] = index
+        unknown = [name for name in checklist["counts"] if name not in species_ids]
+        row = existing.get(checklist["checklist_id"])
+        if unknown:
+            results[index] = dict(status="invalid", code=400, error=f"Species {unknown[0]} not found.")
+        elif checklist["checklist_id"] and not row:
+            results[index] = dict(status="invalid", code=404, error="Checklist not found.")
+        elif row and row.observer_id != user_email:
+            results[index] = dict(status="invalid", code=403, error="You can only edit your own checklists.")
+        else:
+            checklist["species"] = {species_ids[name]: count for name, count in checklist["counts"].items()}
+    if any(result and result["status"] == "invalid" for result in results):
+        # the checklists repeating a key of this batch are not duplicates of
+        # anything saved, since nothing is
+        return [
+            dict(status="valid") if not result or "duplicate_of" in result else result
+            for result in results
+        ]
+
+    to_save = [index for index in checklists if results[index] is None]
+    # the positions whose heat tiles change: where the checklists are saved, and
+    # where the updated ones were
+    positions = {
+        (checklists[index]["latitude"], checklists[index]["longitude"]) for index in to_save
+    }
+    updated = {checklists[index]["checklist_id"] for index in to_save}
+    positions.update(
+        (row.latitude, row.longitude) for row_id, row in existing.items() if row_id in updated
+    )
+    try:
+        now = datetime.datetime.utcnow()
+        new = [index for index in to_save if not checklists[index]["checklist_id"]]
+        for index, checklist_id in zip(new, insert_checklists(
+            db, user_email, [checklists[index] for index in new], now
+        )):
+            results[index] = dict(status="created", checklist_id=checklist_id)
+        for index in to_save:
+            checklist = checklists[index]
+            if checklist["checklist_id"]:
+                update_checklist(db, user_email, existing[checklist["checklist_id"]], checklist, now)
+                results[index] = dict(status="updated", checklist_id=checklist["checklist_id"])
+        if to_save:
+            # Cached responses computed from the previous data are now stale
+            data_version.bump()
+        db.commit()
+    except Exception:
+        db.rollback()
+        if first_with_key and db(
+            (db.checklists.observer_id == user_email)
+            & db.checklists.idempotency_key.belongs(first_with_key)
+        ).count():
+            # a concurrent upload saved one of the keys first (unique index)
+            raise ChecklistError(409, "Some of these checklists are being saved by another request.")
+        raise
+    for index, result in enumerate(results):
+        if "duplicate_of" in result:
+            results[index] = dict(status="duplicate", checklist_id=results[result["duplicate_of"]]["checklist_id"])
+    heat_tiles.invalidate(grid_version.get(), [
+        (lat, lng) for lat, lng in positions if lat is not None and lng is not None
+    ])
+    if snapshot and to_save:
+        if snapshot.update_checklists(db, [results[index]["checklist_id"] for index in to_save]):
+            # the delta is large enough to be folded into a new base, off the request path
+            tasks.submit("rebuild_snapshot")
+    return results
+
+
+def insert_checklists(db, user_email, checklists, now):
+    """
+    Writes new checklists (see parse_checklist, with their species resolved to
+    {species_id: count}) and returns their ids.  The checklists, sightings and
+    user_checklists rows of all of them are written with one multi-row INSERT
+    each, and their derived data (density grid, trend rollup, clusters) with one
+    update each.  The checklists sent without a key get a generated one, by which
+    the ids of the inserted rows are read back.
+    """
+    keys = [checklist["key"] or uuid.uuid4().hex for checklist in checklists]
+    bulk_insert(
+        db, db.checklists,
+        ["latitude", "longitude", "observation_date", "time_started",
+         "duration_minutes", "observer_id", "idempotency_key"],
+        [
+            (checklist["latitude"], checklist["longitude"],
+             checklist["observation_date"] or now.date(), checklist["time_started"],
+             checklist["duration_minutes"], user_email, key)
+            for checklist, key in zip(checklists, keys)
+        ],
+    )
+    saved_ids = dict(db.executesql(db(
+        (db.checklists.observer_id == user_email) & db.checklists.idempotency_key.belongs(keys)
+    )._select(db.checklists.idempotency_key, db.checklists.id)))
+    ids = [saved_ids[key] for key in keys]
+
+    sightings, density_cells, cluster_cells, trends_added = [], {}, {}, []
+    for checklist, checklist_id in zip(checklists, ids):
+        date = checklist["observation_date"] or now.date()
+        lat, lng = checklist["latitude"], checklist["longitude"]
+        for species_id, count in checklist["species"].items():
+            sightings.append((checklist_id, species_id, count))
+            trends_added.append((species_id, date, count))
+            if lat is not None:
+                density_grid.accumulate(density_cells, lat, lng, species_id, count)
+        if lat is not None:
+            clusters.accumulate(cluster_cells, lat, lng)
+    bulk_insert(db, db.sightings, ["sampling_event_id", "common_name", "observation_count"], sightings)
+    # The user_checklists rows associate the checklists with the user
+    bulk_insert(
+        db, db.user_checklists,
+        ["user_email", "checklist_id", "species_id", "observation_count"],
+        [(user_email,) + sighting for sighting in sightings],
+    )
+    density_grid.apply_cells(db, density_cells)
+    clusters.apply_cells(db, cluster_cells)
+    trends.update(db, user_email, added=trends_added)
+    return ids
+
+
+def update_checklist(db, user_email, row, checklist, now):
+    """
+    Rewrites the existing checklist row with checklist (see insert_checklists).
+    Only the species whose count changed are deleted and re-inserted; a checklist
+    saved without a date moves to today, and keeps its position if it has none.
+    """
+    new_counts = checklist["species"]
+    old_date, old_position = row.observation_date, (row.latitude, row.longitude)
+    fields = dict(observation_date=checklist["observation_date"] or now.date())
+    if checklist["latitude"] is not None:
+        fields.update(latitude=checklist["latitude"], longitude=checklist["longitude"])
+    for name in ("time_started", "duration_minutes"):
+        if checklist[name] is not None:
+            fields[name] = checklist[name]
+    row.update_record(**fields)
+    new_date, new_position = row.observation_date, (row.latitude, row.longitude)
+    old_sightings = db.executesql(db(db.sightings.sampling_event_id == row.id)._select(
+        db.sightings.id, db.sightings.common_name, db.sightings.observation_count
+    ))
+    old_entries = db.executesql(db(
+        (db.user_checklists.checklist_id == row.id) &
+        (db.user_checklists.user_email == user_email)
+    )._select(
+        db.user_checklists.id, db.user_checklists.species_id,
+        db.user_checklists.observation_count,
+    ))
+
+    # Sightings: only the species whose count changed are rewritten
+    delete_ids, removed, added = diff_counts(old_sightings, new_counts)
+    if delete_ids:
+        db(db.sightings.id.belongs(delete_ids)).delete()
+    bulk_insert(
+        db, db.sightings, ["sampling_event_id", "common_name", "observation_count"],
+        [(row.id, species_id, count) for species_id, count in added],
+    )
+    if new_position != old_position:
+        # every old sighting leaves the old position and every new one joins the new
+        density_grid.update_sightings(
+            db, *old_position, removed=[(sid, count) for _, sid, count in old_sightings]
+        )
+        density_grid.update_sightings(db, *new_position, added=list(new_counts.items()))
+        clusters.add_checklist(db, *old_position, sign=-1)
+        clusters.add_checklist(db, *new_position)
+    else:
+        density_grid.update_sightings(db, *new_position, added=added, removed=removed)
+    # Likewise when the date changes, for the trend rollup
+    if old_date != new_date:
+        trends_removed = [(sid, old_date, count) for _, sid, count in old_sightings]
+        trends_added = [(sid, new_date, count) for sid, count in new_counts.items()]
+    else:
+        trends_removed = [(sid, new_date, count) for sid, count in removed]
+        trends_added = [(sid, new_date, count) for sid, count in added]
+    trends.update(db, user_email, added=trends_added, removed=trends_removed)
+
+    # The user_checklists rows associate the checklist with the user
+    delete_ids, _, added = diff_counts(old_entries, new_counts)
+    if delete_ids:
+        db(db.user_checklists.id.belongs(delete_ids)).delete()
+    bulk_insert(
+        db, db.user_checklists,
+        ["user_email", "checklist_id", "species_id", "observation_count"],
+        [(user_email, row.id, species_id, count) for species_id, count in added],
+    )
@@ -0,0 +1,91 @@
+"""
+This file maintains the pre-aggregated checklist clusters used by the maps (api/clusters).
+
+Checklist locations are grouped into web-mercator tile cells at every zoom level
+in CLUSTER_ZOOMS, like the density grid (see density_grid.py) but counting
+checklists instead of sightings.  Each cell keeps its number of checklists and the
+sums of their coordinates, so a cluster is served as (centroid, count) and a new
+checklist is added with one read and one write per level.  A map zoom is served
+from the level whose cells are about 64 pixels wide (4x4 cells per map tile), so
+a view returns at most a few hundred clusters whatever the number of checklists.
+"""
+from .density_grid import GRID_ZOOMS, grid_zoom, in_tile_range, merge_cells, tile_xy
+from .ingest import bulk_insert
+from .instrumentation import fetched
+
+# the grid levels, so that grid_zoom picks the cluster level of a map zoom
+CLUSTER_ZOOMS = GRID_ZOOMS
+# Cells are this many zoom levels finer than the map, i.e. a map tile holds 4x4 cells
+CELL_ZOOM_OFFSET = 2
+# Coordinates are rounded to about a meter, which keeps the responses small
+PRECISION = 5
+
+CLUSTER_FIELDS = ["zoom", "tile_x", "tile_y", "checklists", "lat_sum", "lng_sum"]
+
+
+def accumulate(cells, lat, lng, sign=1):
+    # Adds (or with sign=-1 removes) one checklist to the cells dict, keyed by
+    # (zoom, x, y) with values [checklists, lat_sum, lng_sum]
+    for zoom in CLUSTER_ZOOMS:
+        x, y = tile_xy(lat, lng, zoom)
+        cell = cells.get((zoom, x, y))
+        if cell is None:
+            cell = cells[(zoom, x, y)] = [0, 0.0, 0.0]
+        cell[0] += sign
+        cell[1] += sign * lat
+        cell[2] += sign * lng
+
+
+def rebuild(db):
+    """Recomputes all the clusters from the checklists table."""
+    db(db.checklist_clusters).delete()
+    checklists = db.checklists
+    sql = db((checklists.latitude != None) & (checklists.longitude != None))._select(
+        checklists.latitude, checklists.longitude
+    )
+    cells = {}
+    # iterate the cursor instead of fetching every checklist into a list
+    db._adapter.execute(sql)
+    for lat, lng in db._adapter.cursor:
+        accumulate(cells, lat, lng)
+    rows = bulk_insert(
+        db, db.checklist_clusters, CLUSTER_FIELDS,
+        (key + tuple(value) for key, value in cells.items()),
+    )
+    db.commit()
+    return rows
+
+
+def add_checklist(db, lat, lng, sign=1):
+    """Adds a new checklist at (lat, lng) to the clusters (sign=-1 removes it)."""
+    if lat is None or lng is None:
+        return
+    cells = {}
+    accumulate(cells, lat, lng, sign)
+    apply_cells(db, cells)
+
+
+def apply_cells(db, cells):
+    """
+    Merges a dict of cell deltas (see accumulate) into the clusters, with one
+    SELECT, one DELETE and one multi-row INSERT however many cells are touched.
+    """
+    merge_cells(db, db.checklist_clusters, CLUSTER_FIELDS[:3], CLUSTER_FIELDS[3:], cells)
+
+
+def query_clusters(db, zoom, bbox=None):
+    """
+    Returns the [lat, lng, checklists] of the clusters that intersect
+    bbox = (west, south, east, north), at the level matching the map zoom.
+    """
+    table = db.checklist_clusters
+    level = grid_zoom(zoom, CELL_ZOOM_OFFSET)
+    query = (table.zoom == level) & (table.checklists > 0)
+    if bbox:
+        query &= in_tile_range(table, bbox, level)
+    rows = fetched(db.executesql(db(query)._select(
+        (table.lat_sum / table.checklists).with_alias("lat"),
+        (table.lng_sum / table.checklists).with_alias("lng"),
+        table.checklists,
+    )))
+    return [[round(lat, PRECISION), round(lng, PRECISION), count] for lat, lng, count in rows]
@@ -35,12 +35,20 @@ for item in settings.LOGGERS:
 # #######################################################
 # connect to db
 # #######################################################
+def configure_connection(adapter):
+    # runs once for every new (not pooled) connection
+    if adapter.dbengine == "sqlite":
+        for pragma in settings.SQLITE_PRAGMAS:
+            adapter.execute(f"PRAGMA {pragma};")
+
+
 db = DAL(
     settings.DB_URI,
     folder=settings.DB_FOLDER,
     pool_size=settings.DB_POOL_SIZE,
     migrate=settings.DB_MIGRATE,
     fake_migrate=settings.DB_FAKE_MIGRATE,
+    after_connection=configure_connection,
 )
 
 # #######################################################
@@ -25,101 +25,220 @@ session, db, T, auth, and tempates are examples of Fixtures.
 Warning: Fixtures MUST be declared with @action.uses({fixtures}) else your app will result in undefined behavior
 """
 
-from py4web import action, request, abort, redirect, URL
+from py4web import action, request, response, abort, redirect, URL
 from py4web.core import HTTP
 from py4web.utils.grid import Grid, GridClassStyleBulma
 from py4web.utils.form import Form, FormStyleBulma
 from yatl.helpers import A
 from .common import (
-    db, session, T, cache, auth, logger, authenticated,
+    db, session, T, cache, auth, groups, logger, authenticated,
     unauthenticated, flash, Field
 )
 from .models import get_user_email
+from . import (
+    checklist_store, clusters, density_grid, heat_tiles, observations, prefork, spatial,
+    subqueries, tasks, trends,
+)
+from .caching import cached, data_version, grid_version, response_cache
+from .typeahead import species_index, parse_limit
+from .random_species import species_sampler, parse_sample_size
+from .streaming import NDJSON, ndjson, stream_rows, wants_ndjson
+from .instrumentation import fetched, instrumented
+from .snapshot import snapshot
 
 import datetime
+import itertools
 import json
 import uuid
-import random
 
 
 @action('index')
-@action.uses('index.html', db, auth)
+@action.uses(instrumented, 'index.html', db, auth)
 def index():
     # Render the index.html template and provide access to the database (db) and authentication (auth) services
     return dict()
 
 @action('api/species', method=['GET'])
-@action.uses(db)
+@action.uses(instrumented, db)
 def get_species():
-    # Get the 'suggest' query parameter from the request, stripping whitespace and converting it to lowercase
-    query = request.query.get('suggest', '').strip().lower()
-
-    # Query the database for species whose common names contain the search query
-    species = db(db.species.common_name.contains(query)).select().as_list()
+    # Get the 'suggest' query parameter and the optional result cap from the request
+    query = request.query.get('suggest', '')
+    limit = parse_limit(request.query.get('limit'))
+
+    # Look up the best matching species in the in-memory typeahead index
+    species = [
+        {'id': species_id, 'common_name': common_name}
+        for species_id, common_name in species_index.search(query, limit)
+    ]
+    if wants_ndjson():
+        return ndjson([species])
 
     # Return the matching species as a dictionary
     return dict(species=species)
 
+
+def density_params():
+    # (species layer, zoom, bbox, (date_from, date_to)) from the query string; raises ValueError
+    zoom = int(request.query.get('zoom', density_grid.DEFAULT_ZOOM))
+    bbox = parse_bbox(request.query.get('bbox'))
+    dates = tuple(
+        datetime.date.fromisoformat(request.query[name]) if request.query.get(name) else None
+        for name in ('date_from', 'date_to')
+    )
+    return density_layer(), zoom, bbox, dates
+
+
+def parse_bbox(value):
+    # bbox is "west,south,east,north", as returned by Leaflet's toBBoxString(); raises ValueError
+    bbox = tuple(float(part) for part in value.split(',')) if value else None
+    if bbox is not None and len(bbox) != 4:
+        raise ValueError("bbox must be west,south,east,north.")
+    return bbox
+
+
+def window_cells(layer, zoom, bbox, dates):
+    # Cells of a date window, computed from the sightings since the grid has no dates
+    filters = observations.Filters(
+        None if layer == density_grid.ALL_SPECIES else layer, bbox, *dates
+    )
+    return observations.density_cells(db, filters, zoom)
+
+
+def density_layer():
+    # Density layer of the species in the query string, None if it does not exist
+    species = request.query.get('species')
+    if not species:
+        # Aggregated layer of all species
+        return density_grid.ALL_SPECIES
+    species_row = fetched(db(db.species.common_name == species).select(db.species.id)).first()
+    return species_row.id if species_row else None
+
+
 @action('api/density', method=['GET'])
-@action.uses(db)
+@action.uses(instrumented, db)
 def density():
-    # Retrieve the 'species' parameter from the query string
-    species = request.query.get('species')
+    if wants_ndjson():
+        return density_stream()
+    return density_json()
 
-    if species:
-        # Fetch density data for the specified species
-        rows = db(
-            (db.sightings.common_name == db.species.id) &  # Match species ID in sightings and species tables
-            (db.species.common_name == species) &          # Filter by the specified species name
-            (db.sightings.sampling_event_id == db.checklists.id)  # Match sampling event IDs in sightings and checklists
-        ).select(
-            db.checklists.latitude,  # Latitude of the sightings
-            db.checklists.longitude, # Longitude of the sightings
-            db.sightings.observation_count # Observation count for the sightings
-        )
-    else:
-        # Fetch aggregated density data for all species
-        rows = db(
-            (db.sightings.common_name == db.species.id) &  # Match species ID in sightings and species tables
-            (db.sightings.sampling_event_id == db.checklists.id)  # Match sampling event IDs in sightings and checklists
-        ).select(
-            db.checklists.latitude,  # Latitude of the sightings
-            db.checklists.longitude, # Longitude of the sightings
-            db.sightings.observation_count # Observation count for the sightings
-        )
 
-    # Prepare density data for response
-    density_data = []
-    for row in rows:
-        # Append each sighting's data to the density_data list
-        density_data.append({
-            'lat': row.checklists.latitude,  # Latitude of the sighting
-            'lng': row.checklists.longitude, # Longitude of the sighting
-            'density': row.sightings.observation_count  # Observation count (density)
-        })
+@cached(expiration=300)
+def density_json():
+    try:
+        layer, zoom, bbox, dates = density_params()
+    except ValueError:
+        return dict(error="Invalid zoom, bbox or date parameter.", density=[])
+    if layer is None:
+        return dict(density=[])
+
+    # Pre-aggregated cells in view, one point per cell
+    if any(dates):
+        cells = window_cells(layer, zoom, bbox, dates)
+    else:
+        cells = density_grid.query_cells(db, layer, zoom, bbox)
+    density_data = [{'lat': lat, 'lng': lng, 'density': total} for lat, lng, total in cells]
 
     # Return the density data as a dictionary
     return dict(density=density_data)
 
-@action('get_random_bird', method=['GET'])
+
+def density_stream():
+    # Same cells as density_json, one {lat, lng, density} line each, streamed from the cursor
+    try:
+        layer, zoom, bbox, dates = density_params()
+    except ValueError:
+        raise HTTP(400, "Invalid zoom, bbox or date parameter.")
+    if layer is None:
+        return ndjson([])
+    if any(dates):
+        return ndjson([[
+            {'lat': lat, 'lng': lng, 'density': total}
+            for lat, lng, total in window_cells(layer, zoom, bbox, dates)
+        ]])
+    sql = density_grid.cells_sql(db, layer, zoom, bbox)
+    return ndjson(
+        [{'lat': lat, 'lng': lng, 'density': total} for lat, lng, total in rows]
+        for rows in stream_rows(db, sql)
+    )
+
+
+# Heatmap tiles rendered from the density grid, see heat_tiles.py
+@action('api/heat/<z:int>/<x:int>/<y:int>.png', method=['GET'])
+@action.uses(instrumented, db)
+def heat_tile(z, x, y):
+    if not 0 <= z <= heat_tiles.MAX_ZOOM or not (0 <= x < 1 << z and 0 <= y < 1 << z):
+        raise HTTP(404)
+    # Tiles only change with the data: clients and proxies may keep them a few
+    # minutes, then revalidate them with the data version as ETag.  The disk
+    # cache is kept per grid version, and saves remove the tiles they change.
+    version = data_version.get()
+    etag = f'"{version}"'
+    response.headers['Cache-Control'] = 'public, max-age=300'
+    response.headers['ETag'] = etag
+    if request.headers.get('If-None-Match') == etag:
+        raise HTTP(304)
+    response.headers['Content-Type'] = 'image/png'
+    layer = density_layer()
+    if layer is None:
+        return heat_tiles.EMPTY_TILE
+    return heat_tiles.cached_tile(db, grid_version.get(), layer, z, x, y)
+
+# Checklist locations grouped per map zoom, see clusters.py
+@action('api/clusters', method=['GET'])
+@action.uses(instrumented, db)
+@cached(expiration=300)
+def checklist_clusters():
+    try:
+        zoom = int(request.query.get('zoom', density_grid.DEFAULT_ZOOM))
+        bbox = parse_bbox(request.query.get('bbox'))
+    except ValueError:
+        return dict(error="Invalid zoom or bbox parameter.", clusters=[])
+    # [lat, lng, checklists] triples, the centroid and size of every cluster in view
+    return dict(clusters=clusters.query_clusters(db, zoom, bbox))
+
+@action('api/cache_stats', method=['GET'])
+@action.uses(instrumented, db)
+def cache_stats():
+    # Hit/miss counters of the response cache in this worker process
+    return response_cache.stats()
+
+@action('api/ready', method=['GET'])
 @action.uses(db)
+def ready():
+    # Readiness check for load balancers and the pre-fork launcher, see prefork.py
+    is_ready, details = prefork.readiness()
+    if not is_ready:
+        response.status = 503
+    return details
+
+@action('api/metrics', method=['GET'])
+@action.uses(instrumented)
+def metrics():
+    # Time, SQL statements and rows per route, see instrumentation.py
+    return dict(metrics=instrumented.summary())
+
+@action('get_random_bird', method=['GET'])
+@action.uses(instrumented, db)
 def get_random_bird():
-    rows = db(db.species).select()
-    if rows:
-        random_bird = random.choice(rows)
-        return dict(common_name=random_bird.common_name)
+    # ?n= asks for several distinct species (common_names), ?weighted=1 favours
+    # the species sighted most recently (see random_species.py)
+    n = parse_sample_size(request.query.get('n'))
+    weighted = request.query.get('weighted') in ('1', 'true')
+    names = species_sampler.sample(n, weighted=weighted)
+    if names:
+        return dict(common_name=names[0], common_names=names)
     else:
         return dict(error="No birds found")
 
 
 
 @action('location')
-@action.uses('location.html')
+@action.uses(instrumented, 'location.html')
 def species():
     return dict()  
 
 @action('checklist')
-@action.uses('checklist.html', db, auth, session)
+@action.uses(instrumented, 'checklist.html', db, auth, session)
 def checklists():
     return dict( 
         get_species_url=URL("get_species"),
@@ -129,15 +248,18 @@ def checklists():
 #for checklist html
 #an endpoint to retrieve species filtered by the search query.
 @action("get_species", method=["GET"])
-@action.uses(db, auth, session)
+@action.uses(instrumented, db, auth, session)
 def get_species():
-    query = request.query.get("query", "").strip().lower()
-    print(f"Received query: {query}")
-    species = db(db.species.common_name.contains(query)).select().as_list()
+    query = request.query.get("query", "")
+    limit = parse_limit(request.query.get("limit"))
+    species = [
+        {"id": species_id, "common_name": common_name}
+        for species_id, common_name in species_index.search(query, limit)
+    ]
     return dict(species=species)
 
 @action("save_checklist", method=["POST"])
-@action.uses(db, auth, session)
+@action.uses(instrumented, db, auth, session)
 def save_checklist():
     # Check if the user is logged in
     if not auth.current_user:
@@ -146,128 +268,190 @@ def save_checklist():
     data = request.json
     checklist_id = data.get("checklist_id")  # For updates
     species_data = data.get("species", [])  # Array of species and counts
-    print("this is species_data", species_data)
-    
-    # Validate that species_data is not empty
-    if not species_data:
-        raise HTTP(400, "Species data is required.")  # Bad Request if no species data provided
-    
-    if checklist_id:
-        # If the checklist_id is provided, update the existing checklist record
-        checklist = db.checklists.get(checklist_id)
-        if not checklist:
-            raise HTTP(404, "Checklist not found.")
-        
-        # Update the checklist observation date and observer ID (if needed)
-        checklist.update_record(
-            observation_date=datetime.datetime.utcnow(),
-            observer_id=auth.current_user.get("email"),
-        )
-        
-        # Remove all related sightings for the checklist (if any)
-        db(db.sightings.sampling_event_id == checklist_id).delete()
-
-    else:
-        # Insert a new checklist record without using uuid, instead using auto-incremented ID
-        checklist_id = db.checklists.insert(
-            latitude=0,  # Placeholder latitude value
-            longitude=0,  # Placeholder longitude value
-            observation_date=datetime.datetime.utcnow(),
-            observer_id=auth.current_user.get("email"),
-        )
+    # Optional: where, when and how long the checklist was observed
+    fields = {name: data.get(name) for name in CHECKLIST_FIELDS}
 
-    # Insert all species data related to this checklist
-    for item in species_data:
-        # Look up species_id based on common_name
-        species_row = db(db.species.common_name == item["common_name"]).select().first()
-        
-        if species_row:
-            species_id = species_row.id  # Use species_id (integer)
-        else:
-            raise HTTP(400, f"Species {item['common_name']} not found.")
-        
-        db.sightings.insert(
-            sampling_event_id=checklist_id,  # Linking sighting to the checklist by its ID
-            species_id=species_id,  # Insert the species_id instead of common_name
-            observation_count=item["count"],
-        )
-
-    # Insert a record in the user_checklists table to associate the checklist with the user
-    user_email = auth.current_user.get("email")  # Get the logged-in user's email
-    for item in species_data:
-        print("this is item ", item)
-        species_row = db(db.species.common_name == item["common_name"]).select().first()
-        if species_row:
-            species_id = species_row.id  # Use species_id (integer)
-        else:
-            raise HTTP(400, f"Species {item['common_name']} not found.")
-        
-        # Insert species_id instead of common_name in user_checklists table
-        db.user_checklists.insert(
-            user_email=user_email,
-            checklist_id=checklist_id,
-            species_id=species_id,  # Save species_id, not common_name
-            observation_count=item["count"],  # Observation count
+    # Resolve the species, write the checklist, its sightings and user_checklists
+    # rows in bulk, in one transaction (see checklist_store.py)
+    try:
+        checklist_id = checklist_store.save_checklist(
+            db, auth.current_user.get("email"), species_data, checklist_id, **fields
         )
+    except checklist_store.ChecklistError as e:
+        raise HTTP(e.status, e.message)
 
     return dict(status="success", checklist_id=checklist_id)
 
+# Optional fields of a saved checklist, besides its species (see checklist_store.parse_checklist)
+CHECKLIST_FIELDS = ("key", "latitude", "longitude", "observation_date", "time_started", "duration_minutes")
+
+def read_checklists():
+    # The checklists of a bulk upload: NDJSON (one per line) or {"checklists": [...]}
+    # (not a bare JSON array, which the session fixture cannot read a token from)
+    if NDJSON in request.headers.get("Content-Type", ""):
+        lines = request.body.read().decode("utf8").splitlines()
+        items = []
+        for number, line in enumerate(lines, 1):
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    raise HTTP(400, f"Invalid JSON on line {number}.")
+        return items
+    items = (request.json or {}).get("checklists")
+    if not isinstance(items, list):
+        raise HTTP(400, "Expected a list of checklists.")
+    return items
+
+@action("api/checklists/bulk", method=["POST"])
+@action.uses(instrumented, db, auth, session)
+def save_checklists():
+    # Saves many checklists at once, e.g. those recorded offline by the mobile app
+    if not auth.current_user:
+        raise HTTP(403, "Please log in to submit your checklists.")
+    items = read_checklists()
+    # Validated together and saved in one transaction, or not at all if any is
+    # invalid; the results tell what happened to each (see checklist_store.py)
+    try:
+        results = checklist_store.save_checklists(db, auth.current_user.get("email"), items)
+    except checklist_store.ChecklistError as e:
+        raise HTTP(e.status, e.message)
+    saved = not any(result["status"] == "invalid" for result in results)
+    if not saved:
+        response.status = 400
+    return dict(saved=saved, results=results)
+
+# Number of my_checklist rows per page, and the largest page a client can ask for
+MY_CHECKLIST_PAGE_SIZE = 50
+MY_CHECKLIST_MAX_PAGE_SIZE = 500
+
+def get_user_checklist_page(user_email, params):
+    """
+    Returns one page of the user's checklist entries, newest first, with a single
+    joined query.  params holds the optional filters date_from, date_to (YYYY-MM-DD)
+    and species (common name), the page size limit, and the cursor returned with
+    the previous page.  Returns (items, next_cursor); next_cursor is None on the last page.
+    """
+    try:
+        cursor = int(params.get('cursor') or 0)
+        limit = int(params.get('limit') or MY_CHECKLIST_PAGE_SIZE)
+        limit = max(1, min(limit, MY_CHECKLIST_MAX_PAGE_SIZE))
+        date_from = params.get('date_from') and datetime.date.fromisoformat(params.get('date_from'))
+        date_to = params.get('date_to') and datetime.date.fromisoformat(params.get('date_to'))
+    except ValueError:
+        raise HTTP(400, "Invalid cursor, limit or date.")
+
+    query = (
+        (db.user_checklists.user_email == user_email) &
+        (db.user_checklists.checklist_id == db.checklists.id)
+    )
+    if cursor:
+        # Keyset pagination: continue after the last entry of the previous page
+        query &= db.user_checklists.id < cursor
+    if date_from:
+        query &= db.checklists.observation_date >= date_from
+    if date_to:
+        query &= db.checklists.observation_date <= date_to
+    if params.get('species'):
+        query &= db.species.common_name == params.get('species')
+
+    rows = fetched(db(query).select(
+        db.user_checklists.id,
+        db.user_checklists.observation_count,
+        db.checklists.id,
+        db.checklists.sampling_event_id,
+        db.checklists.latitude,
+        db.checklists.longitude,
+        db.checklists.observation_date,
+        db.species.common_name,
+        left=db.species.on(db.user_checklists.species_id == db.species.id),
+        orderby=~db.user_checklists.id,
+        limitby=(0, limit + 1),  # one more row tells if there is a next page
+    ))
+    items = [{
+        'checklist_id': row.checklists.id,
+        'sampling_event_id': row.checklists.sampling_event_id,
+        'latitude': row.checklists.latitude,
+        'longitude': row.checklists.longitude,
+        'observation_date': row.checklists.observation_date,
+        'common_name': row.species.common_name or "Unknown species",  # Fallback if species is not found
+        'user_observation_count': row.user_checklists.observation_count,  # Fetch from user_checklists
+    } for row in rows[:limit]]
+    next_cursor = rows[limit - 1].user_checklists.id if len(rows) > limit else None
+    return items, next_cursor
+
 @action("my_checklist")
-@action.uses("my_checklist.html", db, session, auth)
+@action.uses(instrumented, "my_checklist.html", db, session, auth)
 def my_checklist():
     # Make sure the user is logged in
     if not auth.current_user:
         raise HTTP(403, "You must be logged in to view your checklists.")
-    
-    user_email = auth.current_user.get('email')
-    
-    # Select checklists associated with the current user
-    checklists = db(db.user_checklists.user_email == user_email).select()
-    
-    checklist_items = []
-    for user_checklist in checklists:
-        # Get the checklist data from the checklists table
-        checklist = db.checklists[user_checklist.checklist_id]
-        
-        # Retrieve the species based on species_id from the species table
-        species = db(db.species.id == user_checklist.species_id).select().first()
-        
-        if species:
-            common_name = species.common_name
-        else:
-            common_name = "Unknown species"  # Fallback if species is not found
-        
-        # Add the relevant fields to display, including the user_observation_count
-        checklist_items.append({
-            'sampling_event_id': checklist.sampling_event_id,
-            'latitude': checklist.latitude,
-            'longitude': checklist.longitude,
-            'observation_date': checklist.observation_date,
-            'common_name': common_name,  # Retrieved from species table
-            'user_observation_count': user_checklist.observation_count,  # Fetch from user_checklists
-        })
-    
-    return dict(checklist_items=checklist_items)
+
+    # First page of the user's entries; the page loads the next ones from api/my_checklist
+    checklist_items, next_cursor = get_user_checklist_page(
+        auth.current_user.get('email'), request.query
+    )
+    filters = {key: request.query.get(key, '') for key in ('date_from', 'date_to', 'species')}
+    return dict(
+        checklist_items=checklist_items,
+        next_cursor=next_cursor,
+        filters=filters,
+        my_checklist_api_url=URL('api/my_checklist'),
+    )
+
+@action("api/my_checklist", method=["GET"])
+@action.uses(instrumented, db, session, auth)
+def api_my_checklist():
+    if not auth.current_user:
+        raise HTTP(403, "You must be logged in to view your checklists.")
+    items, next_cursor = get_user_checklist_page(auth.current_user.get('email'), request.query)
+    return dict(items=items, next_cursor=next_cursor)
 
 #also Iain
 @action('user_stats')
-@action.uses('user_stats.html')
+@action.uses(instrumented, 'user_stats.html')
 def user_stats():
     return dict()  
 
 
 #iain
 @action("api/user_stats/species", method=["GET"])
-@action.uses(db)
+@action.uses(instrumented, db)
 def user_stats_species():
-    query = request.query.get("suggest", "").strip().lower()
-    species = db(db.species.common_name.lower().contains(query)).select(db.species.common_name).as_list()
+    query = request.query.get("suggest", "")
+    limit = parse_limit(request.query.get("limit"))
+    species = [
+        {"common_name": common_name}
+        for _, common_name in species_index.search(query, limit)
+    ]
+    if wants_ndjson():
+        return ndjson([species])
     return dict(species=species)
 
 
 
+def parse_trend_params(params):
+    # (date_from, date_to, bucket) from the query parameters; raises ValueError
+    date_from, date_to = [
+        datetime.date.fromisoformat(params[name]) if params.get(name) else None
+        for name in ("date_from", "date_to")
+    ]
+    bucket = params.get("bucket") or "day"
+    if bucket not in trends.BUCKETS:
+        raise ValueError(f"bucket must be one of {', '.join(trends.BUCKETS)}")
+    return date_from, date_to, bucket
+
+
+def trends_user():
+    # The per-user trends are cached separately for every user
+    if request.query.get("mine") and auth.current_user:
+        return auth.current_user.get("email")
+    return ""
+
+
 @action("api/user_stats/trends", method=["GET"])
-@action.uses(db)
+@action.uses(instrumented, db, session, auth)
+@cached(expiration=300, vary=trends_user)
 def user_stats_trends():
     species_name = request.query.get("species", "").strip()
 
@@ -275,100 +459,221 @@ def user_stats_trends():
         return dict(error="Species name is required.", trends=[])
 
     # Validate the species name exists in the database
-    species_row = db(db.species.common_name == species_name).select().first()
+    species_row = fetched(db(db.species.common_name == species_name).select()).first()
     if not species_row:
         return dict(error="Species not found.", trends=[])
 
-    # Query trends for the specified species
-    trends = db(
-        (db.sightings.common_name == species_row.id) &
-        (db.sightings.sampling_event_id == db.checklists.id)
-    ).select(
-        db.checklists.observation_date,
-        db.sightings.observation_count.sum().with_alias("total_count"),
-        groupby=db.checklists.observation_date
-    )
-
-    return dict(trends=[
-        {"date": str(trend["checklists.observation_date"]), "count": trend["total_count"]}
-        for trend in trends
-    ])
+    try:
+        date_from, date_to, bucket = parse_trend_params(request.query)
+    except ValueError as e:
+        return dict(error=str(e), trends=[])
 
+    # mine=1 restricts the trends to the sightings of the logged in user
+    observer_id = trends.ALL_OBSERVERS
+    if request.query.get("mine"):
+        if not auth.current_user:
+            return dict(error="Please log in to see your own trends.", trends=[])
+        observer_id = auth.current_user.get("email")
 
+    # Read the trends of the species from the daily rollup
+    return dict(trends=trends.query(
+        db, species_row.id, observer_id, date_from, date_to, bucket
+    ))
 
 
+# code for location page
+# Orders of the species of api/region_stats: sightings and checklists are
+# descending, ties (and "name") by name
+REGION_STATS_ORDERS = ('name', 'sightings', 'checklists')
+
+
+def parse_region_stats_params(data):
+    # (limit or None, order, date_from, date_to) of api/region_stats; raises ValueError
+    limit = data.get('limit')
+    if limit in (None, ''):
+        limit = None
+    elif isinstance(limit, bool) or int(limit) < 1:
+        raise ValueError("limit must be a positive integer")
+    else:
+        limit = int(limit)
+    order = data.get('order') or 'name'
+    if order not in REGION_STATS_ORDERS:
+        raise ValueError(f"order must be one of {', '.join(REGION_STATS_ORDERS)}")
+    date_from, date_to = [
+        datetime.date.fromisoformat(data[name]) if data.get(name) else None
+        for name in ('date_from', 'date_to')
+    ]
+    return limit, order, date_from, date_to
+
+
+def ranked_region_stats(stats, contributors, limit, order):
+    # The species and contributor rows of api/region_stats from {species id:
+    # [sightings, checklists]} and {observer: checklists} computed without the
+    # SQL aggregation below (snapshot or date window)
+    species_index.refresh()
+    names = dict(species_index.data[0])
+    species_rows = sorted(
+        (
+            (names[species_id], sightings, checklists)
+            for species_id, (sightings, checklists) in stats.items() if species_id in names
+        ),
+        key={
+            'sightings': lambda row: (-row[1], row[0]),
+            'checklists': lambda row: (-row[2], row[0]),
+        }.get(order, lambda row: row[0]),
+    )
+    if limit:
+        species_rows = species_rows[:limit]
+    contributor_rows = sorted(contributors.items(), key=lambda item: (-item[1], item[0]))
+    return species_rows, contributor_rows
+
+
+def region_stats_response(species_rows, contributor_rows, timed_out):
+    # JSON objects are serialized with sorted keys, so the requested order is
+    # returned as a separate list of names; partial flags the sub-queries that
+    # did not finish before the deadline (their part of the response is empty)
+    response = dict(
+        species_stats={
+            name: {'sightings': sightings, 'checklists': checklists}
+            for name, sightings, checklists in species_rows
+        },
+        species_order=[name for name, _, _ in species_rows],
+        top_contributors=[
+            {'observer_id': observer_id, 'checklists': checklists}
+            for observer_id, checklists in contributor_rows
+        ],
+    )
+    if timed_out:
+        response.update(partial=True, timed_out=timed_out)
+    return response
 
 
-# code for location page
 @action('api/region_stats', method=["POST"])
-@action.uses(db)
+@action.uses(instrumented, db)
 def region_stats():
     try:
         # Get region bounds from the request
         data = request.json
-        north, south, east, west = data['north'], data['south'], data['east'], data['west']
-        logger.info(f"Received bounds: north={north}, south={south}, east={east}, west={west}")
-
-        # Query for sightings within the region bounds
-        sightings = db(
-            (db.checklists.latitude <= north) &
-            (db.checklists.latitude >= south) &
-            (db.checklists.longitude <= east) &
-            (db.checklists.longitude >= west) &
+        try:
+            north, south, east, west = (
+                float(data[name]) for name in ('north', 'south', 'east', 'west')
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise HTTP(400, f"Invalid bounds: {e}")
+        logger.debug("Received bounds: north=%s, south=%s, east=%s, west=%s", north, south, east, west)
+
+        # Optional: only the top `limit` species, ordered by `order` (see
+        # REGION_STATS_ORDERS), and only the checklists from date_from to
+        # date_to (ISO dates); checked before any query runs
+        try:
+            limit, order, date_from, date_to = parse_region_stats_params(data)
+        except (TypeError, ValueError) as e:
+            raise HTTP(400, f"Invalid limit, order or date parameter: {e}")
+
+        stats, timed_out = None, []
+        if snapshot and snapshot.parts():
+            # Vectorized over the memory-mapped snapshot, see snapshot.py
+            stats, contributors = snapshot.region_stats(
+                north, south, east, west, date_from, date_to
+            )
+        elif date_from or date_to:
+            # The query layer picks the most selective of the bbox and the dates
+            filters = observations.Filters(
+                bbox=(west, south, east, north), date_from=date_from, date_to=date_to
+            )
+            results, timed_out = subqueries.run_concurrently(db, {
+                'species': lambda: observations.species_totals(db, filters),
+                'contributors': lambda: observations.contributors(db, filters),
+            })
+            stats = {
+                species_id: [sightings or 0, checklists]
+                for species_id, sightings, checklists in results.get('species', [])
+            }
+            contributors = dict(results.get('contributors', []))
+        if stats is not None:
+            species_rows, contributor_rows = ranked_region_stats(stats, contributors, limit, order)
+            if wants_ndjson():
+                return ndjson([
+                    [
+                        {'species': name, 'sightings': sightings, 'checklists': checklists}
+                        for name, sightings, checklists in species_rows
+                    ],
+                    [
+                        {'observer_id': observer_id, 'checklists': checklists}
+                        for observer_id, checklists in contributor_rows
+                    ],
+                    [{'partial': True, 'timed_out': timed_out}] if timed_out else [],
+                ])
+            return region_stats_response(species_rows, contributor_rows, timed_out)
+
+        # Aggregate the sightings within the region bounds, found through the spatial index,
+        # into one row per species: total sightings and number of distinct checklists
+        in_region = spatial.in_bbox(db, north, south, east, west)
+        total_sightings = db.sightings.observation_count.sum()
+        distinct_checklists = db.checklists.id.count(distinct=True)
+        # ties are broken by name, like ranked_region_stats
+        orderby = {
+            'sightings': ~total_sightings | db.species.common_name,
+            'checklists': ~distinct_checklists | db.species.common_name,
+        }.get(order, db.species.common_name)
+        species_sql = db(
+            in_region &
             (db.sightings.sampling_event_id == db.checklists.id) &
             (db.sightings.common_name == db.species.id)  # Corrected field name
-        ).select(
-            db.species.common_name,
-            db.sightings.observation_count,
-            db.checklists.id
+        )._select(
+            db.species.common_name, total_sightings, distinct_checklists,
+            groupby=db.species.id | db.species.common_name,
+            orderby=orderby,
+            limitby=(0, limit) if limit else None,
         )
-
-        # Process the data
-        species_stats = {}
-        for sighting in sightings:
-            species_name = sighting.species.common_name
-            checklist_id = sighting.checklists.id
-            if species_name not in species_stats:
-                species_stats[species_name] = {'sightings': 0, 'checklists': set()}
-            species_stats[species_name]['sightings'] += sighting.sightings.observation_count
-            species_stats[species_name]['checklists'].add(checklist_id)
-
-        # Convert checklists set to counts
-        for species in species_stats:
-            species_stats[species]['checklists'] = len(species_stats[species]['checklists'])
-
-        # Get top contributors
-        top_contributors = db(
-            (db.checklists.latitude <= north) &
-            (db.checklists.latitude >= south) &
-            (db.checklists.longitude <= east) &
-            (db.checklists.longitude >= west)
-        ).select(
-            db.checklists.observer_id,
-            db.checklists.id.count().with_alias("checklist_count"),
+        # Top contributors
+        contributors_sql = db(in_region)._select(
+            db.checklists.observer_id, db.checklists.id.count(),
             groupby=db.checklists.observer_id,
-            orderby=~db.checklists.id.count()
+            orderby=~db.checklists.id.count() | db.checklists.observer_id,
         )
 
-        # Prepare response
-        response = dict(
-            species_stats=species_stats,
-            top_contributors=[
-                {'observer_id': c.checklists.observer_id, 'checklists': c.checklist_count}
-                for c in top_contributors
-            ]
-        )
-
-        logger.info(f"Region stats computed successfully: {response}")
-        return response
-
+        if wants_ndjson():
+            # One line per species in the requested order, then one per contributor
+            return ndjson(itertools.chain(
+                (
+                    [
+                        {'species': name, 'sightings': sightings or 0, 'checklists': checklists}
+                        for name, sightings, checklists in rows
+                    ]
+                    for rows in stream_rows(db, species_sql)
+                ),
+                (
+                    [
+                        {'observer_id': observer_id, 'checklists': checklists}
+                        for observer_id, checklists in rows
+                    ]
+                    for rows in stream_rows(db, contributors_sql)
+                ),
+            ))
+
+        # The two aggregations are independent: they run concurrently, each on
+        # its own connection, and the slower one is dropped past the deadline
+        results, timed_out = subqueries.run_concurrently(db, {
+            'species': lambda: fetched(db.executesql(species_sql)),
+            'contributors': lambda: fetched(db.executesql(contributors_sql)),
+        })
+        species_rows = [
+            (name, sightings or 0, checklists)
+            for name, sightings, checklists in results.get('species', [])
+        ]
+        return region_stats_response(species_rows, results.get('contributors', []), timed_out)
+
+    except HTTP:
+        raise
     except Exception as e:
         logger.error(f"Error in region_stats: {e}")
         return dict(error=f"Error: {e}")
 
 #graph for locations page
 @action('api/species_graph', method=["GET"])
-@action.uses(db)
+@action.uses(instrumented, db)
+@cached(expiration=300)
 def species_graph():
     # Get the species name from the query parameters
     species_name = request.query.get("species")
@@ -377,25 +682,49 @@ def species_graph():
         return dict(error="Species parameter is missing.")
 
     # Find the species ID for the given species name
-    species_row = db(db.species.common_name == species_name).select().first()
+    species_row = fetched(db(db.species.common_name == species_name).select()).first()
     if not species_row:
         return dict(error=f"Species '{species_name}' not found.")
 
-    # Query the database for sightings trends
-    trends = db(
-        (db.sightings.common_name == species_row.id) &
-        (db.sightings.sampling_event_id == db.checklists.id)
-    ).select(
-        db.checklists.observation_date,
-        db.sightings.observation_count.sum().with_alias("total_count"),
-        groupby=db.checklists.observation_date
-    )
-
-    # Process the data into the format expected by the frontend
-    graph_data = [
-        {"date": str(trend["checklists.observation_date"]), "count": trend["total_count"]}
-        for trend in trends
-    ]
+    try:
+        date_from, date_to, bucket = parse_trend_params(request.query)
+        bbox = parse_bbox(request.query.get("bbox"))
+    except ValueError as e:
+        return dict(error=str(e))
+
+    if bbox:
+        # Trends within an area, from the sightings (the rollup has no positions)
+        filters = observations.Filters(species_row.id, bbox, date_from, date_to)
+        graph_data = trends.bucket_totals(observations.date_totals(db, filters), bucket)
+    else:
+        # Read the trends of the species from the daily rollup, in the format expected by the frontend
+        graph_data = trends.query(db, species_row.id, date_from=date_from, date_to=date_to, bucket=bucket)
 
     return dict(data=graph_data)
 
+
+# Background jobs (see tasks.py), for the users in the "admin" group:
+# groups.add(user_id, "admin")
+JOBS_PAGE_SIZE = 50
+
+@action('api/admin/jobs', method=['GET', 'POST'])
+@action.uses(instrumented, db, session, auth)
+def admin_jobs():
+    if not auth.current_user or "admin" not in groups.get(auth.user_id):
+        raise HTTP(403, "Administrators only.")
+
+    if request.method == 'POST':
+        # Submit a job: {"name": ..., "params": {...}}
+        data = request.json or {}
+        try:
+            job_id = tasks.submit(data.get('name'), **(data.get('params') or {}))
+        except (TypeError, ValueError) as e:
+            raise HTTP(400, str(e))
+        return dict(job=db.jobs(job_id).as_dict())
+
+    # Latest jobs, optionally with a given status
+    query = db.jobs.id > 0
+    if request.query.get('status'):
+        query &= db.jobs.status == request.query.get('status')
+    jobs = fetched(db(query).select(orderby=~db.jobs.id, limitby=(0, JOBS_PAGE_SIZE)))
+    return dict(jobs=jobs.as_list())
@@ -0,0 +1,235 @@
+"""
+This file maintains the pre-aggregated density grid used by the heatmap (api/density).
+
+Sightings are aggregated into web-mercator tile cells (zoom, tile_x, tile_y), i.e. the
+quadkey cells of the map, at every zoom level in GRID_ZOOMS.  Each cell keeps the number
+of sightings, the total observation count, and the sums of their coordinates, so the
+centroid can be served and the cell updated incrementally.  Species layers are stored
+under their species id, the all-species layer under ALL_SPECIES.
+"""
+import datetime
+import math
+
+from .ingest import bulk_insert
+from .instrumentation import fetched
+
+GRID_ZOOMS = (4, 6, 8, 10, 12, 14, 16)
+# Cells are this many zoom levels finer than the map, i.e. a 256px map tile holds 8x8 cells
+CELL_ZOOM_OFFSET = 3
+DEFAULT_ZOOM = 10
+ALL_SPECIES = 0
+# Web-mercator is undefined at the poles
+MAX_LATITUDE = 85.05112878
+
+# Cell locations merged by one apply_cells query
+APPLY_CHUNK_CELLS = 50
+
+CELL_FIELDS = ["zoom", "species_id", "tile_x", "tile_y", "points", "total", "lat_sum", "lng_sum"]
+
+
+def tile_xy(lat, lng, zoom):
+    # Returns the (x, y) web-mercator tile containing the point at the given zoom
+    n = 1 << zoom
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def grid_zoom(map_zoom, offset=CELL_ZOOM_OFFSET):
+    # Finest grid level that is not finer than the cells wanted for this map zoom,
+    # offset levels below it (the clusters and heat tiles use their own offsets)
+    wanted = map_zoom + offset
+    return max([zoom for zoom in GRID_ZOOMS if zoom <= wanted] or [GRID_ZOOMS[0]])
+
+
+def tile_range(bbox, zoom):
+    # (x0, y0, x1, y1) of the tiles at zoom that intersect bbox = (west, south, east, north)
+    west, south, east, north = bbox
+    x0, y0 = tile_xy(north, max(west, -180.0), zoom)
+    x1, y1 = tile_xy(south, min(east, 180.0), zoom)
+    return x0, y0, x1, y1
+
+
+def in_tile_range(table, bbox, zoom):
+    # Query of the rows of a cell table whose tile at zoom intersects bbox
+    x0, y0, x1, y1 = tile_range(bbox, zoom)
+    return (
+        (table.tile_x >= x0) & (table.tile_x <= x1)
+        & (table.tile_y >= y0) & (table.tile_y <= y1)
+    )
+
+
+def accumulate(cells, lat, lng, species_id, count, sign=1):
+    # Adds (or with sign=-1 removes) one sighting to the cells dict, keyed by
+    # (zoom, species layer, x, y) with values [points, total, lat_sum, lng_sum]
+    for zoom in GRID_ZOOMS:
+        x, y = tile_xy(lat, lng, zoom)
+        for layer in (ALL_SPECIES, species_id):
+            cell = cells.get((zoom, layer, x, y))
+            if cell is None:
+                cell = cells[(zoom, layer, x, y)] = [0, 0, 0.0, 0.0]
+            cell[0] += sign
+            cell[1] += sign * (count or 0)
+            cell[2] += sign * lat
+            cell[3] += sign * lng
+
+
+def rebuild(db, cells=None):
+    """
+    Recomputes the whole grid from the sightings table, or stores the given cells
+    when they were already computed (see snapshot.density_cells).
+    """
+    db(db.density_cells).delete()
+    if cells is None:
+        cells = read_cells(db)
+    rows = bulk_insert(
+        db, db.density_cells, CELL_FIELDS,
+        (key + tuple(value) for key, value in cells.items()),
+    )
+    db.commit()
+    return rows
+
+
+def read_cells(db):
+    # Accumulates every located sighting into a cells dict (see accumulate)
+    query = (
+        (db.sightings.sampling_event_id == db.checklists.id)
+        & (db.checklists.latitude != None)
+        & (db.checklists.longitude != None)
+    )
+    sql = db(query)._select(
+        db.checklists.latitude, db.checklists.longitude,
+        db.sightings.common_name, db.sightings.observation_count,
+    )
+    cells = {}
+    # iterate the cursor instead of fetching every sighting into a list
+    db._adapter.execute(sql)
+    for lat, lng, species_id, count in db._adapter.cursor:
+        accumulate(cells, lat, lng, species_id, count)
+    return cells
+
+
+def locking(db):
+    # Servers with row locks lock the rows read by a merge against concurrent
+    # saves; SQLite already serializes writers, and the callers have written
+    # before reading them.
+    return db._adapter.dbengine != "sqlite"
+
+
+def merge_rows(db, table, key_fields, value_fields, deltas, query):
+    """
+    Adds deltas, {key: [values]} ordered like key_fields and value_fields, to the
+    rows of table that query selects, with one SELECT, one DELETE and one
+    multi-row INSERT.  Rows whose first value drops to 0 are removed.  Used for
+    the density grid, the clusters (see merge_cells) and the trend rollup.
+    """
+    if not deltas:
+        return
+    merged = {key: list(value) for key, value in deltas.items()}
+    dates = [index for index, name in enumerate(key_fields) if table[name].type == "date"]
+    size = len(key_fields)
+    replaced = []
+    # plain tuples: a batch of checklists reads thousands of rows, too many for Rows
+    for row in fetched(db.executesql(db(query)._select(
+        table.id, *(table[name] for name in key_fields + value_fields), for_update=locking(db)
+    ))):
+        key = list(row[1:size + 1])
+        for index in dates:
+            # dates come back as text from plain SQL on some drivers
+            if isinstance(key[index], str):
+                key[index] = datetime.date.fromisoformat(key[index])
+        delta = merged.get(tuple(key))
+        if delta is not None:
+            merged[tuple(key)] = [value + change for value, change in zip(row[size + 1:], delta)]
+            replaced.append(row[0])
+    if replaced:
+        db(table.id.belongs(replaced)).delete()
+    bulk_insert(
+        db, table, key_fields + value_fields,
+        (key + tuple(value) for key, value in merged.items() if value[0] > 0),
+    )
+
+
+def cell_location(key):
+    # (zoom, x, y) of a cell key (zoom, [layer,] x, y)
+    return key[0], key[-2], key[-1]
+
+
+def chunk_cells(cells, size=APPLY_CHUNK_CELLS):
+    # Splits a dict of cell deltas into dicts touching at most size cell locations
+    indexes, chunks = {}, []
+    for key, value in cells.items():
+        index = indexes.setdefault(cell_location(key), len(indexes)) // size
+        if index == len(chunks):
+            chunks.append({})
+        chunks[index][key] = value
+    return chunks
+
+
+def merge_cells(db, table, key_fields, value_fields, cells):
+    """
+    Merges a dict of cell deltas into table (see merge_rows), whose key_fields
+    are zoom, the optional layers (e.g. species_id), tile_x and tile_y.
+    """
+    if not cells:
+        return
+    locations = {cell_location(key) for key in cells}
+    if len(locations) > APPLY_CHUNK_CELLS:
+        # the query below nests one OR per cell, which overflows the SQLite parser
+        # stack (at about 85) when a batch of checklists touches many: merge in chunks
+        for chunk in chunk_cells(cells):
+            merge_cells(db, table, key_fields, value_fields, chunk)
+        return
+    zoom, *layers, tile_x, tile_y = (table[name] for name in key_fields)
+    query = None
+    for level, x, y in locations:
+        location = (zoom == level) & (tile_x == x) & (tile_y == y)
+        query = location if query is None else query | location
+    for position, layer in enumerate(layers, 1):
+        query &= layer.belongs({key[position] for key in cells})
+    merge_rows(db, table, key_fields, value_fields, cells, query)
+
+
+def apply_cells(db, cells):
+    """
+    Merges a dict of cell deltas (see accumulate) into the grid, with one SELECT,
+    one DELETE and one multi-row INSERT however many cells are touched.
+    """
+    merge_cells(db, db.density_cells, CELL_FIELDS[:4], CELL_FIELDS[4:], cells)
+
+
+def update_sightings(db, lat, lng, added=(), removed=()):
+    """
+    Applies the sightings added to and removed from one checklist at (lat, lng)
+    to the grid.  Both are lists of (species_id, observation_count).
+    """
+    if lat is None or lng is None:
+        return
+    cells = {}
+    for species_id, count in removed:
+        accumulate(cells, lat, lng, species_id, count, -1)
+    for species_id, count in added:
+        accumulate(cells, lat, lng, species_id, count)
+    apply_cells(db, cells)
+
+
+def cells_sql(db, species_id=ALL_SPECIES, zoom=DEFAULT_ZOOM, bbox=None):
+    # SELECT of the (lat, lng, total) of the cells of a layer that intersect
+    # bbox = (west, south, east, north), at the grid level matching the map zoom
+    table = db.density_cells
+    level = grid_zoom(zoom)
+    query = (table.zoom == level) & (table.species_id == species_id) & (table.points > 0)
+    if bbox:
+        query &= in_tile_range(table, bbox, level)
+    # the centroids are computed by the database, so rows come out ready to use
+    return db(query)._select(
+        (table.lat_sum / table.points).with_alias("lat"),
+        (table.lng_sum / table.points).with_alias("lng"),
+        table.total,
+    )
+
+
+def query_cells(db, species_id=ALL_SPECIES, zoom=DEFAULT_ZOOM, bbox=None):
+    """Returns the [lat, lng, total] of the cells in view, see cells_sql."""
+    return [list(row) for row in fetched(db.executesql(cells_sql(db, species_id, zoom, bbox)))]
@@ -0,0 +1,290 @@
+"""
+This file renders the heatmap tiles of the index page (api/heat/{z}/{x}/{y}.png).
+
+Tiles are 256x256 web-mercator map tiles drawn from the pre-aggregated density
+grid (see density_grid.py): every cell in or near the tile adds a blurred spot at
+its centroid, weighted by the log of its observation count, and the summed
+intensity is colored with the gradient of the former client-side heatmap.
+Intensities are scaled by the largest cell of the layer at that grid level, so
+neighbouring tiles match at their edges; these maxima are computed when the grid
+is rebuilt (see refresh) rather than by every tile.  The PNG is encoded with zlib,
+without an imaging library.
+
+Rendered tiles are cached on disk under the grid version (see caching.py), which
+changes when the grid is rebuilt, not when checklists are saved: a save only
+removes the tiles drawn from the cells it changed (see invalidate).  The folders
+of the older versions are removed by the rebuilds, not by the requests.
+"""
+import math
+import os
+import shutil
+import struct
+import threading
+import zlib
+
+from . import settings
+from .density_grid import MAX_LATITUDE, grid_zoom, tile_xy
+from .ingest import bulk_insert
+from .instrumentation import fetched
+
+TILE_SIZE = 256
+# Deepest map zoom served (Leaflet's maxZoom on the index page)
+MAX_ZOOM = 19
+# Spots are drawn with this radius in pixels, from cells this many zoom levels
+# finer than the map tile (32x32 cells per tile)
+RADIUS = 12
+CELL_ZOOM_OFFSET = 5
+# Gradient of the leaflet.heat plugin previously used by the index page
+GRADIENT = [
+    (0.4, (0, 0, 255)),
+    (0.6, (0, 255, 255)),
+    (0.7, (0, 255, 0)),
+    (0.8, (255, 255, 0)),
+    (1.0, (255, 0, 0)),
+]
+MAX_OPACITY = 0.8
+TILE_FOLDER = os.path.join(settings.DB_FOLDER, "heat_tiles")
+
+
+# #######################################################
+# PNG encoding
+# #######################################################
+def png_chunk(kind, data):
+    return (
+        struct.pack(">I", len(data)) + kind + data
+        + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    )
+
+
+def encode_png(width, height, pixels):
+    """Encodes pixels, a bytes-like of width * height RGBA values, as a PNG."""
+    stride = width * 4
+    # every scanline starts with its filter type, 0 (none)
+    scanlines = b"".join(
+        b"\x00" + bytes(pixels[row * stride:(row + 1) * stride]) for row in range(height)
+    )
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+        png_chunk(b"IDAT", zlib.compress(scanlines, 6)),
+        png_chunk(b"IEND", b""),
+    ])
+
+
+EMPTY_TILE = encode_png(TILE_SIZE, TILE_SIZE, bytes(TILE_SIZE * TILE_SIZE * 4))
+
+
+def gradient_color(value):
+    # Color of the gradient at value, between 0 and 1
+    low, color = GRADIENT[0]
+    if value <= low:
+        return color
+    for high, high_color in GRADIENT[1:]:
+        if value <= high:
+            t = (value - low) / (high - low)
+            return tuple(round(a + (b - a) * t) for a, b in zip(color, high_color))
+        low, color = high, high_color
+    return color
+
+
+def make_palette():
+    # 256 RGBA colors from transparent (0) to the end of the gradient (255)
+    return [
+        bytes(gradient_color(index / 255)) + bytes([round(255 * MAX_OPACITY * index / 255)])
+        for index in range(256)
+    ]
+
+
+PALETTE = make_palette()
+
+
+def make_kernel(radius):
+    # Gaussian spot as rows of weights, 1 at the center and ~0 at the radius
+    sigma = radius / 2.0
+    return [
+        [math.exp(-(dx * dx + dy * dy) / (2 * sigma * sigma)) for dx in range(-radius, radius + 1)]
+        for dy in range(-radius, radius + 1)
+    ]
+
+
+KERNEL = make_kernel(RADIUS)
+
+
+# #######################################################
+# Rendering
+# #######################################################
+def world_pixel(lat, lng, zoom):
+    # Position of the point in pixels of the whole map at zoom
+    size = TILE_SIZE << zoom
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    x = (lng + 180.0) / 360.0 * size
+    y = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * size
+    return x, y
+
+
+def refresh(db):
+    """
+    Recomputes the largest cell total of every layer at every grid level, after
+    the grid was rebuilt (see load_data.rebuild_derived and tasks.py).  The saves
+    in between do not change them, so the tiles they redraw keep the same scale.
+    """
+    table = db.density_cells
+    db(db.density_maxima).delete()
+    rows = bulk_insert(db, db.density_maxima, ["zoom", "species_id", "total"], db.executesql(
+        db(table.points > 0)._select(
+            table.zoom, table.species_id, table.total.max(), groupby=table.zoom | table.species_id
+        )
+    ))
+    db.commit()
+    return rows
+
+
+def tile_cells(db, layer, zoom, x, y):
+    # (lat, lng, total) of the cells of the layer within RADIUS pixels of the tile,
+    # and the largest total of the layer at that grid level (see refresh)
+    table = db.density_cells
+    level = grid_zoom(zoom, CELL_ZOOM_OFFSET)
+    scale = 2.0 ** (level - zoom) / TILE_SIZE  # grid cells per pixel
+    last = (1 << level) - 1
+
+    def cell_range(tile):
+        low = int(math.floor((tile * TILE_SIZE - RADIUS) * scale))
+        high = int(math.floor(((tile + 1) * TILE_SIZE + RADIUS) * scale))
+        return max(low, 0), min(high, last)
+
+    (x0, x1), (y0, y1) = cell_range(x), cell_range(y)
+    layer_query = (table.zoom == level) & (table.species_id == layer) & (table.points > 0)
+    rows = fetched(db.executesql(db(
+        layer_query
+        & (table.tile_x >= x0) & (table.tile_x <= x1)
+        & (table.tile_y >= y0) & (table.tile_y <= y1)
+    )._select(
+        (table.lat_sum / table.points).with_alias("lat"),
+        (table.lng_sum / table.points).with_alias("lng"),
+        table.total,
+    )))
+    if not rows:
+        return rows, 0
+    maxima = db.density_maxima
+    top = fetched(db((maxima.zoom == level) & (maxima.species_id == layer)).select(maxima.total)).first()
+    # a species first seen since the last rebuild has no maximum yet
+    return rows, top.total if top else max(total for _, _, total in rows)
+
+
+def render_tile(db, layer, zoom, x, y):
+    """Returns the PNG of map tile (zoom, x, y) for the density layer."""
+    cells, top = tile_cells(db, layer, zoom, x, y)
+    if not cells:
+        return EMPTY_TILE
+    scale = 1.0 / math.log1p(max(top, 1))
+    intensity = [0.0] * (TILE_SIZE * TILE_SIZE)
+    for lat, lng, total in cells:
+        px, py = world_pixel(lat, lng, zoom)
+        px, py = int(px) - x * TILE_SIZE, int(py) - y * TILE_SIZE
+        weight = math.log1p(max(total, 1)) * scale
+        left, right = max(px - RADIUS, 0), min(px + RADIUS + 1, TILE_SIZE)
+        if left >= right:
+            continue
+        for row in range(max(py - RADIUS, 0), min(py + RADIUS + 1, TILE_SIZE)):
+            kernel = KERNEL[row - py + RADIUS][left - px + RADIUS:right - px + RADIUS]
+            start, end = row * TILE_SIZE + left, row * TILE_SIZE + right
+            intensity[start:end] = [
+                value + weight * k for value, k in zip(intensity[start:end], kernel)
+            ]
+    pixels = b"".join(PALETTE[min(int(value * 255), 255)] for value in intensity)
+    return encode_png(TILE_SIZE, TILE_SIZE, pixels)
+
+
+# #######################################################
+# Disk cache
+# #######################################################
+def tile_folder(version, zoom, x, y):
+    # The cached PNGs of map tile (zoom, x, y), one per layer
+    return os.path.join(TILE_FOLDER, str(version), str(zoom), str(x), str(y))
+
+
+def cached_tile(db, version, layer, zoom, x, y):
+    """Returns the PNG of the tile, rendered or read from the cache of this grid version."""
+    path = os.path.join(tile_folder(version, zoom, x, y), f"{layer}.png")
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    png = render_tile(db, layer, zoom, x, y)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written aside and renamed, so concurrent readers never see a partial tile
+    temp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(temp, "wb") as f:
+            f.write(png)
+        os.replace(temp, path)
+    except FileNotFoundError:
+        # the tile was invalidated while it was drawn, it is not cached
+        pass
+    return png
+
+
+def point_tiles(lat, lng):
+    """
+    Yields (zoom, x range, y range) of the map tiles drawn from the grid cell of
+    the point, at every map zoom: the spot of the cell may be anywhere in it, and
+    spreads RADIUS pixels around.
+    """
+    for zoom in range(MAX_ZOOM + 1):
+        level = grid_zoom(zoom, CELL_ZOOM_OFFSET)
+        size = TILE_SIZE * 2.0 ** (zoom - level)  # cell size in pixels
+        last = (1 << zoom) - 1
+        ranges = []
+        for cell in tile_xy(lat, lng, level):
+            low = int(math.floor((cell * size - RADIUS) / TILE_SIZE))
+            high = int(math.floor(((cell + 1) * size + RADIUS) / TILE_SIZE))
+            ranges.append(range(max(low, 0), min(high, last) + 1))
+        yield zoom, ranges[0], ranges[1]
+
+
+def invalidate(version, points):
+    """
+    Removes the cached tiles of every layer drawn from the cells of the points,
+    a list of (lat, lng), after checklists were saved there.  The other tiles of
+    the version stay cached.  Returns the number of tiles removed.  A tile drawn
+    concurrently from the data before the save can still be cached after; it is
+    redrawn at the next save nearby or rebuild.
+    """
+    root = os.path.join(TILE_FOLDER, str(version))
+    if not os.path.isdir(root):
+        return 0
+    # only the columns of tiles that were drawn are looked at
+    columns = {zoom: None for zoom in os.listdir(root)}
+    removed = 0
+    for lat, lng in points:
+        for zoom, xs, ys in point_tiles(lat, lng):
+            if str(zoom) not in columns:
+                continue
+            if columns[str(zoom)] is None:
+                columns[str(zoom)] = set(os.listdir(os.path.join(root, str(zoom))))
+            for x in xs:
+                if str(x) not in columns[str(zoom)]:
+                    continue
+                for y in ys:
+                    folder = tile_folder(version, zoom, x, y)
+                    if os.path.isdir(folder):
+                        shutil.rmtree(folder, ignore_errors=True)
+                        removed += 1
+    return removed
+
+
+def prune(version):
+    """
+    Removes the tiles of the grid versions before version, except the previous
+    one, still used by the workers that have not read the new version yet (see
+    caching.DataVersion).  Runs after the grid is rebuilt, off the request path.
+    """
+    removed = 0
+    if not os.path.isdir(TILE_FOLDER):
+        return removed
+    for name in os.listdir(TILE_FOLDER):
+        if name.isdigit() and int(name) < version - 1:
+            shutil.rmtree(os.path.join(TILE_FOLDER, name), ignore_errors=True)
+            removed += 1
+    return removed
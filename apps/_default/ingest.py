@@ -0,0 +1,545 @@
+"""
+This file loads the eBird CSV exports (species, checklists, sightings) into the database.
+
+Loading a file has two stages:
+
+- parsing: the file is split into chunks of about CHUNK_SIZE bytes, which are
+  parsed and validated into typed tuples by a pool of worker processes.  Plain
+  files are split by byte ranges, each worker reading its own range; compressed
+  files are decompressed by the main process and handed out block by block.
+- writing: a single writer, in the main process, takes the parsed chunks in file
+  order, resolves species names and sampling event identifiers from in-memory maps
+  built once per load, and writes the rows with multi-row INSERTs.  Checklists
+  already stored are updated with the values of the file (an upsert on their
+  sampling event identifier), so a corrected export is applied when reloaded.
+
+Every chunk is committed together with its byte offset in the ingest_manifest
+table, so an interrupted load resumes where it stopped.  The manifest also
+remembers the content hash of every loaded file, so unchanged files are skipped
+entirely.  Rows that cannot be loaded are written, with the reason, to a rejects
+file in the rejects/ subfolder of the exports.
+
+Exports can be comma or tab separated (like the eBird Basic Dataset), and
+gzipped: for species.csv, the loader also looks for species.tsv, species.txt and
+the same names ending in .gz.  Records must not span lines, which is true of the
+eBird exports.
+
+The loader is run with load-data.sh (see load_data.py), not at import time.
+"""
+import collections
+import concurrent.futures
+import csv
+import datetime
+import gzip
+import hashlib
+import os
+import time
+
+from .common import logger
+from .caching import species_version
+
+# Number of rows written by each multi-row INSERT statement
+BATCH_SIZE = 500
+# Number of bytes of an export parsed, written and committed between two checkpoints
+CHUNK_SIZE = 4 << 20
+# Parsing processes; files of a single chunk are parsed in the main process
+WORKERS = os.cpu_count() or 1
+
+SPECIES_CSV = "species.csv"
+CHECKLISTS_CSV = "checklists.csv"
+SIGHTINGS_CSV = "sightings.csv"
+
+REJECTS_FOLDER = "rejects"
+
+
+# Helper to safely cast values
+def safe_cast(value, cast_type, default=None):
+    try:
+        return cast_type(value)
+    except (ValueError, TypeError):
+        return default
+
+
+def file_hash(path, block_size=1 << 20):
+    # sha256 of the file contents, read in blocks so large exports are not held in memory
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def batches(iterable, size=BATCH_SIZE):
+    # Groups an iterable into lists of at most `size` items
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bulk_insert(db, table, fieldnames, rows, batch_size=BATCH_SIZE, upsert=None):
+    """
+    Inserts rows (tuples ordered like fieldnames) using multi-row INSERT statements.
+    Given upsert, the name of a unique field, the rows whose key is already stored
+    update the other fields of the stored row instead (SQLite 3.24+, PostgreSQL).
+    """
+    fields = [table[name] for name in fieldnames]
+    represent = db._adapter.represent
+    head = "INSERT INTO %s(%s) VALUES " % (
+        table._rname, ",".join(field._rname for field in fields)
+    )
+    tail = ""
+    if upsert:
+        updates = ",".join(
+            "%s=excluded.%s" % (field._rname, field._rname) for field in fields if field.name != upsert
+        )
+        tail = " ON CONFLICT(%s) DO %s" % (
+            table[upsert]._rname, "UPDATE SET " + updates if updates else "NOTHING"
+        )
+    count = 0
+    for batch in batches(rows, batch_size):
+        values = ",".join(
+            "(%s)" % ",".join(represent(value, field.type) for value, field in zip(row, fields))
+            for row in batch
+        )
+        db.executesql(head + values + tail)
+        count += len(batch)
+    return count
+
+
+def species_map(db):
+    # common_name -> species id
+    return dict(db.executesql(db(db.species)._select(db.species.common_name, db.species.id)))
+
+
+def checklist_map(db):
+    # sampling_event_id -> checklist id, for the checklists that came from a CSV export
+    query = db.checklists.sampling_event_id != None
+    return dict(db.executesql(db(query)._select(db.checklists.sampling_event_id, db.checklists.id)))
+
+
+# #######################################################
+# Reading the exports
+# #######################################################
+def find_file(folder, filename):
+    # Path of the export of filename in folder, in any of the supported formats, or None
+    stem = os.path.splitext(filename)[0]
+    for name in (filename, stem + ".tsv", stem + ".txt"):
+        for suffix in ("", ".gz"):
+            path = os.path.join(folder, name + suffix)
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def open_export(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def read_header(path):
+    """Returns the column names, the delimiter and the offset of the first row."""
+    with open_export(path) as f:
+        header = f.readline()
+    line = header.decode("utf-8-sig")
+    delimiter = "\t" if "\t" in line else ","
+    return next(csv.reader([line], delimiter=delimiter)), delimiter, len(header)
+
+
+# #######################################################
+# Parsing, in the worker processes
+# #######################################################
+# Each parser is made from the column names of the file, and converts the values of
+# a row to a typed tuple, raising ValueError with the reason if the row is invalid.
+
+def columns(fieldnames, *names):
+    # Positions of the named columns; a missing column fails the whole file
+    missing = [name for name in names if name not in fieldnames]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+    return [fieldnames.index(name) for name in names]
+
+
+def species_parser(fieldnames):
+    (name,) = columns(fieldnames, "COMMON NAME")
+
+    def parse(values):
+        common_name = values[name].strip()
+        if not common_name:
+            raise ValueError("missing common name")
+        return (common_name,)
+
+    return parse
+
+
+def parse_float(value, low, high, what):
+    # None for an empty value, else a float within [low, high]
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"invalid {what}")
+    if not low <= number <= high:
+        raise ValueError(f"{what} out of range")
+    return number
+
+
+def checklists_parser(fieldnames):
+    event, lat, lng, date, started, observer, duration = columns(
+        fieldnames, "SAMPLING EVENT IDENTIFIER", "LATITUDE", "LONGITUDE", "OBSERVATION DATE",
+        "TIME OBSERVATIONS STARTED", "OBSERVER ID", "DURATION MINUTES",
+    )
+
+    def parse(values):
+        event_id = values[event].strip()
+        if not event_id:
+            raise ValueError("missing sampling event identifier")
+        observation_date = values[date] or None
+        time_started = values[started] or None
+        try:
+            if observation_date:
+                datetime.date.fromisoformat(observation_date)
+            if time_started:
+                datetime.time.fromisoformat(time_started)
+        except ValueError:
+            raise ValueError("invalid date or time")
+        return (
+            event_id,
+            parse_float(values[lat], -90, 90, "latitude"),
+            parse_float(values[lng], -180, 180, "longitude"),
+            observation_date,
+            time_started,
+            values[observer],
+            safe_cast(values[duration], float),
+        )
+
+    return parse
+
+
+def sightings_parser(fieldnames):
+    event, name, count = columns(
+        fieldnames, "SAMPLING EVENT IDENTIFIER", "COMMON NAME", "OBSERVATION COUNT"
+    )
+
+    def parse(values):
+        # "X" means the species was present but not counted
+        if values[count] == "X":
+            observation_count = 0
+        else:
+            observation_count = safe_cast(values[count], int)
+        if observation_count is None or observation_count < 0:
+            raise ValueError("invalid count")
+        return (values[event].strip(), values[name], observation_count)
+
+    return parse
+
+
+PARSERS = {
+    "species": species_parser,
+    "checklists": checklists_parser,
+    "sightings": sightings_parser,
+}
+
+
+def parse_block(kind, fieldnames, delimiter, data, offset):
+    """
+    Parses data, whole lines of an export starting at byte offset, with the parser
+    of kind.  Returns (rows, rejects, end offset) where rows are (offset, tuple)
+    pairs and rejects are (offset, reason, values) triples.
+    """
+    parse = PARSERS[kind](fieldnames)
+    rows, rejects = [], []
+    position = [offset]
+
+    def lines():
+        for line in data.splitlines(keepends=True):
+            position[0] += len(line)
+            yield line.decode("utf-8", errors="replace")
+
+    quoting = csv.QUOTE_NONE if delimiter == "\t" else csv.QUOTE_MINIMAL
+    start = offset
+    # csv.reader pulls lines lazily, so position is the end of the current row
+    for values in csv.reader(lines(), delimiter=delimiter, quoting=quoting):
+        if any(values):
+            try:
+                if len(values) != len(fieldnames):
+                    raise ValueError("wrong number of fields")
+                rows.append((start, parse(values)))
+            except ValueError as e:
+                rejects.append((start, str(e), values))
+        start = position[0]
+    return rows, rejects, offset + len(data)
+
+
+def parse_range(kind, path, fieldnames, delimiter, start, end):
+    """Parses the lines of an uncompressed export that start within [start, end)."""
+    with open(path, "rb") as f:
+        # skip the end of a line started in the previous range
+        f.seek(start - 1)
+        if f.read(1) != b"\n":
+            f.readline()
+        begin = f.tell()
+        data = f.read(end - begin) if begin < end else b""
+        if data and not data.endswith(b"\n"):
+            data += f.readline()
+    return parse_block(kind, fieldnames, delimiter, data, begin)
+
+
+def read_blocks(path, offset, size):
+    # Yields (data, offset) blocks of whole lines of about size bytes, from offset
+    with open_export(path) as f:
+        f.readline()
+        # compressed files cannot seek, the rows already loaded are read again
+        while f.tell() < offset:
+            if not f.read(min(size, offset - f.tell())):
+                break
+        position = f.tell()
+        while True:
+            data = f.read(size)
+            if not data:
+                break
+            if not data.endswith(b"\n"):
+                data += f.readline()
+            yield data, position
+            position += len(data)
+
+
+def parse_tasks(kind, path, fieldnames, delimiter, offset, chunk_size):
+    # The (function, *args) parsing the export from offset, one per chunk, in file order
+    if path.endswith(".gz"):
+        for data, start in read_blocks(path, offset, chunk_size):
+            yield (parse_block, kind, fieldnames, delimiter, data, start)
+    else:
+        size = os.path.getsize(path)
+        for start in range(offset, size, chunk_size):
+            yield (parse_range, kind, path, fieldnames, delimiter, start, min(start + chunk_size, size))
+
+
+def parsed_chunks(tasks, workers):
+    """
+    Runs the parsing tasks, in a pool of worker processes if workers > 1, and
+    yields their results in order.  At most two tasks per worker are in flight,
+    so a slow writer does not make parsed chunks pile up in memory.
+    """
+    if workers <= 1:
+        for function, *args in tasks:
+            yield function(*args)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for function, *args in tasks:
+            pending.append(pool.submit(function, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# #######################################################
+# Writing, in the main process
+# #######################################################
+# Each resolver is given the db and whether the file is loaded from the start.  It
+# returns a function converting a parsed tuple to a tuple ordered like the loader's
+# fields, or to None if the row is skipped; it raises ValueError to reject it.
+
+def species_resolver(db, fresh):
+    # A species is only its name: the names already stored have nothing to update
+    known = species_map(db)
+
+    def resolve(row):
+        name = row[0]
+        if name not in known:
+            known[name] = None
+            return row
+
+    return resolve
+
+
+def checklists_resolver(db, fresh):
+    # Every checklist is written, the stored ones are updated (see LOADERS); one
+    # repeated in the file is loaded once, like a species
+    seen = set()
+
+    def resolve(row):
+        event_id = row[0]
+        if event_id not in seen:
+            seen.add(event_id)
+            return row
+
+    return resolve
+
+
+def sightings_resolver(db, fresh):
+    if fresh:
+        # The sightings file is authoritative for the checklists that came from CSV
+        # exports: their sightings are replaced, which keeps reloading a changed file
+        # idempotent.  Checklists entered through the app have no sampling_event_id
+        # and are never touched.
+        csv_checklists = db(db.checklists.sampling_event_id != None)._select(db.checklists.id)
+        db(db.sightings.sampling_event_id.belongs(csv_checklists)).delete()
+    species_ids = species_map(db)
+    checklist_ids = checklist_map(db)
+
+    def resolve(row):
+        event_id, name, observation_count = row
+        species_id = species_ids.get(name)
+        if species_id is None:
+            raise ValueError("unknown species")
+        checklist_id = checklist_ids.get(event_id)
+        if checklist_id is None:
+            raise ValueError("unknown checklist")
+        return (checklist_id, species_id, observation_count)
+
+    return resolve
+
+
+# Files are loaded in dependency order; a reloaded file forces its dependents to reload.
+# The last item is the unique field by which the rows already stored are updated
+# (see bulk_insert), None if they are never stored twice.
+LOADERS = [
+    (SPECIES_CSV, "species", ["common_name"], species_resolver, None),
+    (CHECKLISTS_CSV, "checklists",
+     ["sampling_event_id", "latitude", "longitude", "observation_date",
+      "time_started", "observer_id", "duration_minutes"],
+     checklists_resolver, "sampling_event_id"),
+    (SIGHTINGS_CSV, "sightings", ["sampling_event_id", "common_name", "observation_count"],
+     sightings_resolver, None),
+]
+
+
+class RejectsFile:
+    """Writes the rejected rows of an export, with their offset and reason, on demand."""
+
+    def __init__(self, path, append):
+        self.path = path
+        self.append = append
+        self.file = None
+        self.counts = {}
+
+    def write(self, offset, reason, values):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            exists = self.append and os.path.exists(self.path)
+            self.file = open(self.path, "a" if exists else "w", newline="")
+            self.writer = csv.writer(self.file)
+            if not exists:
+                self.writer.writerow(["OFFSET", "REASON", "VALUES..."])
+        self.writer.writerow([offset, reason, *values])
+        self.counts[reason] = self.counts.get(reason, 0) + 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def load_file(db, path, tablename, fieldnames, resolver, sha256, manifest=None,
+              progress=None, chunk_size=CHUNK_SIZE, workers=WORKERS, filename=None, upsert=None):
+    """
+    Streams one export into tablename, committing a checkpoint after every chunk.
+    If manifest is an unfinished load of the same content, resumes from its offset.
+    upsert is the unique field by which stored rows are updated (see bulk_insert).
+    Returns the total number of rows inserted or updated for this file.
+    """
+    filename = filename or os.path.basename(path)
+    header, delimiter, data_offset = read_header(path)
+    # fails early if columns are missing
+    PARSERS[tablename](header)
+    resume = manifest is not None and manifest.status == "loading" and manifest.sha256 == sha256
+    offset = max(manifest.byte_offset, data_offset) if resume else data_offset
+    rows_loaded = manifest.rows_loaded if resume else 0
+    if resume:
+        logger.info(f"Resuming {path} at byte {offset} ({rows_loaded} rows already loaded)")
+    if not path.endswith(".gz") and os.path.getsize(path) - offset <= chunk_size:
+        workers = 1
+    resolve = resolver(db, not resume)
+    rejects = RejectsFile(os.path.join(os.path.dirname(path), REJECTS_FOLDER, filename), resume)
+    rows_read, started = 0, time.time()
+    tasks = parse_tasks(tablename, path, header, delimiter, offset, chunk_size)
+    try:
+        for rows, parse_rejects, offset in parsed_chunks(tasks, workers):
+            for reject in parse_rejects:
+                rejects.write(*reject)
+            values = []
+            for row_offset, row in rows:
+                try:
+                    value = resolve(row)
+                except ValueError as e:
+                    rejects.write(row_offset, str(e), row)
+                    continue
+                if value is not None:
+                    values.append(value)
+            rows_loaded += bulk_insert(db, db[tablename], fieldnames, values, upsert=upsert)
+            rows_read += len(rows) + len(parse_rejects)
+            db.ingest_manifest.update_or_insert(
+                db.ingest_manifest.filename == filename,
+                filename=filename,
+                sha256=sha256,
+                status="loading",
+                byte_offset=offset,
+                rows_loaded=rows_loaded,
+                loaded_on=datetime.datetime.utcnow(),
+            )
+            db.commit()
+            if progress:
+                progress(filename, rows_read, rows_loaded, time.time() - started)
+    finally:
+        rejects.close()
+    db.ingest_manifest.update_or_insert(
+        db.ingest_manifest.filename == filename,
+        filename=filename,
+        sha256=sha256,
+        status="done",
+        byte_offset=offset,
+        rows_loaded=rows_loaded,
+        loaded_on=datetime.datetime.utcnow(),
+    )
+    db.commit()
+    if rejects.counts:
+        logger.warning(f"Rejected rows in {path}: {rejects.counts}, see {rejects.path}")
+    return rows_loaded
+
+
+def load_all(db, folder, force=False, progress=None, chunk_size=CHUNK_SIZE, workers=WORKERS):
+    """
+    Loads the exports found in folder, skipping those whose content hash matches
+    a completed load in the manifest (unless force is set).  Returns a dict mapping
+    each filename to the number of rows it holds, or None if the file was skipped.
+    progress(filename, rows_read, rows_loaded, seconds) is called after every chunk.
+    """
+    summary = {}
+    upstream_changed = force
+    try:
+        for filename, tablename, fieldnames, resolver, upsert in LOADERS:
+            path = find_file(folder, filename)
+            if path is None:
+                logger.error(f"CSV file not found - {os.path.join(folder, filename)}")
+                summary[filename] = None
+                continue
+            sha256 = file_hash(path)
+            manifest = db(db.ingest_manifest.filename == filename).select().first()
+            if (manifest and manifest.status == "done" and manifest.sha256 == sha256
+                    and not upstream_changed):
+                summary[filename] = None
+                continue
+            if upstream_changed:
+                # a dependency was reloaded, so this file cannot resume from a checkpoint
+                manifest = None
+            summary[filename] = load_file(
+                db, path, tablename, fieldnames, resolver, sha256, manifest,
+                progress=progress, chunk_size=chunk_size, workers=workers, filename=filename,
+                upsert=upsert,
+            )
+            upstream_changed = True
+            if tablename == "species" and summary[filename]:
+                # the typeahead indexes of the running servers reload the names
+                species_version.bump()
+                db.commit()
+            logger.info(f"Loaded {summary[filename]} rows from {path}")
+    except Exception:
+        db.rollback()
+        raise
+    return summary
@@ -0,0 +1,153 @@
+"""
+This file defines the instrumentation fixture of the actions.
+
+    @action('api/something')
+    @action.uses(instrumented, db)
+    def something():
+        ...
+
+For every request it records the wall time of the action (including the fixtures
+listed after it, e.g. the commit of db), the number of SQL statements, their total
+time and the number of rows fetched.  Requests slower than settings.SLOW_ACTION_MS
+and statements slower than settings.SLOW_QUERY_MS are logged, and the counters are
+aggregated per route for the api/metrics endpoint.
+
+Statements are timed by a pydal execution handler, leaving out the ones pydal runs
+to set up or check a connection taken from the pool (SETUP_STATEMENTS), which are
+not the action's.  Rows are counted by the actions, on the results they get back:
+
+    rows = fetched(db(query).select(...))
+
+so rows read straight from a cursor, e.g. by the NDJSON streams, are not.
+"""
+import threading
+import time
+
+from py4web import request
+from py4web.core import Fixture
+from pydal.helpers.classes import ExecutionHandler
+
+from . import settings
+from .common import db, logger
+
+# Characters of a slow statement written to the log
+LOGGED_SQL_LENGTH = 1000
+# Statements run by pydal on the connections taken from the pool, before the
+# action: the liveness check and the PRAGMAs (SQLite) or SETs (PostgreSQL) of the
+# new connections
+SETUP_STATEMENTS = ("SELECT 1;", "PRAGMA ", "SET ")
+
+_local = threading.local()
+
+
+class RequestStats:
+
+    def __init__(self, route=None):
+        # the route is kept here for the threads that count statements on behalf
+        # of the request (see bind_stats), where request is not bound
+        self.route = route
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+
+
+def current_stats():
+    # Stats of the request being handled by this thread, None outside instrumented actions
+    return getattr(_local, "stats", None)
+
+
+def bind_stats(stats):
+    # Counts the statements of this thread in stats, e.g. for a sub-query run
+    # by another thread on behalf of a request (see subqueries.py)
+    _local.stats = stats
+
+
+class SQLTimer(ExecutionHandler):
+    """Counts and times the statements of the instrumented requests."""
+
+    def before_execute(self, command):
+        self.started = time.perf_counter()
+
+    def after_execute(self, command):
+        stats = current_stats()
+        if stats is None or command.startswith(SETUP_STATEMENTS):
+            return
+        elapsed = time.perf_counter() - self.started
+        stats.queries += 1
+        stats.sql_seconds += elapsed
+        if elapsed * 1000 >= settings.SLOW_QUERY_MS:
+            logger.warning("slow query (%.1f ms) in %s: %s",
+                           elapsed * 1000, stats.route, command[:LOGGED_SQL_LENGTH])
+
+
+def fetched(rows):
+    """Adds the rows fetched by a select or executesql to the request stats, returns them."""
+    stats = current_stats()
+    if stats is not None:
+        stats.rows += len(rows)
+    return rows
+
+
+class Instrumentation(Fixture):
+    """Fixture recording the time, SQL statements and rows of every request."""
+
+    def __init__(self, db):
+        self.db = db
+        db._adapter.execution_handlers.append(SQLTimer)
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def on_request(self, context):
+        _local.stats = RequestStats(request.path)
+
+    def on_success(self, context):
+        self.record(error=False)
+
+    def on_error(self, context):
+        self.record(error=True)
+
+    def record(self, error):
+        stats = current_stats()
+        _local.stats = None
+        if stats is None:
+            return
+        elapsed = time.perf_counter() - stats.started
+        route = stats.route
+        if elapsed * 1000 >= settings.SLOW_ACTION_MS:
+            logger.warning(
+                "slow action %s %s: %.1f ms, %d queries (%.1f ms), %d rows",
+                request.method, route, elapsed * 1000,
+                stats.queries, stats.sql_seconds * 1000, stats.rows,
+            )
+        with self.lock:
+            metrics = self.metrics.get(route)
+            if metrics is None:
+                metrics = self.metrics[route] = dict(
+                    requests=0, errors=0, slow=0, seconds=0.0, max_seconds=0.0,
+                    queries=0, sql_seconds=0.0, rows=0,
+                )
+            metrics["requests"] += 1
+            metrics["errors"] += error
+            metrics["slow"] += elapsed * 1000 >= settings.SLOW_ACTION_MS
+            metrics["seconds"] += elapsed
+            metrics["max_seconds"] = max(metrics["max_seconds"], elapsed)
+            metrics["queries"] += stats.queries
+            metrics["sql_seconds"] += stats.sql_seconds
+            metrics["rows"] += stats.rows
+
+    def summary(self):
+        """Returns the counters of every route, with per-request averages."""
+        with self.lock:
+            metrics = {route: dict(values) for route, values in self.metrics.items()}
+        for values in metrics.values():
+            requests = values["requests"]
+            values["avg_ms"] = values["seconds"] * 1000 / requests
+            values["max_ms"] = values.pop("max_seconds") * 1000
+            values["avg_queries"] = values["queries"] / requests
+            values["avg_sql_ms"] = values["sql_seconds"] * 1000 / requests
+            values["avg_rows"] = values["rows"] / requests
+        return metrics
+
+
+instrumented = Instrumentation(db)
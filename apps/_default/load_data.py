@@ -0,0 +1,92 @@
+"""
+Command line entry point that loads the CSV exports into the database.
+
+    python -m apps._default.load_data [--folder FOLDER] [--chunk-size BYTES] [--workers N] [--force]
+
+(or simply ./load-data.sh from the project root).  Files are streamed in chunks
+and a checkpoint is committed after every chunk, so an interrupted load can be
+resumed by running the command again.  Files that were already loaded and have
+not changed are skipped.  The density grid, the trend rollup, the checklist
+clusters and (if enabled) the columnar snapshot are rebuilt after new data is loaded.
+"""
+import argparse
+import os
+import sys
+
+from .models import db
+from . import clusters, ingest, density_grid, heat_tiles, trends
+from .caching import data_version, grid_version
+from .snapshot import snapshot
+
+UPLOADS_FOLDER = os.path.join(os.path.dirname(__file__), "uploads")
+
+
+def print_progress(filename, rows_read, rows_loaded, seconds):
+    rate = rows_read / seconds if seconds else 0
+    print(f"{filename}: {rows_read} rows read, {rows_loaded} loaded, {rate:,.0f} rows/s", flush=True)
+
+
+def rebuild_derived(db):
+    """Rebuilds the tables derived from the sightings; returns their row counts."""
+    counts = {}
+    cells = None
+    if snapshot:
+        # the snapshot is rebuilt first, the grid is then computed from its arrays
+        counts["snapshot_sightings"] = snapshot.rebuild(db)
+        cells = snapshot.density_cells()
+    counts["density_cells"] = density_grid.rebuild(db, cells)
+    counts["density_maxima"] = heat_tiles.refresh(db)
+    counts["daily_trends"] = trends.rebuild(db)
+    counts["checklist_clusters"] = clusters.rebuild(db)
+    # invalidates the responses and heat tiles cached by running servers
+    data_version.bump()
+    heat_tiles.prune(grid_version.bump())
+    db.commit()
+    return counts
+
+
+def needs_rebuild(db, summary):
+    # Derived tables are rebuilt whenever the data changed, or if they are missing
+    changed = any(rows is not None for rows in summary.values())
+    missing = any(db(table).isempty() for table in (
+        db.density_cells, db.density_maxima, db.daily_trends, db.checklist_clusters
+    ))
+    return changed or missing or bool(snapshot and snapshot.parts() is None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load the eBird CSV exports into the database.")
+    parser.add_argument("--folder", default=UPLOADS_FOLDER,
+                        help="folder containing species.csv, checklists.csv and sightings.csv")
+    parser.add_argument("--chunk-size", type=int, default=ingest.CHUNK_SIZE,
+                        help="bytes of an export parsed and committed between two checkpoints")
+    parser.add_argument("--workers", type=int, default=ingest.WORKERS,
+                        help="processes parsing the exports")
+    parser.add_argument("--force", action="store_true",
+                        help="reload every file, even if unchanged or partially loaded")
+    parser.add_argument("--quiet", action="store_true", help="do not report progress")
+    args = parser.parse_args(argv)
+
+    missing = [
+        filename for filename, *_ in ingest.LOADERS
+        if ingest.find_file(args.folder, filename) is None
+    ]
+    if missing:
+        print(f"Error: File not found - {', '.join(missing)} in {args.folder}")
+        return 1
+
+    summary = ingest.load_all(
+        db, args.folder, force=args.force, chunk_size=args.chunk_size, workers=args.workers,
+        progress=None if args.quiet else print_progress,
+    )
+    for filename, rows in summary.items():
+        print(f"{filename}: {'unchanged, skipped' if rows is None else f'{rows} rows'}")
+
+    if needs_rebuild(db, summary):
+        for tablename, rows in rebuild_derived(db).items():
+            print(f"{tablename}: {rows} rows", flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
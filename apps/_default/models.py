@@ -1,11 +1,11 @@
 """
-This file defines the database models and loads data from CSV files.
+This file defines the database models.
+The CSV data in uploads/ is loaded separately, with load-data.sh (see load_data.py).
 """
-import os
-import csv
 import datetime
 from pydal.validators import IS_NOT_EMPTY, IS_INT_IN_RANGE, IS_FLOAT_IN_RANGE, IS_DATE
 from .common import db, Field, auth 
+from . import spatial
 
 def get_user_email():
     return auth.current_user.get('email') if auth.current_user else None
@@ -13,6 +13,12 @@ def get_user_email():
 def get_time():
     return datetime.datetime.utcnow()
 
+def define_index(table, name, *fieldnames, unique=False):
+    # Creates the index if it does not exist yet (pydal migrations do not manage indexes)
+    columns = ", ".join(table[fieldname]._rname for fieldname in fieldnames)
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    db.executesql(f"CREATE {kind} IF NOT EXISTS {name} ON {table._rname} ({columns});")
+
 # Define the database tables
 db.define_table(
     "species",
@@ -28,7 +34,18 @@ db.define_table(
     Field("time_started", "time"),
     Field("observer_id", requires=IS_NOT_EMPTY()),
     Field("duration_minutes", "double"),
+    # key chosen by the app for the checklists it uploads, so that a retried
+    # upload does not save them twice, or generated when it sends none (see
+    # checklist_store.save_checklists)
+    Field("idempotency_key", "string", length=128),
 )
+# the trends and date filters select checklists by date, narrowed by position
+# from the index entries (see observations.py); it supersedes the former
+# checklists_date_idx on observation_date alone
+define_index(db.checklists, "checklists_date_position_idx", "observation_date", "latitude", "longitude")
+db.executesql("DROP INDEX IF EXISTS checklists_date_idx;")
+# one checklist per key and observer; the imported checklists have no key
+define_index(db.checklists, "checklists_key_idx", "observer_id", "idempotency_key", unique=True)
 # User-Checklist association table 
 db.define_table(
     "user_checklists",
@@ -37,111 +54,109 @@ db.define_table(
     Field("species_id", "reference species", requires=IS_NOT_EMPTY()),
     Field("observation_count", "integer", requires=IS_INT_IN_RANGE(1, None)),
 )
+# my_checklist pages through a user's entries by descending id; the index
+# also serves every lookup by user_email alone
+define_index(db.user_checklists, "user_checklists_user_idx", "user_email", "id")
+define_index(db.user_checklists, "user_checklists_checklist_idx", "checklist_id")
 db.define_table(
     "sightings",
     Field("sampling_event_id", "reference checklists", requires=IS_NOT_EMPTY()),
     Field("common_name", "reference species", requires=IS_NOT_EMPTY()),
     Field("observation_count", "integer", requires=IS_INT_IN_RANGE(1, None)),
 )
+# Foreign keys of the sightings, used by every join with checklists and species
+define_index(db.sightings, "sightings_checklist_idx", "sampling_event_id")
+# The sightings of a species, and of a species in a given checklist (see
+# observations.py); it supersedes the former sightings_species_idx on common_name alone
+define_index(db.sightings, "sightings_species_checklist_idx", "common_name", "sampling_event_id")
+db.executesql("DROP INDEX IF EXISTS sightings_species_idx;")
+
+# Spatial access path for bounding-box queries on checklists (see spatial.py):
+# an R*Tree on SQLite, a B-tree index on (latitude, longitude) elsewhere.
+if db._adapter.dbengine == "sqlite":
+    spatial.define_rtree(db)
+else:
+    define_index(db.checklists, "checklists_position_idx", "latitude", "longitude")
+
+# One row per loaded CSV file, used to skip files that have not changed
+# and to resume a load that was interrupted (status "loading").
+db.define_table(
+    "ingest_manifest",
+    Field("filename", "string", unique=True),
+    Field("sha256", "string"),
+    Field("status", "string", default="loading"),
+    Field("byte_offset", "bigint", default=0),
+    Field("rows_loaded", "integer"),
+    Field("loaded_on", "datetime", default=get_time),
+)
+# Counters bumped whenever the data changes, used to invalidate cached responses
+db.define_table(
+    "data_version",
+    Field("name", "string", unique=True),
+    Field("version", "integer", default=0),
+)
+# Pre-aggregated heatmap cells, see density_grid.py.
+# species_id is 0 for the all-species layer, so it is not a reference.
+db.define_table(
+    "density_cells",
+    Field("zoom", "integer"),
+    Field("species_id", "integer"),
+    Field("tile_x", "integer"),
+    Field("tile_y", "integer"),
+    Field("points", "integer", default=0),
+    Field("total", "integer", default=0),
+    Field("lat_sum", "double", default=0),
+    Field("lng_sum", "double", default=0),
+)
+define_index(db.density_cells, "density_cells_cell_idx", "zoom", "species_id", "tile_x", "tile_y")
+# Largest cell total of every layer at every grid level, which scales the heatmap
+# tiles; recomputed when the grid is rebuilt, see heat_tiles.refresh
+db.define_table(
+    "density_maxima",
+    Field("zoom", "integer"),
+    Field("species_id", "integer"),
+    Field("total", "integer", default=0),
+)
+define_index(db.density_maxima, "density_maxima_layer_idx", "zoom", "species_id")
+# Pre-aggregated checklist clusters of the maps, see clusters.py.
+db.define_table(
+    "checklist_clusters",
+    Field("zoom", "integer"),
+    Field("tile_x", "integer"),
+    Field("tile_y", "integer"),
+    Field("checklists", "integer", default=0),
+    Field("lat_sum", "double", default=0),
+    Field("lng_sum", "double", default=0),
+)
+define_index(db.checklist_clusters, "checklist_clusters_cell_idx", "zoom", "tile_x", "tile_y")
+# Daily observation totals per species and observer, see trends.py.
+# observer_id is "" for the all-observers rows.
+db.define_table(
+    "daily_trends",
+    Field("species_id", "integer"),
+    Field("observation_date", "date"),
+    Field("observer_id", "string"),
+    Field("sightings", "integer", default=0),
+    Field("total", "integer", default=0),
+)
+define_index(
+    db.daily_trends, "daily_trends_species_idx", "species_id", "observer_id", "observation_date"
+)
+# Background jobs and their status, see tasks.py
+db.define_table(
+    "jobs",
+    Field("name", "string"),
+    Field("job_key", "string"),
+    Field("params", "json"),
+    Field("status", "string", default="queued"),
+    Field("result", "json"),
+    Field("error", "text"),
+    Field("created_on", "datetime", default=get_time),
+    Field("started_on", "datetime"),
+    Field("finished_on", "datetime"),
+    # "host:pid" of the process running the job, see tasks.fail_orphaned_jobs
+    Field("owner", "string"),
+)
+define_index(db.jobs, "jobs_key_idx", "job_key", "status")
 
 db.commit()
-
-# Base paths for CSV files
-base_path = os.path.dirname(__file__)
-uploads_path = os.path.join(base_path, "uploads")
-
-species_csv = os.path.join(uploads_path, "species.csv")
-checklist_csv = os.path.join(uploads_path, "checklists.csv")
-sightings_csv = os.path.join(uploads_path, "sightings.csv")
-
-# Verify file existence and preview contents
-def validate_and_preview(file_path, rows=5):
-    if not os.path.exists(file_path):
-        print(f"Error: File not found - {file_path}")
-        return False
-    print(f"Preview of {file_path}:")
-    with open(file_path, "r", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        for i, row in enumerate(reader):
-            print(row)
-            if i >= rows - 1:
-                break
-    return True
-
-if not validate_and_preview(species_csv):
-    exit(1)
-if not validate_and_preview(checklist_csv):
-    exit(1)
-if not validate_and_preview(sightings_csv):
-    exit(1)
-
-# Helper to safely cast values
-def safe_cast(value, cast_type, default=None):
-    try:
-        return cast_type(value)
-    except (ValueError, TypeError):
-        return default
-
-# Load species CSV
-with open(species_csv, "r", encoding="utf-8") as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        try:
-            db.species.insert(common_name=row["COMMON NAME"])
-        except Exception as e:
-            print(f"Error inserting species: {row['COMMON NAME']} - {e}")
-
-# Load checklist CSV
-with open(checklist_csv, "r", encoding="utf-8") as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        try:
-            db.checklists.insert(
-                sampling_event_id=row["SAMPLING EVENT IDENTIFIER"],
-                latitude=safe_cast(row["LATITUDE"], float),
-                longitude=safe_cast(row["LONGITUDE"], float),
-                observation_date=safe_cast(row["OBSERVATION DATE"], str),
-                time_started=row["TIME OBSERVATIONS STARTED"] or None,
-                observer_id=row["OBSERVER ID"],
-                duration_minutes=safe_cast(row["DURATION MINUTES"], float),
-            )
-        except Exception as e:
-            print(f"Error inserting checklist: {row} - {e}")
-
-# Load sightings CSV
-# Load sightings CSV
-with open(sightings_csv, "r", encoding="utf-8") as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        try:
-            # Check for the "X" value and set it to 0
-            if row["OBSERVATION COUNT"] == "X":
-                observation_count = 0
-            else:
-                observation_count = safe_cast(row["OBSERVATION COUNT"], int)
-
-            if observation_count is None:
-                print(f"Warning: Invalid observation count '{row['OBSERVATION COUNT']}' for {row['COMMON NAME']}. Skipping.")
-                continue
-
-            species_record = db(db.species.common_name == row["COMMON NAME"]).select().first()
-            if not species_record:
-                print(f"Warning: Species '{row['COMMON NAME']}' not found. Skipping.")
-                continue
-
-            checklist_record = db(db.checklists.sampling_event_id == row["SAMPLING EVENT IDENTIFIER"]).select().first()
-            if not checklist_record:
-                print(f"Warning: Checklist with ID '{row['SAMPLING EVENT IDENTIFIER']}' not found. Skipping.")
-                continue
-
-            db.sightings.insert(
-                sampling_event_id=checklist_record.id,
-                common_name=species_record.id,
-                observation_count=observation_count,
-            )
-        except Exception as e:
-            print(f"Error inserting sighting: {row} - {e}")
-
-db.commit()
-
-print("CSV data loaded successfully.")
\ No newline at end of file
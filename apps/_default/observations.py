@@ -0,0 +1,227 @@
+"""
+This file is the query layer for the sightings filtered by any combination of
+species, bounding box and date range, used by the actions when a filter is not
+covered by a pre-aggregated table (e.g. a date window on the map).
+
+Each filter has its own access path:
+- species: the sightings (common_name, sampling_event_id) index
+- date range: the checklists (observation_date, latitude, longitude) index
+- bounding box: the R*Tree on SQLite, the (latitude, longitude) index elsewhere
+
+plan() estimates how many sightings every filter alone selects, from the
+pre-aggregated tables (trend rollup, density grid) and the date span, and the
+most selective one drives the query: its table is scanned first through its
+index, and the other filters are checked on the joined rows.  On SQLite the
+order is enforced with CROSS JOIN and by keeping the other filters off the
+indexes of the driving table (unary +); other databases plan the join order
+from their own statistics.
+"""
+import datetime
+
+from .density_grid import ALL_SPECIES, GRID_ZOOMS, grid_zoom, in_tile_range, tile_range, tile_xy
+from .instrumentation import fetched
+from .trends import ALL_OBSERVERS
+
+SPECIES, DATES, BBOX = "species", "dates", "bbox"
+# The bbox estimate reads the grid level where the box spans at most this many cells a side
+ESTIMATE_CELLS = 8
+
+
+class Filters:
+    """Species id, bbox (west, south, east, north) and date range, all optional."""
+
+    def __init__(self, species_id=None, bbox=None, date_from=None, date_to=None):
+        self.species_id = species_id
+        self.bbox = bbox
+        self.date_from = date_from
+        self.date_to = date_to
+
+    def has_dates(self):
+        return bool(self.date_from or self.date_to)
+
+
+# #######################################################
+# Planning
+# #######################################################
+def located_sightings(db):
+    # Number of located sightings, from the coarsest level of the density grid
+    table = db.density_cells
+    points = table.points.sum()
+    query = (table.zoom == GRID_ZOOMS[0]) & (table.species_id == ALL_SPECIES)
+    return fetched(db(query).select(points)).first()[points] or 0
+
+
+def estimate_species(db, filters):
+    # Sightings of the species within the dates, summed from the trend rollup
+    table = db.daily_trends
+    query = (table.species_id == filters.species_id) & (table.observer_id == ALL_OBSERVERS)
+    if filters.date_from:
+        query &= table.observation_date >= filters.date_from
+    if filters.date_to:
+        query &= table.observation_date <= filters.date_to
+    sightings = table.sightings.sum()
+    return fetched(db(query).select(sightings)).first()[sightings] or 0
+
+
+def estimate_dates(db, filters, total):
+    # The share of total within the dates, assuming sightings are spread evenly
+    date = db.checklists.observation_date
+    row = fetched(db(date != None).select(date.min(), date.max())).first()
+    first, last = row[date.min()], row[date.max()]
+    if not first:
+        return 0
+    start, end = max(filters.date_from or first, first), min(filters.date_to or last, last)
+    if start > end:
+        return 0
+    return total * ((end - start).days + 1) / ((last - first).days + 1)
+
+
+def estimate_bbox(db, filters):
+    # Sightings in the density grid cells that intersect the box
+    table = db.density_cells
+    for level in sorted(GRID_ZOOMS, reverse=True):
+        x0, y0, x1, y1 = tile_range(filters.bbox, level)
+        if max(x1 - x0, y1 - y0) < ESTIMATE_CELLS or level == GRID_ZOOMS[0]:
+            break
+    points = table.points.sum()
+    query = (
+        (table.zoom == level) & (table.species_id == ALL_SPECIES)
+        & in_tile_range(table, filters.bbox, level)
+    )
+    return fetched(db(query).select(points)).first()[points] or 0
+
+
+def plan(db, filters, sightings=True):
+    """
+    Returns (driving filter or None, {filter: estimated sightings}).  With
+    sightings=False the species filter cannot drive (queries on checklists only).
+    """
+    estimates = {}
+    if filters.species_id is not None and sightings:
+        estimates[SPECIES] = estimate_species(db, filters)
+    if filters.bbox:
+        estimates[BBOX] = estimate_bbox(db, filters)
+    if filters.has_dates():
+        estimates[DATES] = estimate_dates(db, filters, located_sightings(db))
+    driver = min(estimates, key=estimates.get) if estimates else None
+    return driver, estimates
+
+
+# #######################################################
+# SQL
+# #######################################################
+def build_sql(db, filters, columns, groupby=None, orderby=None, sightings=True):
+    """
+    Returns the SELECT of columns (SQL expressions) over the checklists, joined with
+    their sightings if sightings, that match filters, in the order chosen by plan().
+    """
+    driver, _ = plan(db, filters, sightings)
+    adapter = db._adapter
+    checklists, table = db.checklists, db.sightings
+    sqlite = adapter.dbengine == "sqlite"
+    rtree = db.checklists_rtree if "checklists_rtree" in db.tables else None
+
+    def column(field, driving):
+        # keeps SQLite from using an index of the driving table for another filter
+        return field.sqlsafe if driving or not sqlite else "+" + field.sqlsafe
+
+    where = []
+    if sightings:
+        where.append(f"{table.sampling_event_id.sqlsafe} = {checklists.id.sqlsafe}")
+        if filters.species_id is not None:
+            where.append(f"{table.common_name.sqlsafe} = {adapter.represent(filters.species_id, 'integer')}")
+    if filters.date_from:
+        date = column(checklists.observation_date, driver == DATES)
+        where.append(f"{date} >= {adapter.represent(filters.date_from, 'date')}")
+    if filters.date_to:
+        date = column(checklists.observation_date, driver == DATES)
+        where.append(f"{date} <= {adapter.represent(filters.date_to, 'date')}")
+    if filters.bbox:
+        west, south, east, north = (adapter.represent(value, "double") for value in filters.bbox)
+        latitude = column(checklists.latitude, driver == BBOX)
+        longitude = column(checklists.longitude, driver == BBOX)
+        where += [
+            f"{latitude} <= {north}", f"{latitude} >= {south}",
+            f"{longitude} <= {east}", f"{longitude} >= {west}",
+        ]
+        if rtree and driver == BBOX:
+            # the R*Tree finds the candidates, the predicates above filter them exactly
+            where += [
+                f"{rtree.id.sqlsafe} = {checklists.id.sqlsafe}",
+                f"{rtree.min_lat.sqlsafe} <= {north}", f"{rtree.max_lat.sqlsafe} >= {south}",
+                f"{rtree.min_lng.sqlsafe} <= {east}", f"{rtree.max_lng.sqlsafe} >= {west}",
+            ]
+    tables = [checklists._rname]
+    if sightings:
+        tables = [table._rname] + tables if driver == SPECIES else tables + [table._rname]
+    if rtree and driver == BBOX:
+        tables.insert(0, rtree._rname)
+    sql = "SELECT %s FROM %s" % (", ".join(columns), " CROSS JOIN ".join(tables))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if groupby:
+        sql += " GROUP BY " + groupby
+    if orderby:
+        sql += " ORDER BY " + orderby
+    return sql + ";"
+
+
+# #######################################################
+# Queries of the actions
+# #######################################################
+def species_totals(db, filters):
+    """Returns [(species id, total count, distinct checklists)] of the matching sightings."""
+    table = db.sightings
+    species = table.common_name.sqlsafe
+    return fetched(db.executesql(build_sql(db, filters, [
+        species,
+        f"SUM({table.observation_count.sqlsafe})",
+        f"COUNT(DISTINCT {table.sampling_event_id.sqlsafe})",
+    ], groupby=species)))
+
+
+def contributors(db, filters):
+    """Returns [(observer, checklists)] of the matching checklists (species ignored), most first."""
+    observer = db.checklists.observer_id.sqlsafe
+    return fetched(db.executesql(build_sql(
+        db, filters, [observer, "COUNT(*)"],
+        groupby=observer, orderby=f"COUNT(*) DESC, {observer}", sightings=False,
+    )))
+
+
+def date_totals(db, filters):
+    """Returns [(date, total count)] of the matching sightings, by date."""
+    date = db.checklists.observation_date.sqlsafe
+    rows = fetched(db.executesql(build_sql(
+        db, filters, [date, f"SUM({db.sightings.observation_count.sqlsafe})"],
+        groupby=date, orderby=date,
+    )))
+    # dates come back as text from plain SQL on some drivers
+    return [
+        (datetime.date.fromisoformat(day) if isinstance(day, str) else day, total or 0)
+        for day, total in rows if day
+    ]
+
+
+def density_cells(db, filters, zoom):
+    """
+    Returns the [lat, lng, total] of the density cells of the matching sightings at
+    the grid level of the map zoom, like density_grid.query_cells but computed
+    from the sightings (for the filters the grid does not cover).
+    """
+    checklists, table = db.checklists, db.sightings
+    rows = fetched(db.executesql(build_sql(db, filters, [
+        checklists.latitude.sqlsafe, checklists.longitude.sqlsafe,
+        "COUNT(*)", f"SUM({table.observation_count.sqlsafe})",
+    ], groupby=checklists.id.sqlsafe)))
+    level = grid_zoom(zoom)
+    cells = {}
+    for lat, lng, points, total in rows:
+        if lat is None or lng is None:
+            continue
+        cell = cells.setdefault(tile_xy(lat, lng, level), [0, 0, 0.0, 0.0])
+        cell[0] += points
+        cell[1] += total or 0
+        cell[2] += lat * points
+        cell[3] += lng * points
+    return [[lat_sum / points, lng_sum / points, total] for points, total, lat_sum, lng_sum in cells.values()]
@@ -0,0 +1,78 @@
+"""
+This file prepares the app for the pre-fork launch mode (see gunicorn.conf.py).
+
+The master process imports the app once, then warm() loads the in-memory state
+every worker needs (species lookup tables, recent weights, the snapshot arrays),
+closes its database connections and freezes the garbage collector, so that the
+forked workers share these pages copy-on-write instead of rebuilding them.
+after_fork() runs in every new worker: it drops the connections inherited from
+the master, so each worker opens its own, reseeds the random generator and marks
+failed the jobs left behind by the worker it replaces.
+api/ready tells a load balancer whether a worker can serve requests.
+"""
+import gc
+import os
+import random
+
+from pydal.connection import ConnectionPool
+
+from .common import db, logger
+from . import tasks
+from .caching import data_version
+from .random_species import species_sampler
+from .snapshot import snapshot
+from .typeahead import species_index
+
+
+def release_connections(db):
+    # Closes the connection of this thread and the pooled ones of the database
+    db._adapter.close("commit")
+    for connection in ConnectionPool.POOLS.pop(db._adapter.uri, []):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+def warm():
+    """Loads the shared in-memory state in the master process, before the workers are forked."""
+    data_version.get()
+    species_index.refresh()
+    species_sampler.refresh()
+    if snapshot:
+        snapshot.parts()
+    release_connections(db)
+    # objects allocated so far are never collected, so the collector does not
+    # write to (and un-share) their pages in the workers
+    gc.collect()
+    gc.freeze()
+    logger.info("app warmed up in process %s", os.getpid())
+
+
+def after_fork():
+    """Runs in every worker right after the fork."""
+    # Connections and sockets cannot be shared between processes: forget the
+    # master's pool (closed in warm) so that this worker opens its own
+    ConnectionPool.POOLS.clear()
+    # the workers would otherwise all draw the same random species
+    random.seed()
+    # the jobs left queued or running by a worker this one replaces would block
+    # identical jobs until JOB_TIMEOUT (see tasks.py)
+    db.get_connection_from_pool_or_new()
+    try:
+        tasks.fail_orphaned_jobs()
+    finally:
+        db.recycle_connection_in_pool_or_close("commit")
+
+
+def readiness():
+    """
+    Returns (ready, details) for api/ready: the database answers and the lookup
+    tables are loaded (they already are in the workers of the pre-fork mode).
+    """
+    try:
+        db.executesql("SELECT 1;")
+        species_index.refresh()
+    except Exception as e:
+        return False, dict(status="unavailable", error=str(e), pid=os.getpid())
+    return True, dict(status="ready", pid=os.getpid(), data_version=data_version.get())
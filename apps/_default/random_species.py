@@ -0,0 +1,103 @@
+"""
+This file picks random species for the index page (get_random_bird).
+
+Uniform picks come from the in-memory species list of the typeahead index, so
+a pick is a random index into a tuple instead of a query.  Weighted picks ("bird
+of the day") favour the species sighted most over the last RECENT_DAYS days of
+data, read from the all-observers rows of the trend rollup (see trends.py);
+the cumulative weights are kept in memory and reloaded when species are added
+(like the species list, see caching.py) or once WEIGHTS_MAX_AGE old: the saves
+in between shift the recent counts too little to reload them every time.
+"""
+import bisect
+import datetime
+import itertools
+import random
+import threading
+import time
+
+from .common import db
+from .caching import species_version
+from .instrumentation import fetched
+from .trends import ALL_OBSERVERS
+from .typeahead import species_index
+
+# Days of data, up to the latest observation, counted by the weighted picks
+RECENT_DAYS = 30
+MAX_SAMPLE = 50
+# Seconds after which the weights are read again
+WEIGHTS_MAX_AGE = 3600
+
+
+class SpeciesSampler:
+
+    def __init__(self, db, version, max_age=WEIGHTS_MAX_AGE):
+        self.db = db
+        self.version = version
+        self.max_age = max_age
+        self.loaded_version = None
+        self.loaded_on = 0
+        # (species names, cumulative recent sightings), in the same order
+        self.weights = ((), ())
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Reloads the recent sightings per species if species were added or they are too old."""
+
+        def fresh():
+            return version == self.loaded_version and time.time() - self.loaded_on < self.max_age
+
+        version = self.version.get()
+        if fresh():
+            return
+        with self.lock:
+            if fresh():
+                return
+            table = self.db.daily_trends
+            all_observers = table.observer_id == ALL_OBSERVERS
+            latest = fetched(self.db(all_observers).select(table.observation_date.max())).first()
+            latest = latest[table.observation_date.max()]
+            rows = []
+            if latest:
+                sightings = table.sightings.sum()
+                since = latest - datetime.timedelta(days=RECENT_DAYS - 1)
+                rows = fetched(self.db.executesql(self.db(
+                    all_observers & (table.observation_date >= since)
+                )._select(table.species_id, sightings, groupby=table.species_id)))
+            names = dict(species_index.data[0])
+            rows = [(names[species_id], count) for species_id, count in rows if species_id in names and count]
+            self.weights = (
+                tuple(name for name, _ in rows),
+                tuple(itertools.accumulate(count for _, count in rows)),
+            )
+            self.loaded_version, self.loaded_on = version, time.time()
+
+    def sample(self, n=1, weighted=False):
+        """Returns up to n distinct random species names, weighted by recent sightings if asked."""
+        species_index.refresh()
+        self.refresh()
+        names, cumulative = self.weights
+        if not weighted or not names:
+            species = species_index.data[0]
+            return [name for _, name in random.sample(species, min(n, len(species)))]
+        picked = []
+        # draws with replacement until n distinct species, at most a few times n draws
+        for _ in range(4 * n):
+            position = bisect.bisect(cumulative, random.random() * cumulative[-1])
+            name = names[min(position, len(names) - 1)]
+            if name not in picked:
+                picked.append(name)
+                if len(picked) == min(n, len(names)):
+                    break
+        return picked
+
+
+species_sampler = SpeciesSampler(db, species_version)
+
+
+def parse_sample_size(value):
+    # Number of species asked for, between 1 and MAX_SAMPLE
+    try:
+        return max(1, min(int(value), MAX_SAMPLE))
+    except (TypeError, ValueError):
+        return 1
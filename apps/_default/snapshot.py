@@ -0,0 +1,367 @@
+"""
+This file maintains the columnar snapshot of the checklists and sightings used by
+the analytics (region_stats, and the density grid rebuild).
+
+The snapshot is a set of NumPy arrays saved as .npy files and memory-mapped, so
+every worker process shares the same pages instead of holding rows on its heap:
+
+- checklists: id, lat, lng, date (datetime64[D]) and observer (index in observers),
+  ordered by id
+- sightings: checklist (index in the checklist arrays), species (id) and count
+
+A base snapshot is built from the database after every load (see load_data.py)
+and never modified.  Checklists saved through the app afterwards are appended as
+small delta segments, one per save, whose checklists hide their older version in
+the base and in the earlier segments.  Past MAX_DELTA_SEGMENTS the segments are
+compacted into one, and once the delta holds more than REBUILD_DELTA_FRACTION of
+the base the rebuild_snapshot job folds it into a new base (see tasks.py), so
+neither the saves nor the readers slow down as saves accumulate.  Queries run on
+every part with vectorized masks and bincount and add up the results.
+
+The files replaced by a write are removed by the next one: a reader that has just
+read the manifest can still load them.  A reader slower than two writes retries
+with the new manifest (see Snapshot.parts).
+
+It needs NumPy (pip install numpy) and is enabled in settings.py:
+
+    USE_SNAPSHOT = True
+"""
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+
+from . import settings
+from .density_grid import ALL_SPECIES, GRID_ZOOMS, MAX_LATITUDE
+
+if settings.USE_SNAPSHOT:
+    import numpy as np
+
+# Rows fetched from the cursor at a time while building the arrays
+FETCH_ROWS = 100000
+
+# Delta segments compacted into one past this number
+MAX_DELTA_SEGMENTS = 16
+# The base is rebuilt once the delta has more checklists than this share of it
+# (and than REBUILD_DELTA_CHECKLISTS)
+REBUILD_DELTA_FRACTION = 0.05
+REBUILD_DELTA_CHECKLISTS = 1000
+# Times a reader loads the latest manifest when its files are removed meanwhile
+LOAD_ATTEMPTS = 3
+
+CHECKLIST_COLUMNS = ("checklist_id", "lat", "lng", "date", "observer")
+SIGHTING_COLUMNS = ("sighting_checklist", "sighting_species", "sighting_count")
+
+
+def tile_xy(lat, lng, zoom):
+    # density_grid.tile_xy for arrays of points
+    n = 1 << zoom
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = ((lng + 180.0) / 360.0 * n).astype("int64")
+    y = ((1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * n).astype("int64")
+    return np.clip(x, 0, n - 1), np.clip(y, 0, n - 1)
+
+
+class Part:
+    """
+    The arrays of the base or of a delta segment; hidden masks the checklists
+    replaced by a later segment.
+    """
+
+    def __init__(self, arrays):
+        self.__dict__.update(arrays)
+        self.hidden = None
+
+    def hide(self, checklist_ids):
+        # Masks the checklists of checklist_ids; the ids of a part are sorted, so
+        # they are found by binary search instead of a scan of the whole part
+        positions = np.searchsorted(self.checklist_id, checklist_ids)
+        positions = positions[positions < len(self.checklist_id)]
+        positions = positions[np.isin(self.checklist_id[positions], checklist_ids)]
+        if not len(positions):
+            return
+        if self.hidden is None:
+            self.hidden = np.zeros(len(self.checklist_id), dtype=bool)
+        self.hidden[positions] = True
+
+    def visible(self, mask):
+        return mask if self.hidden is None else mask & ~self.hidden
+
+
+def fetch_columns(db, sql, dtypes):
+    # Runs sql and returns its columns as arrays of dtypes, without building Row objects
+    db._adapter.execute(sql)
+    cursor = db._adapter.cursor
+    parts = [[] for _ in dtypes]
+    while True:
+        rows = cursor.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        for part, values, dtype in zip(parts, zip(*rows), dtypes):
+            part.append(np.array(values, dtype=dtype))
+    return [
+        np.concatenate(part) if part else np.empty(0, dtype=dtype)
+        for part, dtype in zip(parts, dtypes)
+    ]
+
+
+def read_arrays(db, checklist_ids=None):
+    """Reads the arrays of all the checklists, or of the given checklist ids."""
+    checklists, sightings = db.checklists, db.sightings
+    query = checklists.id > 0 if checklist_ids is None else checklists.id.belongs(checklist_ids)
+    ids, lat, lng, date, observers = fetch_columns(db, db(query)._select(
+        checklists.id, checklists.latitude, checklists.longitude,
+        checklists.observation_date, checklists.observer_id, orderby=checklists.id,
+    ), ["int64", "float64", "float64", "datetime64[D]", "object"])
+    # observers are stored as indexes in a list of their names
+    names, codes = np.unique(observers.astype(str), return_inverse=True)
+    query = sightings.id > 0
+    if checklist_ids is not None:
+        query = sightings.sampling_event_id.belongs(checklist_ids)
+    checklist, species, count = fetch_columns(db, db(query)._select(
+        sightings.sampling_event_id, sightings.common_name,
+        sightings.observation_count.coalesce(0),
+    ), ["int64", "int32", "int32"])
+    # the sightings of checklists saved between the two queries are left to the
+    # delta segment of their save (see Snapshot.rebuild)
+    positions = np.searchsorted(ids, checklist)
+    known = positions < len(ids)
+    known[known] = ids[positions[known]] == checklist[known]
+    return dict(
+        checklist_id=ids, lat=lat, lng=lng, date=date,
+        observer=codes.astype("int32"), observers=names,
+        sighting_checklist=positions[known].astype("int32"),
+        sighting_species=species[known], sighting_count=count[known],
+    )
+
+
+def manifest_files(manifest):
+    # Base folder and delta segments of a manifest
+    return [manifest["base"], *manifest["deltas"]] if manifest else []
+
+
+class Snapshot:
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifest_path = os.path.join(folder, "snapshot.json")
+        self.loaded = None  # (manifest mtime, [base Part, delta Parts...])
+        self.lock = threading.Lock()
+
+    # #######################################################
+    # Writing (load-data, save_checklist)
+    # #######################################################
+    def file_lock(self):
+        # Serializes the writers of all the processes
+        os.makedirs(self.folder, exist_ok=True)
+        lock = open(os.path.join(self.folder, ".lock"), "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if "delta" in manifest:
+            # written before the delta was split in segments
+            delta = manifest.pop("delta")
+            manifest["deltas"] = [delta] if delta else []
+        return manifest
+
+    def write_manifest(self, manifest):
+        # written aside and renamed, so readers never see a partial file
+        path = self.manifest_path + ".tmp"
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(path, self.manifest_path)
+
+    def remove_unused(self, manifest):
+        # Older generations, but the files of the manifest just replaced, which
+        # readers may be loading; processes still mapping them keep them until they reload
+        used = {*manifest_files(manifest), *manifest.get("previous", [])}
+        for name in os.listdir(self.folder):
+            if name.startswith(("base-", "delta-")) and name not in used:
+                path = os.path.join(self.folder, name)
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+    def write_delta(self, arrays):
+        name = f"delta-{time.time_ns()}.npz"
+        np.savez(os.path.join(self.folder, name), **arrays)
+        return name
+
+    def rebuild(self, db):
+        """Builds a new base snapshot of the whole database; returns its number of sightings."""
+        started = time.time_ns()
+        arrays = read_arrays(db)
+        with self.file_lock():
+            name = f"base-{time.time_ns()}"
+            os.makedirs(os.path.join(self.folder, name))
+            for key, array in arrays.items():
+                np.save(os.path.join(self.folder, name, key + ".npy"), array)
+            # segments written while the database was read may hold saves the
+            # new base missed; they are kept, and only hide the same checklists
+            previous = self.read_manifest()
+            deltas = [
+                delta for delta in (previous or {}).get("deltas", [])
+                if int(delta[len("delta-"):-len(".npz")]) >= started
+            ]
+            checklists = 0
+            for delta in deltas:
+                with np.load(os.path.join(self.folder, delta)) as delta_arrays:
+                    checklists += len(delta_arrays["checklist_id"])
+            manifest = dict(
+                base=name, base_checklists=len(arrays["checklist_id"]),
+                deltas=deltas, delta_checklists=checklists,
+                previous=manifest_files(previous),
+            )
+            self.write_manifest(manifest)
+            self.remove_unused(manifest)
+        return len(arrays["sighting_species"])
+
+    def update_checklists(self, db, checklist_ids):
+        """
+        Appends the given checklists to the delta, after they were saved.  Returns
+        True when the delta has grown enough for the base to be rebuilt.
+        """
+        with self.file_lock():
+            manifest = self.read_manifest()
+            if not manifest:
+                return False
+            previous = manifest_files(manifest)
+            deltas = manifest["deltas"] + [self.write_delta(read_arrays(db, sorted(set(checklist_ids))))]
+            checklists = manifest.get("delta_checklists", 0) + len(set(checklist_ids))
+            if len(deltas) > MAX_DELTA_SEGMENTS:
+                # one segment with the latest version of every checklist of the delta
+                ids = set()
+                for delta in deltas:
+                    with np.load(os.path.join(self.folder, delta)) as arrays:
+                        ids.update(arrays["checklist_id"].tolist())
+                deltas, checklists = [self.write_delta(read_arrays(db, sorted(ids)))], len(ids)
+            manifest.update(deltas=deltas, delta_checklists=checklists, previous=previous)
+            self.write_manifest(manifest)
+            self.remove_unused(manifest)
+        base_checklists = manifest.get("base_checklists", 0)
+        return checklists > max(REBUILD_DELTA_CHECKLISTS, REBUILD_DELTA_FRACTION * base_checklists)
+
+    # #######################################################
+    # Reading
+    # #######################################################
+    def parts(self):
+        """Returns the [base, delta segments...] parts, reloaded if the snapshot changed, or None."""
+        for attempt in range(LOAD_ATTEMPTS):
+            try:
+                mtime = os.stat(self.manifest_path).st_mtime_ns
+            except FileNotFoundError:
+                return None
+            loaded = self.loaded
+            if loaded is not None and loaded[0] == mtime:
+                return loaded[1]
+            try:
+                with self.lock:
+                    parts = self.load(self.read_manifest())
+            except FileNotFoundError:
+                # removed by a writer two manifests later, which the next attempt reads
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+                continue
+            self.loaded = (mtime, parts)
+            return parts
+
+    def load(self, manifest):
+        # Maps the base and loads the delta segments of manifest
+        base_folder = os.path.join(self.folder, manifest["base"])
+        base = Part({
+            key: np.load(os.path.join(base_folder, key + ".npy"), mmap_mode="r")
+            for key in CHECKLIST_COLUMNS + SIGHTING_COLUMNS + ("observers",)
+        })
+        parts = [base]
+        for name in manifest["deltas"]:
+            with np.load(os.path.join(self.folder, name)) as arrays:
+                delta = Part({key: arrays[key] for key in arrays.files})
+            # the latest version of a checklist hides the earlier ones
+            for part in parts:
+                part.hide(delta.checklist_id)
+            parts.append(delta)
+        return parts
+
+    def region_stats(self, north, south, east, west, date_from=None, date_to=None):
+        """
+        Returns ({species id: [total count, checklists]}, {observer: checklists}) for
+        the checklists within the bounds and dates, like the SQL of api/region_stats.
+        """
+        species_stats, contributors = {}, {}
+        for part in self.parts():
+            in_region = (
+                (part.lat >= south) & (part.lat <= north) & (part.lng >= west) & (part.lng <= east)
+            )
+            if date_from:
+                in_region &= part.date >= np.datetime64(date_from)
+            if date_to:
+                in_region &= part.date <= np.datetime64(date_to)
+            in_region = part.visible(in_region)
+            observers = np.bincount(part.observer[in_region], minlength=len(part.observers))
+            for code in np.flatnonzero(observers):
+                name = str(part.observers[code])
+                contributors[name] = contributors.get(name, 0) + int(observers[code])
+            selected = in_region[part.sighting_checklist]
+            species = part.sighting_species[selected]
+            if not len(species):
+                continue
+            totals = np.bincount(species, weights=part.sighting_count[selected])
+            # distinct (species, checklist) pairs, counted per species
+            pairs = np.unique(
+                species.astype("int64") * len(part.checklist_id) + part.sighting_checklist[selected]
+            )
+            checklists = np.bincount(pairs // len(part.checklist_id), minlength=len(totals))
+            for species_id in np.flatnonzero(checklists):
+                stats = species_stats.setdefault(int(species_id), [0, 0])
+                stats[0] += int(totals[species_id])
+                stats[1] += int(checklists[species_id])
+        return species_stats, contributors
+
+    def density_cells(self):
+        """
+        Returns the cells of the density grid, {(zoom, layer, x, y): [points, total,
+        lat_sum, lng_sum]} as built by density_grid.accumulate, for all the sightings.
+        """
+        cells = {}
+        for part in self.parts():
+            located = part.visible(~np.isnan(part.lat) & ~np.isnan(part.lng))
+            selected = located[part.sighting_checklist]
+            checklist = part.sighting_checklist[selected]
+            lat, lng = part.lat[checklist], part.lng[checklist]
+            species = part.sighting_species[selected].astype("int64")
+            count = part.sighting_count[selected]
+            for zoom in GRID_ZOOMS:
+                x, y = tile_xy(lat, lng, zoom)
+                tile = (x << zoom) + y
+                # one key per (layer, x, y): the all-species layer, then the species ones
+                for key in (tile, (species << (2 * zoom)) + tile):
+                    keys, inverse = np.unique(key, return_inverse=True)
+                    values = zip(
+                        keys.tolist(),
+                        np.bincount(inverse).tolist(),
+                        np.bincount(inverse, weights=count).tolist(),
+                        np.bincount(inverse, weights=lat).tolist(),
+                        np.bincount(inverse, weights=lng).tolist(),
+                    )
+                    for value, points, total, lat_sum, lng_sum in values:
+                        layer, value = divmod(value, 1 << (2 * zoom))
+                        x_value, y_value = divmod(value, 1 << zoom)
+                        cell = cells.get((zoom, layer or ALL_SPECIES, x_value, y_value))
+                        if cell is None:
+                            cell = cells[(zoom, layer or ALL_SPECIES, x_value, y_value)] = [0, 0, 0.0, 0.0]
+                        cell[0] += points
+                        cell[1] += int(total)
+                        cell[2] += lat_sum
+                        cell[3] += lng_sum
+        return cells
+
+
+snapshot = (
+    Snapshot(os.path.join(settings.DB_FOLDER, "snapshot")) if settings.USE_SNAPSHOT else None
+)
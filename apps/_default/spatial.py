@@ -0,0 +1,78 @@
+"""
+This file provides the spatial access path for bounding-box queries on checklists.
+
+On SQLite, the checklists_rtree R*Tree virtual table indexes the position of every
+checklist and is kept in sync with the checklists table by triggers, so rows written
+by the CSV loader, the actions, or by hand are all indexed.  On other databases
+checklists are found through a B-tree index on (latitude, longitude), see models.py.
+"""
+from .common import Field
+
+RTREE_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS checklists_rtree_insert AFTER INSERT ON checklists
+    WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL
+    BEGIN
+        INSERT OR REPLACE INTO checklists_rtree
+        VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS checklists_rtree_update AFTER UPDATE OF latitude, longitude ON checklists
+    BEGIN
+        DELETE FROM checklists_rtree WHERE id = old.id;
+        INSERT INTO checklists_rtree
+        SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude
+        WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS checklists_rtree_delete AFTER DELETE ON checklists
+    BEGIN
+        DELETE FROM checklists_rtree WHERE id = old.id;
+    END;""",
+]
+
+
+def define_rtree(db):
+    """Creates (SQLite only) the R*Tree over checklist positions and its sync triggers."""
+    exists = db.executesql(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='checklists_rtree';"
+    )
+    if not exists:
+        db.executesql(
+            "CREATE VIRTUAL TABLE checklists_rtree USING rtree(id, min_lat, max_lat, min_lng, max_lng);"
+        )
+        # index the checklists that are already there
+        db.executesql(
+            "INSERT INTO checklists_rtree SELECT id, latitude, latitude, longitude, longitude "
+            "FROM checklists WHERE latitude IS NOT NULL AND longitude IS NOT NULL;"
+        )
+    for trigger in RTREE_TRIGGERS:
+        db.executesql(trigger)
+    # The virtual table is managed above, pydal only needs to know how to query it
+    db.define_table(
+        "checklists_rtree",
+        Field("min_lat", "double"),
+        Field("max_lat", "double"),
+        Field("min_lng", "double"),
+        Field("max_lng", "double"),
+        migrate=False,
+    )
+
+
+def in_bbox(db, north, south, east, west):
+    """Returns a query selecting the checklists inside the bounding box."""
+    query = (
+        (db.checklists.latitude <= north) &
+        (db.checklists.latitude >= south) &
+        (db.checklists.longitude <= east) &
+        (db.checklists.longitude >= west)
+    )
+    if "checklists_rtree" in db.tables:
+        # The R*Tree finds the candidates; it stores 32-bit floats rounded outwards,
+        # so the exact predicates above are kept to filter the few extra ones.
+        rtree = db.checklists_rtree
+        query &= (
+            (rtree.id == db.checklists.id) &
+            (rtree.min_lat <= north) &
+            (rtree.max_lat >= south) &
+            (rtree.min_lng <= east) &
+            (rtree.max_lng >= west)
+        )
+    return query
@@ -5,7 +5,7 @@ const app = Vue.createApp({
     return {
       map: null, // Leaflet map instance
       drawingLayer: null, // Layer group for user-drawn shapes
-      heatLayer: null, // Heatmap layer instance
+      heatLayer: null, // Heatmap tile layer instance
       selectedSpecies: '', // User's selected species
       speciesSuggestions: [], // Suggestions for species
       loadingHeatmap: false, // Show loading indicator while heatmap is being updated
@@ -104,20 +104,23 @@ const app = Vue.createApp({
       }
     },
 
-    updateHeatmap(data) {
-      // Remove the existing heatmap layer, if it exists
+    heatmapUrl() {
+      // Heatmap tiles are rendered by the server from the density grid
+      const species = this.selectedSpecies
+        ? `?species=${encodeURIComponent(this.selectedSpecies)}`
+        : '';
+      return `/api/heat/{z}/{x}/{y}.png${species}`;
+    },
+
+    updateHeatmap() {
+      // The tile layer loads the tiles in view; changing its URL reloads them
       if (this.heatLayer) {
-        this.map.removeLayer(this.heatLayer);
+        this.heatLayer.setUrl(this.heatmapUrl());
+        return;
       }
-
-      // Format density data for the Leaflet heatmap plugin
-      const heatData = data.map((point) => [point.lat, point.lng, point.density]);
-
-      // Add a new heatmap layer with the provided data
-      this.heatLayer = L.heatLayer(heatData, {
-        radius: 25,
-        blur: 15,
-        maxZoom: 17,
+      this.heatLayer = L.tileLayer(this.heatmapUrl(), {
+        maxZoom: 19,
+        opacity: 0.9,
       }).addTo(this.map);
     },
 
@@ -139,32 +142,6 @@ const app = Vue.createApp({
         });
     },
 
-    fetchDensity() {
-      // Build the API query for fetching density data based on the selected species
-      const speciesQuery = this.selectedSpecies
-        ? `?species=${encodeURIComponent(this.selectedSpecies)}`
-        : '';
-
-      axios
-        .get(`/api/density${speciesQuery}`)
-        .then((response) => {
-          // Check if density data exists
-          if (response.data.density && response.data.density.length > 0) {
-            this.updateHeatmap(response.data.density); // Update the heatmap with fetched data
-          } else {
-            // Notify the user if no data is available
-            alert(
-              this.selectedSpecies
-                ? `No density data available for species: ${this.selectedSpecies}.`
-                : 'No density data available for all species.'
-            );
-          }
-        })
-        .catch((error) => {
-          console.error('Error fetching density data:', error); // Log errors in the console
-        });
-    },
-
     fetchSpecies() {
       // Clear suggestions if the search box is empty
       if (this.selectedSpecies.trim() === "") {
@@ -188,14 +165,14 @@ const app = Vue.createApp({
 
     clearSelection() {
       this.selectedSpecies = ''; // Clear the selected species
-      this.fetchDensity(); // Reload heatmap for all species
+      this.updateHeatmap(); // Reload heatmap for all species
     },
 
     selectSpecies(speciesName) {
       // Update the selected species and clear suggestions
       this.selectedSpecies = speciesName;
       this.speciesSuggestions = [];
-      this.fetchDensity(); // Update the heatmap for the selected species
+      this.updateHeatmap(); // Update the heatmap for the selected species
     },
 
     showRegionStats() {
@@ -295,7 +272,7 @@ const app = Vue.createApp({
     this.fetchRandomBird(); // Fetch a random bird on page load
     this.initMap();
     this.centerMapOnUser();
-    this.fetchDensity(); // Load heatmap for all species by default
+    this.updateHeatmap(); // Load heatmap for all species by default
   },
 });
 
@@ -17,12 +17,14 @@ const app = Vue.createApp({
       }
 
       this.isLoading = true; // Set loading state
-      axios.post('/api/region_stats', region)
+      // Species come back aggregated by the server, most sighted first
+      axios.post('/api/region_stats', { ...region, order: 'sightings' })
         .then(response => {
-          this.speciesStats = Object.entries(response.data.species_stats).map(([name, stats]) => ({
+          const stats = response.data.species_stats;
+          this.speciesStats = response.data.species_order.map(name => ({
             name,
-            sightings: stats.sightings,
-            checklists: stats.checklists,
+            sightings: stats[name].sightings,
+            checklists: stats[name].checklists,
           }));
           this.topContributors = response.data.top_contributors;
 
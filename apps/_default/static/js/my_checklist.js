@@ -0,0 +1,56 @@
+"use strict";
+
+// Loads the next pages of "My Checklists" from api/my_checklist and appends
+// them to the table, instead of reloading the whole page.
+(function () {
+  const button = document.getElementById("load-more");
+  const tbody = document.getElementById("checklist-items");
+  if (!button || !tbody) {
+    return; // Single page of results
+  }
+
+  const cell = (text) => {
+    const td = document.createElement("td");
+    td.textContent = text;
+    return td;
+  };
+
+  const actionsCell = () => {
+    const td = document.createElement("td");
+    td.innerHTML =
+      '<button class="button is-warning is-small">Edit</button> ' +
+      '<button class="button is-danger is-small">Delete</button>';
+    return td;
+  };
+
+  button.addEventListener("click", (event) => {
+    event.preventDefault();
+    button.classList.add("is-loading");
+    // The link carries the filters and the cursor of the next page
+    const params = new URL(button.href).searchParams;
+    fetch(`${my_checklist_api_url}?${params}`)
+      .then((response) => response.json())
+      .then((data) => {
+        data.items.forEach((item) => {
+          const tr = document.createElement("tr");
+          tr.appendChild(cell(item.observation_date));
+          tr.appendChild(cell(item.common_name));
+          tr.appendChild(cell(item.user_observation_count));
+          tr.appendChild(actionsCell());
+          tbody.appendChild(tr);
+        });
+        if (data.next_cursor) {
+          params.set("cursor", data.next_cursor);
+          button.href = `${button.pathname}?${params}`;
+        } else {
+          button.remove(); // Last page
+        }
+      })
+      .catch((error) => {
+        console.error("Error loading more checklists:", error);
+      })
+      .finally(() => {
+        button.classList.remove("is-loading");
+      });
+  });
+})();
@@ -8,6 +8,8 @@ const app = Vue.createApp({
       selectedSpecies: "", // Currently selected species for trends
       speciesSuggestions: [], // Species suggestions based on search query
       trends: [], // Bird-watching trends over time
+      mine: false, // Only the sightings of the logged in user
+      bucket: "day", // Trends summed by day, week or month
     };
   },
   methods: {
@@ -40,8 +42,12 @@ const app = Vue.createApp({
         return;
       }
 
+      const params = { species: this.selectedSpecies, bucket: this.bucket };
+      if (this.mine) {
+        params.mine = 1;
+      }
       axios
-        .get(`/api/user_stats/trends?species=${encodeURIComponent(this.selectedSpecies)}`)
+        .get("/api/user_stats/trends", { params: params })
         .then((response) => {
           this.trends = response.data.trends || [];
           this.renderChart(); // Render the trends chart after data is fetched
@@ -0,0 +1,60 @@
+"""
+This file defines the streaming (NDJSON) responses of the large API results.
+
+Clients that send "Accept: application/x-ndjson" get one JSON object per line
+instead of one JSON document.  The action returns a generator, which py4web
+writes out chunk by chunk after the action has returned: the rows are read from
+the cursor STREAM_CHUNK_ROWS at a time, so memory stays bounded whatever the
+size of the result and the first lines are sent before the query is finished.
+
+By then the DAL fixture has already recycled the request's connection, so the
+generator takes its own from the pool and gives it back when it is exhausted
+(or closed, if the client goes away).
+"""
+import json
+
+from py4web import request, response
+
+NDJSON = "application/x-ndjson"
+# Rows fetched from the cursor, and lines written, at a time
+STREAM_CHUNK_ROWS = 1000
+
+
+def wants_ndjson():
+    # True if the client asked for a streamed response
+    return NDJSON in request.headers.get("Accept", "")
+
+
+def stream_rows(db, sql, size=STREAM_CHUNK_ROWS):
+    """Yields the rows of sql in lists of up to size, from a connection of its own."""
+    db.get_connection_from_pool_or_new()
+    try:
+        cursor = db._adapter.connection.cursor()
+        try:
+            cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+    finally:
+        # the stream only reads, there is nothing to commit
+        db.recycle_connection_in_pool_or_close("rollback")
+
+
+def ndjson(chunks):
+    """
+    Returns the streamed response of chunks, an iterable of lists of JSON
+    serializable objects, writing every list as one block of lines.
+    """
+    response.headers["Content-Type"] = NDJSON
+
+    def lines():
+        for objects in chunks:
+            yield "".join(
+                json.dumps(obj, separators=(",", ":"), default=str) + "\n" for obj in objects
+            ).encode("utf8")
+
+    return lines()
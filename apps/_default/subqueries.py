@@ -0,0 +1,76 @@
+"""
+This file runs the independent SQL sub-queries of an action concurrently.
+
+    results, timed_out = run_concurrently(db, {
+        "species": lambda: db.executesql(species_sql),
+        "contributors": lambda: db.executesql(contributors_sql),
+    })
+
+Every sub-query runs in a thread of a shared pool, on a connection of its own
+taken from the DAL pool, so the latency of the action is that of its slowest
+sub-query rather than their sum.  The sub-queries still running when the
+deadline (settings.SUBQUERY_DEADLINE_MS) expires are interrupted where the
+driver allows it (sqlite3 interrupt(), psycopg2 cancel()) and reported in
+timed_out, so the action can return the other results flagged as partial.
+Their SQL statements are counted in the request stats (see instrumentation.py).
+"""
+import concurrent.futures
+import threading
+
+from . import instrumentation, settings
+
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.SUBQUERY_WORKERS, thread_name_prefix="subquery"
+)
+
+
+class SubQuery:
+    """One sub-query and the connection it runs on, so that it can be interrupted."""
+
+    def __init__(self, db, function, stats):
+        self.db = db
+        self.function = function
+        self.stats = stats
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def run(self):
+        instrumentation.bind_stats(self.stats)
+        self.db.get_connection_from_pool_or_new()
+        try:
+            with self.lock:
+                self.connection = self.db._adapter.connection
+            return self.function()
+        finally:
+            with self.lock:
+                self.connection = None
+            # sub-queries only read, there is nothing to commit
+            self.db.recycle_connection_in_pool_or_close("rollback")
+            instrumentation.bind_stats(None)
+
+    def interrupt(self):
+        # Stops the statement in progress, if the sub-query is still running
+        with self.lock:
+            if self.connection is None:
+                return
+            cancel = getattr(self.connection, "interrupt", None) or getattr(self.connection, "cancel", None)
+            if cancel:
+                cancel()
+
+
+def run_concurrently(db, functions, deadline_ms=None):
+    """
+    Runs the functions ({name: function()}) concurrently, each on its own
+    connection, and returns ({name: result}, [names of those that timed out]).
+    Errors of the sub-queries that finished are raised.
+    """
+    if deadline_ms is None:
+        deadline_ms = settings.SUBQUERY_DEADLINE_MS
+    stats = instrumentation.current_stats()
+    queries = {name: SubQuery(db, function, stats) for name, function in functions.items()}
+    futures = {executor.submit(query.run): name for name, query in queries.items()}
+    done, not_done = concurrent.futures.wait(futures, timeout=deadline_ms / 1000)
+    for future in not_done:
+        queries[futures[future]].interrupt()
+    results = {futures[future]: future.result() for future in done}
+    return results, sorted(futures[future] for future in not_done)
@@ -1,34 +1,265 @@
 """
-To use celery tasks:
-1) pip install -U "celery[redis]" 
-2) In settings.py: 
+This file defines the background jobs: ingesting the CSV uploads, rebuilding the
+derived data (density grid, trend rollup, clusters, snapshot) and
+vacuuming/analyzing the database.
+
+Jobs are submitted with submit(name, **params) and run off the request path.
+Every job is recorded in the jobs table (queued, running, done or failed, with its
+result or error), which the api/admin/jobs endpoint lists.  Jobs are idempotent:
+submitting a job identical to one already queued or running returns that one, and
+running a job again is harmless (load-data skips the files already loaded, the
+rebuilds recompute the tables from scratch).
+
+By default jobs run in a pool of settings.JOB_WORKERS threads of the server
+process, which needs no broker.  Each job records the process running it, so the
+jobs of a server worker that exited (recycled or killed, see gunicorn.conf.py)
+are marked failed instead of blocking identical jobs until JOB_TIMEOUT.
+To run them on Celery workers instead:
+1) pip install -U "celery[redis]"
+2) In settings.py:
    USE_CELERY = True
    CELERY_BROKER = "redis://localhost:6379/0"
 3) Start "redis-server"
-4) Start "celery -A apps.{appname}.tasks beat"
+4) Start "celery -A apps.{appname}.tasks beat" (vacuums the database every night)
 5) Start "celery -A apps.{appname}.tasks worker --loglevel=info" for each worker
-
 """
-from .common import settings, scheduler, db, Field
+import concurrent.futures
+import datetime
+import hashlib
+import inspect
+import json
+import os
+import socket
+import traceback
+
+from .common import settings, db, logger
+from . import clusters, density_grid, heat_tiles, ingest, trends
+from .caching import data_version, grid_version
+from .snapshot import snapshot
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+HOST = socket.gethostname()
+
+
+# #######################################################
+# The jobs
+# #######################################################
+def ingest_uploads(force=False):
+    # Loads the new or changed CSV files of the uploads folder.  load_data is the
+    # command line module: imported here, "python -m" does not find it already
+    # imported (through controllers) and run it twice.
+    from . import load_data
+
+    # Parsed in this process: the job runs in a thread of a server worker, or in
+    # a Celery worker, neither of which can safely fork a pool of parsers
+    summary = ingest.load_all(db, load_data.UPLOADS_FOLDER, force=force, workers=1)
+    result = dict(files=summary)
+    if load_data.needs_rebuild(db, summary):
+        result.update(load_data.rebuild_derived(db))
+    return result
+
+
+def rebuild_density():
+    rows = density_grid.rebuild(db, snapshot.density_cells() if snapshot and snapshot.parts() else None)
+    maxima = heat_tiles.refresh(db)
+    data_version.bump()
+    heat_tiles.prune(grid_version.bump())
+    db.commit()
+    return dict(density_cells=rows, density_maxima=maxima)
+
+
+def rebuild_trends():
+    rows = trends.rebuild(db)
+    data_version.bump()
+    db.commit()
+    return dict(daily_trends=rows)
+
+
+def rebuild_clusters():
+    rows = clusters.rebuild(db)
+    data_version.bump()
+    db.commit()
+    return dict(checklist_clusters=rows)
+
+
+def rebuild_snapshot():
+    # Also folds the checklists saved since the last rebuild into the base
+    if not snapshot:
+        raise ValueError("The snapshot is disabled (settings.USE_SNAPSHOT)")
+    return dict(snapshot_sightings=snapshot.rebuild(db))
+
+
+def vacuum():
+    # Reclaims space and refreshes the planner statistics; VACUUM cannot run
+    # inside a transaction, so the pending one is committed first
+    db.commit()
+    if db._adapter.dbengine == "sqlite":
+        db.executesql("ANALYZE;")
+        db.executesql("VACUUM;")
+    else:
+        connection = db._adapter.connection
+        connection.autocommit = True
+        try:
+            db.executesql("VACUUM ANALYZE;")
+        finally:
+            connection.autocommit = False
+    return {}
+
+
+JOBS = {
+    "ingest_uploads": ingest_uploads,
+    "rebuild_density": rebuild_density,
+    "rebuild_trends": rebuild_trends,
+    "rebuild_clusters": rebuild_clusters,
+    "rebuild_snapshot": rebuild_snapshot,
+    "vacuum": vacuum,
+}
+
+
+# #######################################################
+# Running and submitting jobs
+# #######################################################
+def job_key(name, params):
+    # Identical jobs (same name and parameters) have the same key
+    data = json.dumps([name, params], sort_keys=True)
+    return hashlib.sha256(data.encode("utf8")).hexdigest()
+
 
-# example of task that needs db access
-@scheduler.task
-def my_task():
+def process_owner():
+    # The owner of the jobs queued or run by this process (the pid changes after a fork)
+    return f"{HOST}:{os.getpid()}"
+
+
+def is_orphaned(owner):
+    # True if owner is a process of this host that no longer exists
+    host, _, pid = (owner or "").rpartition(":")
+    if host != HOST or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def fail_orphaned_jobs():
+    """
+    Marks failed the queued or running jobs of the processes of this host that
+    exited, e.g. a recycled server worker; runs when a worker starts (see
+    prefork.py).  Returns their number.
+    """
+    active = db(db.jobs.status.belongs([QUEUED, RUNNING])).select(db.jobs.id, db.jobs.owner)
+    orphaned = [job.id for job in active if is_orphaned(job.owner)]
+    if orphaned:
+        db(db.jobs.id.belongs(orphaned) & db.jobs.status.belongs([QUEUED, RUNNING])).update(
+            status=FAILED, error="The process running the job exited.",
+            finished_on=datetime.datetime.utcnow(),
+        )
+        logger.warning(f"Marked {len(orphaned)} orphaned jobs failed")
+    db.commit()
+    return len(orphaned)
+
+
+def run_job(job_id):
+    """Runs a queued job on a connection of its own and records its outcome."""
+    db.get_connection_from_pool_or_new()
     try:
-        # this task will be executed in its own thread, connect to db
-        db._adapter.reconnect()
-        # do something here
+        # claims the job, unless another worker already did
+        claimed = db((db.jobs.id == job_id) & (db.jobs.status == QUEUED)).update(
+            status=RUNNING, started_on=datetime.datetime.utcnow(), owner=process_owner()
+        )
         db.commit()
-    except:
-        # rollback on failure
-        db.rollback()
-
-
-# run my_task very 10 seconds
-scheduler.conf.beat_schedule = {
-    "my_first_task": {
-        "task": "apps.%s.tasks.my_task" % settings.APP_NAME,
-        "schedule": 10.0,
-        "args": (),
-    },
-}
+        if not claimed:
+            return
+        job = db.jobs(job_id)
+        try:
+            result = JOBS[job.name](**(job.params or {}))
+        except Exception:
+            db.rollback()
+            error = traceback.format_exc()
+            logger.error(f"Job {job.name} ({job_id}) failed: {error}")
+            db(db.jobs.id == job_id).update(
+                status=FAILED, error=error, finished_on=datetime.datetime.utcnow()
+            )
+        else:
+            db(db.jobs.id == job_id).update(
+                status=DONE, result=result, finished_on=datetime.datetime.utcnow()
+            )
+        db.commit()
+    finally:
+        db.recycle_connection_in_pool_or_close("commit")
+
+
+class LocalBackend:
+    """Runs the jobs in a thread pool of this process."""
+
+    def __init__(self, workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="job"
+        )
+
+    def enqueue(self, job_id):
+        self.executor.submit(run_job, job_id)
+
+
+if settings.USE_CELERY:
+    from .common import scheduler
+
+    @scheduler.task
+    def run_job_task(job_id):
+        run_job(job_id)
+
+    @scheduler.task
+    def vacuum_task():
+        submit("vacuum")
+
+    class CeleryBackend:
+        """Runs the jobs on the Celery workers."""
+
+        def enqueue(self, job_id):
+            run_job_task.delay(job_id)
+
+    backend = CeleryBackend()
+
+    # vacuum the database every night
+    scheduler.conf.beat_schedule = {
+        "vacuum": {
+            "task": "apps.%s.tasks.vacuum_task" % settings.APP_NAME,
+            "schedule": 24 * 3600.0,
+            "args": (),
+        },
+    }
+else:
+    backend = LocalBackend(settings.JOB_WORKERS)
+
+
+def submit(name, **params):
+    """
+    Queues the job name with params and returns its id, or the id of the identical
+    job already queued or running.  Commits, so that the job is visible to the workers.
+    """
+    if name not in JOBS:
+        raise ValueError(f"Unknown job {name}")
+    # raises TypeError if the parameters do not match the job
+    inspect.signature(JOBS[name]).bind(**params)
+    key = job_key(name, params)
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.JOB_TIMEOUT)
+    active = db(
+        (db.jobs.job_key == key)
+        & db.jobs.status.belongs([QUEUED, RUNNING])
+        & (db.jobs.created_on > since)
+    ).select(db.jobs.id, db.jobs.owner, orderby=~db.jobs.id, limitby=(0, 1)).first()
+    if active and is_orphaned(active.owner):
+        # its worker exited without finishing it
+        fail_orphaned_jobs()
+    elif active:
+        return active.id
+    # the jobs of the local backend are queued in this process, the Celery ones
+    # get the owner of the worker that claims them
+    owner = None if settings.USE_CELERY else process_owner()
+    job_id = db.jobs.insert(name=name, job_key=key, params=params, owner=owner)
+    db.commit()
+    backend.enqueue(job_id)
+    return job_id
@@ -0,0 +1,107 @@
+"""
+This file maintains the daily_trends rollup used by the trend graphs
+(api/species_graph and api/user_stats/trends).
+
+Each row holds the total observation count of one species on one date, for one
+observer, plus an all-observers row (observer_id ALL_OBSERVERS) for the global graphs.
+The rollup is rebuilt by load-data and updated incrementally when a checklist is
+saved; the graphs read it with an index lookup and bucket it by day, week or month.
+"""
+import datetime
+
+from .density_grid import merge_rows
+from .instrumentation import fetched
+
+ALL_OBSERVERS = ""
+BUCKETS = ("day", "week", "month")
+
+TREND_FIELDS = ["species_id", "observation_date", "observer_id", "sightings", "total"]
+
+
+def rebuild(db):
+    """Recomputes the whole rollup from the sightings table."""
+    db(db.daily_trends).delete()
+    sightings, checklists, trends = db.sightings, db.checklists, db.daily_trends
+    insert = "INSERT INTO %s(%s) " % (
+        trends._rname, ",".join(trends[name]._rname for name in TREND_FIELDS)
+    )
+    join = "FROM %s JOIN %s ON %s = %s WHERE %s IS NOT NULL" % (
+        sightings._rname, checklists._rname,
+        sightings.sampling_event_id.sqlsafe, checklists.id.sqlsafe,
+        checklists.observation_date.sqlsafe,
+    )
+    columns = dict(
+        species=sightings.common_name.sqlsafe,
+        date=checklists.observation_date.sqlsafe,
+        observer=checklists.observer_id.sqlsafe,
+        count=sightings.observation_count.sqlsafe,
+    )
+    # One row per (species, date, observer)...
+    db.executesql(insert + (
+        "SELECT {species}, {date}, {observer}, COUNT(*), SUM({count}) " + join +
+        " GROUP BY {species}, {date}, {observer};"
+    ).format(**columns))
+    # ... and one per (species, date) for all observers
+    db.executesql(insert + (
+        "SELECT {species}, {date}, '', COUNT(*), SUM({count}) " + join +
+        " GROUP BY {species}, {date};"
+    ).format(**columns))
+    db.commit()
+    return db(trends).count()
+
+
+def update(db, observer_id, added=(), removed=()):
+    """
+    Applies sightings added to and removed from checklists of observer_id.
+    Both are lists of (species_id, observation_date, observation_count).
+    Like the density grid, it uses one SELECT, one DELETE and one INSERT (see
+    density_grid.merge_rows).
+    """
+    deltas = {}
+    for sign, sightings in ((-1, removed), (1, added)):
+        for species_id, date, count in sightings:
+            if date is None:
+                continue
+            for observer in (ALL_OBSERVERS, observer_id):
+                delta = deltas.setdefault((species_id, date, observer), [0, 0])
+                delta[0] += sign
+                delta[1] += sign * (count or 0)
+    if not deltas:
+        return
+    table = db.daily_trends
+    query = (
+        table.species_id.belongs({key[0] for key in deltas})
+        & table.observation_date.belongs({key[1] for key in deltas})
+        & table.observer_id.belongs({key[2] for key in deltas})
+    )
+    merge_rows(db, table, TREND_FIELDS[:3], TREND_FIELDS[3:], deltas, query)
+
+
+def bucket_start(date, bucket):
+    # First day of the week (Monday) or month containing date
+    if bucket == "week":
+        return date - datetime.timedelta(days=date.weekday())
+    if bucket == "month":
+        return date.replace(day=1)
+    return date
+
+
+def query(db, species_id, observer_id=ALL_OBSERVERS, date_from=None, date_to=None, bucket="day"):
+    """Returns [{"date", "count"}] for the species, summed by day, week or month."""
+    table = db.daily_trends
+    where = (table.species_id == species_id) & (table.observer_id == observer_id)
+    if date_from:
+        where &= table.observation_date >= date_from
+    if date_to:
+        where &= table.observation_date <= date_to
+    rows = fetched(db(where).select(table.observation_date, table.total, orderby=table.observation_date))
+    return bucket_totals(((row.observation_date, row.total) for row in rows), bucket)
+
+
+def bucket_totals(rows, bucket):
+    """Sums (date, total) rows, ordered by date, into [{"date", "count"}] by day, week or month."""
+    totals = {}
+    for date, total in rows:
+        start = bucket_start(date, bucket)
+        totals[start] = totals.get(start, 0) + total
+    return [{"date": str(date), "count": count} for date, count in totals.items()]
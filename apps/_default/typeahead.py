@@ -0,0 +1,94 @@
+"""
+This file defines the in-memory typeahead index used for species suggestions.
+
+The species names are loaded once per process and reloaded when the species
+version changes, i.e. when load-data adds species (see caching.py), not on every
+save.  Every position where a word starts in a lowercased name
+is kept in a sorted list, so prefix matches on any word are found by bisection;
+substring matches are only looked for when there are not enough prefix matches.
+Results are ranked: exact match, name prefix, word prefix, then substring.
+"""
+import bisect
+import threading
+
+from .common import db
+from .caching import species_version
+from .instrumentation import fetched
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 500
+
+EXACT, NAME_PREFIX, WORD_PREFIX, SUBSTRING = range(4)
+
+
+class SpeciesIndex:
+
+    def __init__(self, db, version):
+        self.db = db
+        self.version = version
+        self.loaded_version = None
+        # (species ids and names, lowercased names, sorted (suffix, position) pairs)
+        self.data = ((), (), ())
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Reloads the species names if species were added since they were loaded."""
+        version = self.version.get()
+        if version == self.loaded_version:
+            return
+        with self.lock:
+            if version == self.loaded_version:
+                return
+            species = tuple(fetched(self.db.executesql(
+                self.db(self.db.species)._select(
+                    self.db.species.id, self.db.species.common_name,
+                    orderby=self.db.species.common_name,
+                )
+            )))
+            lowered = tuple(name.lower() for _, name in species)
+            suffixes = sorted(
+                (name[start:], position)
+                for position, name in enumerate(lowered)
+                for start in range(len(name))
+                if start == 0 or not name[start - 1].isalnum()
+            )
+            self.data = (species, lowered, tuple(suffixes))
+            self.loaded_version = version
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        """Returns up to limit (id, common_name) pairs matching query, best first."""
+        self.refresh()
+        species, lowered, suffixes = self.data
+        query = query.strip().lower()
+        if not query:
+            return list(species[:limit])
+        ranks = {}
+        for i in range(bisect.bisect_left(suffixes, (query,)), len(suffixes)):
+            suffix, position = suffixes[i]
+            if not suffix.startswith(query):
+                break
+            if lowered[position] == query:
+                rank = EXACT
+            elif suffix == lowered[position]:
+                rank = NAME_PREFIX
+            else:
+                rank = WORD_PREFIX
+            ranks[position] = min(rank, ranks.get(position, rank))
+        if len(ranks) < limit:
+            for position, name in enumerate(lowered):
+                if position not in ranks and query in name:
+                    ranks[position] = SUBSTRING
+        # positions follow the alphabetical order, so ties are alphabetical
+        best = sorted(ranks, key=lambda position: (ranks[position], position))[:limit]
+        return [species[position] for position in best]
+
+
+species_index = SpeciesIndex(db, species_version)
+
+
+def parse_limit(value, default=DEFAULT_LIMIT):
+    # Result cap from a query parameter, bounded to MAX_LIMIT
+    try:
+        return max(1, min(int(value), MAX_LIMIT))
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,330 @@
+"""
+This file is the benchmark harness of the app.
+
+For every scale it generates synthetic data (see synthetic.py) into
+benchmarks/data/<scale>x, then starts a worker process on a database of its own
+in that folder.  The worker loads the data with load-data (files already loaded
+are skipped), logs in a benchmark user, and drives the actions in-process through
+py4web's WSGI application: every action gets a few warm-up requests and then
+--requests timed ones with randomized parameters.  It reports the p50/p95/p99
+latencies, throughput and errors of each action, and the peak RSS of the worker.
+
+    python benchmarks/run.py --scales 1 10 --save benchmarks/baseline.json
+    python benchmarks/run.py --scales 1 10 --compare benchmarks/baseline.json
+
+Results are written as JSON (--output); with --compare, the actions whose p95
+latency grew by more than --threshold over the baseline are reported and the
+command exits with status 1.
+"""
+import argparse
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import urllib.parse
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+ROOT_FOLDER = os.path.dirname(BENCHMARKS_FOLDER)
+DATA_FOLDER = os.path.join(BENCHMARKS_FOLDER, "data")
+RESULTS_FILE = os.path.join(BENCHMARKS_FOLDER, "results", "latest.json")
+
+WARMUP_REQUESTS = 5
+BENCH_USER = "bench@example.com"
+BENCH_PASSWORD = "bench-password"
+# Actions in the order they are driven: save_checklist writes (and invalidates
+# the cached responses), so it runs after the read-only actions
+ACTIONS = ["density", "heat_tile", "clusters", "region_stats", "species_graph", "user_stats_trends",
+           "save_checklist", "my_checklist"]
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+class Client:
+    """Calls the py4web WSGI application in-process, keeping the session cookie."""
+
+    def __init__(self, app):
+        self.app = app
+        self.cookie = None
+
+    def call(self, method, path, query=None, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": path,
+            "QUERY_STRING": urllib.parse.urlencode(query or {}),
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "8000",
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "CONTENT_TYPE": "application/json",
+            "CONTENT_LENGTH": str(len(data)),
+            "wsgi.input": io.BytesIO(data),
+            "wsgi.errors": sys.stderr,
+            "wsgi.url_scheme": "http",
+            "wsgi.version": (1, 0),
+            "wsgi.multithread": False,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        if self.cookie:
+            environ["HTTP_COOKIE"] = self.cookie
+        status = {}
+
+        def start_response(value, headers, exc_info=None):
+            status["code"] = int(value.split()[0])
+            for name, header in headers:
+                if name.lower() == "set-cookie":
+                    self.cookie = header.split(";")[0]
+
+        body = b"".join(self.app(environ, start_response))
+        return status["code"], body
+
+
+class Scenario:
+    """Builds randomized requests for the actions from the loaded data."""
+
+    def __init__(self, db, seed):
+        self.rng = random.Random(seed)
+        self.species = [name for name, in db.executesql("SELECT common_name FROM species;")]
+        self.points = db.executesql(
+            "SELECT latitude, longitude FROM checklists WHERE latitude IS NOT NULL "
+            "ORDER BY RANDOM() LIMIT 1000;"
+        )
+
+    def bbox(self):
+        # A box of 0.1 to 5 degrees around a random checklist
+        lat, lng = self.rng.choice(self.points)
+        size = self.rng.uniform(0.05, 2.5)
+        return dict(north=lat + size, south=lat - size, east=lng + size, west=lng - size)
+
+    def request(self, action):
+        rng = self.rng
+        if action == "density":
+            box = self.bbox()
+            query = dict(
+                bbox=f"{box['west']},{box['south']},{box['east']},{box['north']}",
+                zoom=rng.randint(4, 14),
+            )
+            if rng.random() < 0.5:
+                query["species"] = rng.choice(self.species)
+            return "GET", "/api/density", query, None
+        if action == "heat_tile":
+            # The map tile containing a random checklist
+            lat, lng = rng.choice(self.points)
+            zoom = rng.randint(4, 14)
+            n = 1 << zoom
+            x = int((lng + 180.0) / 360.0 * n)
+            y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+            query = dict(species=rng.choice(self.species)) if rng.random() < 0.5 else None
+            return "GET", f"/api/heat/{zoom}/{x}/{y}.png", query, None
+        if action == "clusters":
+            box = self.bbox()
+            query = dict(
+                bbox=f"{box['west']},{box['south']},{box['east']},{box['north']}",
+                zoom=rng.randint(4, 16),
+            )
+            return "GET", "/api/clusters", query, None
+        if action == "region_stats":
+            body = dict(self.bbox(), order=rng.choice(["name", "sightings", "checklists"]))
+            return "POST", "/api/region_stats", None, body
+        if action == "species_graph":
+            return "GET", "/api/species_graph", dict(species=rng.choice(self.species)), None
+        if action == "user_stats_trends":
+            query = dict(species=rng.choice(self.species), bucket=rng.choice(["day", "week", "month"]))
+            if rng.random() < 0.5:
+                query["mine"] = 1
+            return "GET", "/api/user_stats/trends", query, None
+        if action == "save_checklist":
+            species = rng.sample(self.species, min(len(self.species), rng.randint(5, 30)))
+            body = dict(species=[dict(common_name=name, count=rng.randint(1, 20)) for name in species])
+            return "POST", "/save_checklist", None, body
+        if action == "my_checklist":
+            return "GET", "/my_checklist", None, None
+        raise ValueError(f"Unknown action {action}")
+
+
+def failed(status, body):
+    # The JSON actions report some errors as HTTP 200 with an "error" key
+    if status != 200:
+        return True
+    if body[:1] != b"{":
+        return False
+    try:
+        return "error" in json.loads(body)
+    except ValueError:
+        return True
+
+
+def run_worker(args):
+    """Loads the data and drives the actions; prints the results as JSON."""
+    sys.path.insert(0, ROOT_FOLDER)
+    from py4web import core
+
+    started = time.perf_counter()
+    app = core.wsgi(apps_folder=os.path.join(ROOT_FOLDER, "apps"), password_file=None)
+    from apps._default import load_data
+    from apps._default.common import db
+    from apps._default.caching import response_cache
+    from pydal.validators import CRYPT
+
+    if load_data.main(["--folder", args.folder, "--quiet"]):
+        sys.exit(1)
+    load_seconds = time.perf_counter() - started
+    counts = {table: db(db[table]).count() for table in ("species", "checklists", "sightings")}
+
+    if db(db.auth_user.email == BENCH_USER).isempty():
+        db.auth_user.insert(
+            email=BENCH_USER, first_name="Bench", last_name="User",
+            password=str(CRYPT()(BENCH_PASSWORD)[0]),
+        )
+        db.commit()
+    client = Client(app)
+    status, _ = client.call("POST", "/auth/api/login", body=dict(email=BENCH_USER, password=BENCH_PASSWORD))
+    if status != 200:
+        sys.exit(f"Could not log in the benchmark user (HTTP {status})")
+
+    scenario = Scenario(db, args.seed)
+    actions = {}
+    for action in args.actions:
+        for _ in range(WARMUP_REQUESTS):
+            client.call(*scenario.request(action))
+        latencies, errors = [], 0
+        action_started = time.perf_counter()
+        for _ in range(args.requests):
+            request = scenario.request(action)
+            start = time.perf_counter()
+            status, body = client.call(*request)
+            latencies.append(time.perf_counter() - start)
+            errors += failed(status, body)
+        elapsed = time.perf_counter() - action_started
+        latencies.sort()
+        actions[action] = dict(
+            requests=len(latencies),
+            errors=errors,
+            p50_ms=percentile(latencies, 0.50) * 1000,
+            p95_ms=percentile(latencies, 0.95) * 1000,
+            p99_ms=percentile(latencies, 0.99) * 1000,
+            throughput_rps=len(latencies) / elapsed if elapsed else None,
+            peak_rss_mb=peak_rss_mb(),
+        )
+    print(json.dumps(dict(
+        rows=counts,
+        load_seconds=load_seconds,
+        cache=response_cache.stats(),
+        peak_rss_mb=peak_rss_mb(),
+        actions=actions,
+    )))
+
+
+def run_scale(scale, args):
+    # Generates the data of one scale if needed and runs a worker on it
+    from synthetic import generate
+
+    folder = os.path.join(DATA_FOLDER, f"{scale:g}x")
+    if args.regenerate or not os.path.exists(os.path.join(folder, "sightings.csv")):
+        print(f"scale {scale:g}: generating data in {folder}", flush=True)
+        generate(folder, scale, args.seed)
+    db_folder = os.path.join(folder, "db")
+    os.makedirs(db_folder, exist_ok=True)
+    env = dict(os.environ, DB_URI="sqlite://bench.db", DB_FOLDER=db_folder)
+    command = [
+        sys.executable, os.path.abspath(__file__), "--worker", "--folder", folder,
+        "--requests", str(args.requests), "--seed", str(args.seed), "--actions", *args.actions,
+    ]
+    print(f"scale {scale:g}: loading and benchmarking", flush=True)
+    worker = subprocess.run(command, env=env, cwd=ROOT_FOLDER, stdout=subprocess.PIPE, text=True)
+    if worker.returncode:
+        sys.exit(f"scale {scale:g}: the benchmark worker failed")
+    return json.loads(worker.stdout.strip().splitlines()[-1])
+
+
+def print_results(results):
+    for scale, result in results["scales"].items():
+        print(f"\nscale {scale}: {result['rows']}, loaded in {result['load_seconds']:.1f}s, "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB")
+        print(f"  {'action':<20}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'errors':>8}")
+        for action, stats in result["actions"].items():
+            print(f"  {action:<20}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+                  f"{stats['p99_ms']:>10.2f}{stats['throughput_rps']:>10.1f}{stats['errors']:>8}")
+
+
+def compare(results, baseline, threshold):
+    """Prints the p95 changes against baseline; returns the regressions."""
+    regressions = []
+    print(f"\ncompared with the baseline of {baseline['created']} (threshold {threshold:.0%}):")
+    for scale, result in results["scales"].items():
+        for action, stats in result["actions"].items():
+            base = baseline["scales"].get(scale, {}).get("actions", {}).get(action)
+            if not base:
+                continue
+            change = stats["p95_ms"] / base["p95_ms"] - 1 if base["p95_ms"] else 0
+            regressed = change > threshold
+            if regressed:
+                regressions.append((scale, action))
+            print(f"  {scale:>5} {action:<20} p95 {base['p95_ms']:>9.2f} -> {stats['p95_ms']:>9.2f} ms "
+                  f"({change:+.0%}){'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app's actions on synthetic data.")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100],
+                        help="data sizes relative to the bundled data")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per action")
+    parser.add_argument("--actions", nargs="+", default=ACTIONS, choices=ACTIONS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--regenerate", action="store_true", help="regenerate the synthetic data")
+    parser.add_argument("--output", default=RESULTS_FILE, help="where to write the results")
+    parser.add_argument("--save", metavar="BASELINE", help="also save the results as a baseline")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare the results with a baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="p95 increase reported as a regression (0.2 = 20%%)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--folder", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        return run_worker(args)
+
+    sys.path.insert(0, BENCHMARKS_FOLDER)
+    results = dict(
+        created=datetime.datetime.now().isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        requests=args.requests,
+        seed=args.seed,
+        scales={f"{scale:g}x": run_scale(scale, args) for scale in args.scales},
+    )
+    print_results(results)
+    for path in filter(None, [args.output, args.save]):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nresults written to {path}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+This file generates synthetic eBird-like CSV exports for the benchmarks.
+
+The files have the layout load-data expects (species.csv, checklists.csv and
+sightings.csv, see apps/_default/ingest.py).  Scale 1 is about the size of the
+bundled data (8.5k checklists, 110k sightings); other scales multiply the number
+of checklists and observers, and the number of species by the square root of the
+scale (up to MAX_SPECIES).  Checklists are clustered around birding hotspots,
+observers and species follow skewed (Zipf-like) frequencies, and the output only
+depends on the scale and the seed.
+
+    python benchmarks/synthetic.py --scale 10 --folder benchmarks/data/10x
+"""
+import argparse
+import csv
+import datetime
+import itertools
+import os
+import random
+
+BUNDLED_SPECIES = os.path.join(
+    os.path.dirname(__file__), "..", "apps", "_default", "uploads", "species.csv"
+)
+
+CHECKLISTS_PER_SCALE = 8500
+OBSERVERS_PER_SCALE = 1500
+HOTSPOTS_PER_SCALE = 200
+MAX_SPECIES = 10000
+# Species per checklist, between these bounds (the bundled data averages 13)
+MIN_SPECIES_PER_CHECKLIST, MAX_SPECIES_PER_CHECKLIST = 1, 25
+# Fraction of the counts reported as "X" (present, not counted)
+UNCOUNTED = 0.02
+START_DATE = datetime.date(2021, 1, 1)
+DAYS = 365
+# Hotspots are spread over the contiguous United States
+LATITUDES, LONGITUDES = (25.0, 49.0), (-124.0, -67.0)
+
+SPECIES_HEADER = ["COMMON NAME"]
+CHECKLISTS_HEADER = [
+    "SAMPLING EVENT IDENTIFIER", "LATITUDE", "LONGITUDE", "OBSERVATION DATE",
+    "TIME OBSERVATIONS STARTED", "OBSERVER ID", "DURATION MINUTES",
+]
+SIGHTINGS_HEADER = ["SAMPLING EVENT IDENTIFIER", "COMMON NAME", "OBSERVATION COUNT"]
+
+
+def species_names(count):
+    # The bundled species first, then made-up ones
+    with open(BUNDLED_SPECIES, newline="") as f:
+        names = [row["COMMON NAME"].strip() for row in csv.DictReader(f)]
+    for n in itertools.count(1):
+        if len(names) >= count:
+            break
+        names.append(f"Synthetic Bird {n}")
+    return names[:count]
+
+
+def zipf_weights(count, exponent=1.0):
+    # Cumulative weights of a Zipf distribution, for random.choices
+    return list(itertools.accumulate(1.0 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+def generate(folder, scale=1, seed=0):
+    """Writes the three CSV files into folder; returns {filename: rows}."""
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    species = species_names(min(int(425 * scale ** 0.5), MAX_SPECIES))
+    species_weights = zipf_weights(len(species), 0.8)
+    observers = [f"obs{n}" for n in range(1, int(OBSERVERS_PER_SCALE * scale) + 1)]
+    observer_weights = zipf_weights(len(observers))
+    hotspots = [
+        (rng.uniform(*LATITUDES), rng.uniform(*LONGITUDES), rng.uniform(0.01, 0.3))
+        for _ in range(int(HOTSPOTS_PER_SCALE * scale))
+    ]
+
+    with open(os.path.join(folder, "species.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(SPECIES_HEADER)
+        writer.writerows([name] for name in species)
+
+    checklists = int(CHECKLISTS_PER_SCALE * scale)
+    sightings = 0
+    with open(os.path.join(folder, "checklists.csv"), "w", newline="") as fc, \
+            open(os.path.join(folder, "sightings.csv"), "w", newline="") as fs:
+        checklist_writer, sighting_writer = csv.writer(fc), csv.writer(fs)
+        checklist_writer.writerow(CHECKLISTS_HEADER)
+        sighting_writer.writerow(SIGHTINGS_HEADER)
+        for n in range(checklists):
+            event_id = f"S{n + 1:09d}"
+            lat, lng, spread = rng.choice(hotspots)
+            date = START_DATE + datetime.timedelta(days=rng.randrange(DAYS))
+            checklist_writer.writerow([
+                event_id,
+                round(rng.gauss(lat, spread), 6),
+                round(rng.gauss(lng, spread), 6),
+                date.isoformat(),
+                f"{rng.randrange(5, 19):02d}:{rng.randrange(0, 60, 5):02d}:00",
+                rng.choices(observers, cum_weights=observer_weights)[0],
+                float(rng.choice((5, 10, 15, 30, 45, 60, 90, 120))),
+            ])
+            size = rng.randint(MIN_SPECIES_PER_CHECKLIST, MAX_SPECIES_PER_CHECKLIST)
+            seen = set(rng.choices(species, cum_weights=species_weights, k=size))
+            for name in seen:
+                count = "X" if rng.random() < UNCOUNTED else max(1, int(rng.expovariate(0.2)))
+                sighting_writer.writerow([event_id, name, count])
+            sightings += len(seen)
+    return {"species.csv": len(species), "checklists.csv": checklists, "sightings.csv": sightings}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic eBird CSV exports.")
+    parser.add_argument("--scale", type=float, default=1, help="size relative to the bundled data")
+    parser.add_argument("--folder", required=True, help="output folder")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    for filename, rows in generate(args.folder, args.scale, args.seed).items():
+        print(f"{filename}: {rows} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Gunicorn settings of the pre-fork launch mode (./serve.sh, requires pip install gunicorn).
+
+The master imports the app once (wsgi.py) and forks WEB_WORKERS workers sharing
+its warmed-up memory copy-on-write.  Workers are recycled gracefully after
+about MAX_REQUESTS requests, so slow memory growth never accumulates, and
+GET /api/ready tells a load balancer when a worker can serve requests.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "127.0.0.1:8000")
+# one process per core, each with a few threads for the requests waiting on I/O
+workers = int(os.environ.get("WEB_WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+
+# import the app and warm it up in the master, before forking
+preload_app = True
+
+# recycle every worker after this many requests (jittered, so they do not all
+# restart together); a recycled worker finishes its requests first, and the
+# background jobs it leaves unfinished are marked failed (see tasks.py)
+max_requests = int(os.environ.get("MAX_REQUESTS", 5000))
+max_requests_jitter = max_requests // 10
+graceful_timeout = 30
+timeout = 120
+
+accesslog = "-"
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    # every worker opens its own database connections and fails the orphaned jobs
+    from apps._default import prefork
+
+    prefork.after_fork()
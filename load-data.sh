@@ -0,0 +1 @@
+python -m apps._default.load_data "$@"
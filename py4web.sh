@@ -1,4 +1,5 @@
 rm -rf apps/_default/databases
 rm -rf CSE_183_Group_10_Project
 rm CSE_183_Group_10_Project.zip
+./load-data.sh
 py4web run --errorlog=:stdout -L 20 apps
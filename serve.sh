@@ -0,0 +1,2 @@
+./load-data.sh
+gunicorn -c gunicorn.conf.py wsgi:application
@@ -0,0 +1,116 @@
+"""
+Fixtures of the tests: the app is loaded once, on a fresh SQLite database in a
+temporary folder holding a few checklists, and called through its WSGI interface.
+Test modules import the app modules inside the tests: imported before py4web
+loads the app, they would not register its routes.
+"""
+import datetime
+import io
+import json
+import os
+import sys
+import tempfile
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# settings.py reads the database folder when the app is imported
+os.environ["DB_FOLDER"] = tempfile.mkdtemp(prefix="birds-tests-")
+sys.path.insert(0, ROOT)
+
+SPECIES = ["American Crow", "Mallard", "Song Sparrow"]
+# (latitude, longitude, observer, {species: count}) of the sample checklists
+CHECKLISTS = [
+    (37.0, -122.0, "obs1", {"American Crow": 3, "Mallard": 2}),
+    (37.5, -121.5, "obs2", {"Mallard": 5}),
+    (35.0, -115.0, "obs1", {"Song Sparrow": 1, "American Crow": 1}),
+]
+
+
+def save_and_edit(db, user_email, number=12):
+    """
+    Saves number checklists of user_email, spread over more cells than one merge
+    query takes (APPLY_CHUNK_CELLS), then moves the first one to another place and
+    date with other species, i.e. updates every derived table both ways.
+    """
+    from apps._default.checklist_store import save_checklist, save_checklists
+
+    results = save_checklists(db, user_email, [
+        dict(latitude=45 + index * 0.37, longitude=1 + index * 0.53, observation_date="2024-06-02",
+             species=[dict(common_name="Mallard", count=index + 1),
+                      dict(common_name="American Crow", count=1)])
+        for index in range(number)
+    ])
+    save_checklist(db, user_email, [dict(common_name="Mallard", count=7),
+                                    dict(common_name="Song Sparrow", count=2)],
+                   checklist_id=results[0]["checklist_id"],
+                   latitude=46.2, longitude=3.1, observation_date="2024-06-03")
+    return [result["checklist_id"] for result in results]
+
+
+@pytest.fixture(scope="session")
+def app():
+    from py4web import core
+
+    os.chdir(ROOT)
+    wsgi = core.wsgi(apps_folder=os.path.join(ROOT, "apps"), password_file=None)
+    from apps._default.common import db
+    from apps._default.load_data import rebuild_derived
+
+    species = {name: db.species.insert(common_name=name) for name in SPECIES}
+    for number, (lat, lng, observer, counts) in enumerate(CHECKLISTS):
+        checklist_id = db.checklists.insert(
+            sampling_event_id=f"S{number}", latitude=lat, longitude=lng,
+            observation_date=datetime.date(2024, 5, number + 1), observer_id=observer,
+        )
+        for name, count in counts.items():
+            db.sightings.insert(
+                sampling_event_id=checklist_id, common_name=species[name], observation_count=count
+            )
+    db.commit()
+    rebuild_derived(db)
+    return wsgi
+
+
+@pytest.fixture
+def db(app):
+    from apps._default.common import db
+
+    yield db
+    db.rollback()
+
+
+@pytest.fixture
+def call(app):
+    """
+    Returns call(method, path, body=None, headers=None) -> (status code, decoded
+    JSON response or body, e.g. of the NDJSON streams); path may have a query
+    string, and the headers of the last response are left in call.headers.
+    """
+
+    def call(method, path, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        path, _, query = path.partition("?")
+        environ = {}
+        setup_testing_defaults(environ)
+        environ.update({
+            "REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": query,
+            "CONTENT_TYPE": "application/json",
+            "CONTENT_LENGTH": str(len(data)), "wsgi.input": io.BytesIO(data),
+        })
+        for name, value in (headers or {}).items():
+            environ["HTTP_" + name.upper().replace("-", "_")] = value
+        status = []
+
+        def start_response(code, response_headers, exc_info=None):
+            status.append(code)
+            call.headers = dict(response_headers)
+
+        body = b"".join(app(environ, start_response))
+        if not body.startswith(b"{") or "ndjson" in call.headers.get("Content-Type", ""):
+            # error pages are HTML, and the streams are returned as they are
+            return int(status[0].split()[0]), body
+        return int(status[0].split()[0]), json.loads(body)
+
+    return call
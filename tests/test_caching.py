@@ -0,0 +1,28 @@
+# around the checklists saved by the tests, in Paris
+PARIS = "/api/clusters?zoom=3&bbox=2,48,3,49"
+
+
+def cache_stats(call):
+    return call("GET", "/api/cache_stats")[1]
+
+
+def paris_checklists(clusters):
+    return sum(count for _, _, count in clusters["clusters"])
+
+
+def test_cached_until_saved(db, call):
+    from apps._default.checklist_store import save_checklist
+
+    status, before = call("GET", PARIS)
+    assert status == 200
+    stats = cache_stats(call)
+    # the same parameters, in another order and with an empty one, share the entry
+    assert call("GET", "/api/clusters?bbox=2,48,3,49&zoom=3&species=")[1] == before
+    assert cache_stats(call)["hits"] == stats["hits"] + 1
+
+    save_checklist(db, "cache@example.com", [{"common_name": "Mallard", "count": 1}],
+                   latitude=48.85, longitude=2.35)
+    assert cache_stats(call)["data_version"] == stats["data_version"] + 1
+    status, after = call("GET", PARIS)
+    assert cache_stats(call)["misses"] == stats["misses"] + 1
+    assert paris_checklists(after) == paris_checklists(before) + 1
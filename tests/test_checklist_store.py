@@ -0,0 +1,84 @@
+import pytest
+
+
+def checklist(key=None, **fields):
+    # away from the region of the region_stats tests
+    return dict(dict(
+        key=key, latitude=48.85, longitude=2.35, observation_date="2024-06-01",
+        species=[dict(common_name="Mallard", count=2), dict(common_name="American Crow", count=1)],
+    ), **fields)
+
+
+def saved_checklists(db, user_email):
+    return db(db.checklists.observer_id == user_email).count()
+
+
+def test_batch_saved_with_keys(db):
+    from apps._default.checklist_store import save_checklists
+
+    user = "batch@example.com"
+    results = save_checklists(db, user, [checklist("a"), checklist("b"), checklist("a"), checklist()])
+    assert [result["status"] for result in results] == ["created", "created", "duplicate", "created"]
+    assert results[2]["checklist_id"] == results[0]["checklist_id"]
+    assert len({result["checklist_id"] for result in results}) == 3
+    assert saved_checklists(db, user) == 3
+    assert db(db.sightings.sampling_event_id == results[3]["checklist_id"]).count() == 2
+
+    # a retried upload saves nothing new
+    retried = save_checklists(db, user, [checklist("b")])
+    assert retried == [dict(status="duplicate", checklist_id=results[1]["checklist_id"])]
+    assert saved_checklists(db, user) == 3
+
+
+def test_invalid_batch_with_repeated_key(db):
+    from apps._default.checklist_store import save_checklists
+
+    user = "invalid@example.com"
+    results = save_checklists(db, user, [
+        checklist("a"), checklist("a"), checklist("c", latitude=95),
+    ])
+    assert results[:2] == [dict(status="valid"), dict(status="valid")]
+    assert results[2]["status"] == "invalid"
+    assert results[2]["code"] == 400
+    assert saved_checklists(db, user) == 0
+
+
+def sightings_of(db, checklist_id):
+    return {
+        row.common_name: (row.id, row.observation_count)
+        for row in db(db.sightings.sampling_event_id == checklist_id).select()
+    }
+
+
+def test_update_rewrites_changed_species_only(db):
+    from apps._default.checklist_store import save_checklist
+
+    user = "update@example.com"
+    checklist_id = save_checklist(db, user, [
+        dict(common_name="Mallard", count=2), dict(common_name="American Crow", count=1),
+    ], latitude=48.85, longitude=2.35)
+    before = sightings_of(db, checklist_id)
+    save_checklist(db, user, [
+        dict(common_name="Mallard", count=2), dict(common_name="Song Sparrow", count=4),
+    ], checklist_id=checklist_id)
+    after = sightings_of(db, checklist_id)
+    species = {row.common_name: row.id for row in db(db.species).select()}
+    # the unchanged Mallard row is kept, the crow replaced by the sparrow
+    assert after[species["Mallard"]] == before[species["Mallard"]]
+    assert species["American Crow"] not in after
+    assert after[species["Song Sparrow"]][1] == 4
+    assert db(db.user_checklists.checklist_id == checklist_id).count() == 2
+
+
+def test_failed_save_writes_nothing(db, monkeypatch):
+    from apps._default import checklist_store, trends
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("rollup unavailable")
+
+    user = "failed@example.com"
+    monkeypatch.setattr(trends, "update", fail)
+    with pytest.raises(RuntimeError):
+        checklist_store.save_checklists(db, user, [checklist("a"), checklist("b")])
+    assert saved_checklists(db, user) == 0
+    assert not db(db.user_checklists.user_email == user).count()
@@ -0,0 +1,35 @@
+import pytest
+from conftest import CHECKLISTS, save_and_edit
+
+# west, south, east, north of the sample checklists
+BBOX = (-125.0, 30.0, -110.0, 40.0)
+
+
+def stored_clusters(db):
+    return {
+        (row.zoom, row.tile_x, row.tile_y): [row.checklists, row.lat_sum, row.lng_sum]
+        for row in db(db.checklist_clusters).select()
+    }
+
+
+def test_merged_clusters_match_rebuild(db):
+    from apps._default import clusters
+
+    save_and_edit(db, "clusters@example.com")
+    merged = stored_clusters(db)
+    clusters.rebuild(db)
+    rebuilt = stored_clusters(db)
+    assert merged.keys() == rebuilt.keys()
+    for key, value in rebuilt.items():
+        assert merged[key] == pytest.approx(value)
+
+
+def test_clusters_in_view(db):
+    from apps._default import clusters
+
+    for zoom in (3, 8, 14):
+        found = clusters.query_clusters(db, zoom, BBOX)
+        assert sum(count for _, _, count in found) == len(CHECKLISTS)
+        assert all(BBOX[1] <= lat <= BBOX[3] and BBOX[0] <= lng <= BBOX[2] for lat, lng, _ in found)
+    # the three checklists are far apart at street level
+    assert len(clusters.query_clusters(db, 14, BBOX)) == len(CHECKLISTS)
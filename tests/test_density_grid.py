@@ -0,0 +1,23 @@
+import pytest
+from conftest import save_and_edit
+
+
+def stored_cells(db):
+    return {
+        (row.zoom, row.species_id, row.tile_x, row.tile_y): [
+            row.points, row.total, row.lat_sum, row.lng_sum,
+        ]
+        for row in db(db.density_cells).select()
+    }
+
+
+def test_merged_cells_match_rebuild(db):
+    from apps._default import density_grid
+
+    save_and_edit(db, "grid@example.com")
+    merged = stored_cells(db)
+    density_grid.rebuild(db)
+    rebuilt = stored_cells(db)
+    assert merged.keys() == rebuilt.keys()
+    for key, value in rebuilt.items():
+        assert merged[key] == pytest.approx(value)
@@ -0,0 +1,69 @@
+import os
+
+
+def test_tiles_scaled_by_stored_maxima(db):
+    from apps._default import heat_tiles
+    from apps._default.density_grid import ALL_SPECIES, grid_zoom, tile_xy
+
+    zoom = 6
+    level = grid_zoom(zoom, heat_tiles.CELL_ZOOM_OFFSET)
+    cells = db.density_cells
+    layer = (cells.zoom == level) & (cells.species_id == ALL_SPECIES)
+    # the other tests may have saved checklists since the rebuild of the fixture
+    heat_tiles.refresh(db)
+    largest = db(layer).select(cells.total.max()).first()[cells.total.max()]
+    x, y = tile_xy(37.0, -122.0, zoom)
+    rows, top = heat_tiles.tile_cells(db, ALL_SPECIES, zoom, x, y)
+    assert rows and top == largest
+
+    # the tiles read the maximum stored by the rebuild instead of scanning the layer
+    maxima = db.density_maxima
+    db((maxima.zoom == level) & (maxima.species_id == ALL_SPECIES)).update(total=1000)
+    assert heat_tiles.tile_cells(db, ALL_SPECIES, zoom, x, y)[1] == 1000
+    heat_tiles.refresh(db)
+    assert heat_tiles.tile_cells(db, ALL_SPECIES, zoom, x, y)[1] == largest
+
+
+def cached_path(version, zoom, lat, lng):
+    from apps._default import heat_tiles
+    from apps._default.density_grid import ALL_SPECIES, tile_xy
+
+    x, y = tile_xy(lat, lng, zoom)
+    return f"/api/heat/{zoom}/{x}/{y}.png", os.path.join(
+        heat_tiles.tile_folder(version, zoom, x, y), f"{ALL_SPECIES}.png"
+    )
+
+
+def test_save_invalidates_its_tiles_only(call, db):
+    from apps._default.caching import grid_version
+    from apps._default.checklist_store import save_checklist
+
+    version = grid_version.get()
+    saved, saved_file = cached_path(version, 10, 48.85, 2.35)
+    other, other_file = cached_path(version, 10, 37.0, -122.0)
+    for path in (saved, other):
+        status, png = call("GET", path)
+        assert status == 200 and png.startswith(b"\x89PNG")
+    etag = call.headers["ETag"]
+    assert os.path.exists(saved_file) and os.path.exists(other_file)
+    status, _ = call("GET", saved, headers={"If-None-Match": etag})
+    assert status == 304
+
+    save_checklist(db, "tiles@example.com", [{"common_name": "Mallard", "count": 4}],
+                   latitude=48.85, longitude=2.35)
+    # a save keeps the grid version and the tiles it did not change
+    assert grid_version.get() == version
+    assert not os.path.exists(saved_file) and os.path.exists(other_file)
+    status, _ = call("GET", saved, headers={"If-None-Match": etag})
+    assert status == 200 and call.headers["ETag"] != etag
+    assert os.path.exists(saved_file)
+
+
+def test_prune_keeps_the_previous_version(monkeypatch, tmp_path):
+    from apps._default import heat_tiles
+
+    monkeypatch.setattr(heat_tiles, "TILE_FOLDER", str(tmp_path))
+    for version in (1, 2, 3, 4):
+        os.makedirs(heat_tiles.tile_folder(version, 0, 0, 0))
+    assert heat_tiles.prune(4) == 2
+    assert sorted(os.listdir(tmp_path)) == ["3", "4"]
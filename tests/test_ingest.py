@@ -0,0 +1,136 @@
+"""
+The exports written here hold the checklists of the test database (see
+conftest.py), so loading them leaves the data of the other tests as it was.
+"""
+import csv
+import datetime
+import os
+
+import pytest
+from conftest import CHECKLISTS, SPECIES
+
+CHECKLIST_COLUMNS = [
+    "SAMPLING EVENT IDENTIFIER", "LATITUDE", "LONGITUDE", "OBSERVATION DATE",
+    "TIME OBSERVATIONS STARTED", "OBSERVER ID", "DURATION MINUTES",
+]
+
+
+def write_csv(path, header, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def write_exports(folder, checklists=CHECKLISTS):
+    """Writes the exports of checklists, a list like conftest.CHECKLISTS."""
+    os.makedirs(folder, exist_ok=True)
+    write_csv(os.path.join(folder, "species.csv"), ["COMMON NAME"], [[name] for name in SPECIES])
+    write_csv(os.path.join(folder, "checklists.csv"), CHECKLIST_COLUMNS, [
+        [f"S{number}", lat, lng, datetime.date(2024, 5, number + 1).isoformat(), "", observer, ""]
+        for number, (lat, lng, observer, _) in enumerate(checklists)
+    ])
+    write_csv(os.path.join(folder, "sightings.csv"), [
+        "SAMPLING EVENT IDENTIFIER", "COMMON NAME", "OBSERVATION COUNT",
+    ], [
+        [f"S{number}", name, count]
+        for number, (_, _, _, counts) in enumerate(checklists)
+        for name, count in counts.items()
+    ])
+    return folder
+
+
+def stored_checklist(db, event_id):
+    row = db(db.checklists.sampling_event_id == event_id).select().first()
+    return row.latitude, row.longitude, row.observer_id
+
+
+def test_reloaded_checklists_are_updated(db, tmp_path):
+    from apps._default import ingest
+
+    corrected = list(CHECKLISTS)
+    corrected[2] = (35.5, -115.5, "obs3", CHECKLISTS[2][3])
+    checklist_id = db(db.checklists.sampling_event_id == "S2").select().first().id
+    try:
+        summary = ingest.load_all(db, write_exports(tmp_path / "corrected", corrected), workers=1)
+        assert summary["checklists.csv"] == len(CHECKLISTS)
+        assert stored_checklist(db, "S2") == (35.5, -115.5, "obs3")
+        # updated in place: the sightings and the app keep referring to it
+        assert db(db.checklists.sampling_event_id == "S2").select().first().id == checklist_id
+        assert db(db.checklists.sampling_event_id != None).count() == len(CHECKLISTS)
+        manifest = db(db.ingest_manifest.filename == "checklists.csv").select().first()
+        assert manifest.status == "done"
+    finally:
+        ingest.load_all(db, write_exports(tmp_path / "original"), workers=1)
+    assert stored_checklist(db, "S2") == CHECKLISTS[2][:3]
+
+
+def csv_sightings(db):
+    # {(event id, species): count} of the sightings of the checklists from the exports
+    rows = db(
+        (db.sightings.sampling_event_id == db.checklists.id)
+        & (db.sightings.common_name == db.species.id)
+        & (db.checklists.sampling_event_id != None)
+    ).select(db.checklists.sampling_event_id, db.species.common_name, db.sightings.observation_count)
+    return {
+        (row.checklists.sampling_event_id, row.species.common_name): row.sightings.observation_count
+        for row in rows
+    }
+
+
+def test_interrupted_load_resumes(db, tmp_path):
+    from apps._default import ingest
+
+    expected = csv_sightings(db)
+    folder = write_exports(tmp_path / "exports")
+
+    def interrupt(filename, rows_read, rows_loaded, seconds):
+        if filename == "sightings.csv":
+            raise KeyboardInterrupt
+
+    # small chunks: the first one of sightings.csv is committed, then the load stops
+    with pytest.raises(KeyboardInterrupt):
+        ingest.load_all(db, folder, force=True, progress=interrupt, chunk_size=64, workers=1)
+    manifest = db(db.ingest_manifest.filename == "sightings.csv").select().first()
+    assert manifest.status == "loading" and 0 < manifest.byte_offset
+    assert 0 < len(csv_sightings(db)) < len(expected)
+
+    summary = ingest.load_all(db, folder, chunk_size=64, workers=1)
+    # the other files are done, and the sightings loaded before the stop are kept
+    assert summary == {"species.csv": None, "checklists.csv": None, "sightings.csv": len(expected)}
+    assert csv_sightings(db) == expected
+
+
+def test_invalid_rows_rejected(db, tmp_path):
+    from apps._default import ingest
+
+    expected = csv_sightings(db)
+    folder = write_exports(tmp_path / "rejects")
+    with open(folder / "checklists.csv", "a") as f:
+        f.write("S7,95,-120,2024-05-09,,obs1,\n,37,-120,2024-05-09,,obs1,\nS8,37,-120,May 9,,obs1,\n")
+    with open(folder / "sightings.csv", "a") as f:
+        f.write("S0,Dodo,1\nS9,Mallard,1\nS1,Mallard,-2\n")
+    try:
+        # parsed in chunks by the worker processes
+        summary = ingest.load_all(db, folder, chunk_size=64, workers=2)
+        assert summary["checklists.csv"] == len(CHECKLISTS)
+        assert summary["sightings.csv"] == len(expected)
+        assert csv_sightings(db) == expected
+        assert not db(db.checklists.sampling_event_id.belongs(["S7", "S8"])).count()
+        for filename, reasons in (
+            ("checklists.csv", ["latitude out of range", "missing sampling event identifier",
+                                "invalid date or time"]),
+            ("sightings.csv", ["unknown species", "unknown checklist", "invalid count"]),
+        ):
+            with open(folder / ingest.REJECTS_FOLDER / filename, newline="") as f:
+                header, *rejected = csv.reader(f)
+            assert header == ["OFFSET", "REASON", "VALUES..."]
+            # parse errors are written before the rows the writer could not resolve
+            rejected.sort(key=lambda row: int(row[0]))
+            assert [row[1] for row in rejected] == reasons
+            # the offsets are those of the rejected lines in the export
+            with open(folder / filename, "rb") as f:
+                data = f.read()
+            assert all(data[int(row[0]):].startswith(row[2].encode()) for row in rejected)
+    finally:
+        ingest.load_all(db, write_exports(tmp_path / "original"), workers=1)
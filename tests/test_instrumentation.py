@@ -0,0 +1,30 @@
+def test_connection_setup_not_counted(db):
+    from conftest import SPECIES
+    from apps._default.instrumentation import RequestStats, bind_stats, fetched
+
+    stats = RequestStats("test")
+    bind_stats(stats)
+    try:
+        db.executesql("SELECT 1;")
+        db.executesql("PRAGMA foreign_keys=ON;")
+        assert stats.queries == 0
+        rows = fetched(db(db.species).select())
+        assert (stats.queries, stats.rows) == (1, len(SPECIES))
+    finally:
+        bind_stats(None)
+
+
+def test_metrics_per_route(call):
+    from apps._default.instrumentation import instrumented
+    from apps._default.typeahead import species_index
+
+    species_index.refresh()
+    before = instrumented.summary().get("/api/species", dict(requests=0, rows=0))
+    for _ in range(2):
+        assert call("GET", "/api/species?suggest=mal")[0] == 200
+    status, body = call("GET", "/api/metrics")
+    assert status == 200
+    metrics = body["metrics"]["/api/species"]
+    assert metrics["requests"] == before["requests"] + 2 and metrics["errors"] == 0
+    # the matches come from the loaded index, not from fetched rows
+    assert metrics["rows"] == before["rows"]
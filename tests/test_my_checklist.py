@@ -0,0 +1,32 @@
+import pytest
+
+
+def entries(items):
+    return [(item["checklist_id"], item["common_name"]) for item in items]
+
+
+def test_pages_follow_cursor(db):
+    from py4web.core import HTTP
+    from apps._default.checklist_store import save_checklist
+    from apps._default.controllers import get_user_checklist_page
+
+    user = "pages@example.com"
+    for count in (1, 2, 3):
+        save_checklist(db, user, [{"common_name": "Mallard", "count": count},
+                                  {"common_name": "Song Sparrow", "count": 1}],
+                       latitude=48.85, longitude=2.35)
+    everything, cursor = get_user_checklist_page(user, {})
+    assert len(everything) == 6 and cursor is None
+
+    first, cursor = get_user_checklist_page(user, {"limit": "4"})
+    assert entries(first) == entries(everything[:4])
+    # entries saved meanwhile are newer: they do not shift the next page
+    save_checklist(db, user, [{"common_name": "Mallard", "count": 4}], latitude=48.85, longitude=2.35)
+    second, last = get_user_checklist_page(user, {"limit": "4", "cursor": str(cursor)})
+    assert entries(second) == entries(everything[4:])
+    assert last is None
+
+    mallards, _ = get_user_checklist_page(user, {"species": "Mallard"})
+    assert [item["user_observation_count"] for item in mallards] == [4, 3, 2, 1]
+    with pytest.raises(HTTP):
+        get_user_checklist_page(user, {"cursor": "next"})
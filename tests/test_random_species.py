@@ -0,0 +1,28 @@
+def test_random_birds(call):
+    from conftest import SPECIES
+
+    status, birds = call("GET", "/get_random_bird?n=10")
+    assert status == 200
+    assert sorted(birds["common_names"]) == SPECIES
+    # weighted picks are among the species of the last RECENT_DAYS days of data
+    status, birds = call("GET", "/get_random_bird?n=2&weighted=1")
+    assert status == 200
+    assert birds["common_names"] and set(birds["common_names"]) <= set(SPECIES)
+
+
+def test_weights_not_reloaded_by_saves(db, monkeypatch):
+    from apps._default import random_species
+    from apps._default.checklist_store import save_checklist
+
+    sampler = random_species.species_sampler
+    sampler.refresh()
+    weights = sampler.weights
+    save_checklist(db, "random@example.com", [{"common_name": "Song Sparrow", "count": 1}],
+                   latitude=48.85, longitude=2.35)
+    sampler.refresh()
+    assert sampler.weights is weights
+
+    # until they are WEIGHTS_MAX_AGE old
+    monkeypatch.setattr(sampler, "loaded_on", sampler.loaded_on - random_species.WEIGHTS_MAX_AGE)
+    sampler.refresh()
+    assert sampler.weights is not weights
@@ -0,0 +1,57 @@
+BOUNDS = dict(north=40, south=30, east=-110, west=-125)
+SPECIES_ORDER = ["American Crow", "Mallard", "Song Sparrow"]
+
+
+def test_region_stats(call):
+    status, stats = call("POST", "/api/region_stats", BOUNDS)
+    assert status == 200
+    assert "error" not in stats
+    assert stats["species_order"] == SPECIES_ORDER
+
+
+def test_region_stats_with_slow_queries_logged(call, monkeypatch):
+    # the sub-queries run on other threads, where the slow query log cannot read the request
+    from apps._default import settings
+
+    monkeypatch.setattr(settings, "SLOW_QUERY_MS", 0)
+    status, stats = call("POST", "/api/region_stats", BOUNDS)
+    assert status == 200
+    assert "error" not in stats
+    assert stats["species_order"] == SPECIES_ORDER
+
+
+def test_region_stats_ties_sorted_by_name(call):
+    # American Crow and Mallard are both in 2 checklists
+    status, stats = call("POST", "/api/region_stats", dict(BOUNDS, order="checklists", limit=2))
+    assert status == 200
+    assert stats["species_order"] == ["American Crow", "Mallard"]
+    assert stats["top_contributors"] == [
+        {"observer_id": "obs1", "checklists": 2}, {"observer_id": "obs2", "checklists": 1},
+    ]
+
+
+def test_region_stats_invalid_parameters(call):
+    for invalid in (dict(limit="ten"), dict(limit=0), dict(order="random"), dict(date_from="May")):
+        status, _ = call("POST", "/api/region_stats", dict(BOUNDS, **invalid))
+        assert status == 400
+
+
+def test_region_stats_date_window_bounds_as_strings(call):
+    # S1 and S2; the bounds of the JSON body are converted on every path
+    window = dict(date_from="2024-05-02", date_to="2024-05-03")
+    expected = call("POST", "/api/region_stats", dict(BOUNDS, **window))[1]
+    assert expected["species_order"] == SPECIES_ORDER
+    assert expected["species_stats"]["Mallard"] == {"sightings": 5, "checklists": 1}
+    strings = {name: str(value) for name, value in BOUNDS.items()}
+    status, stats = call("POST", "/api/region_stats", dict(strings, **window))
+    assert status == 200
+    assert stats == expected
+
+
+def test_region_stats_invalid_bounds(call):
+    for invalid in (dict(north="up"), dict(west=None), dict(east=[1])):
+        status, _ = call("POST", "/api/region_stats", dict(BOUNDS, **invalid))
+        assert status == 400
+    bounds = dict(BOUNDS)
+    del bounds["south"]
+    assert call("POST", "/api/region_stats", bounds)[0] == 400
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def snapshot(tmp_path, monkeypatch):
+    # A snapshot of the test database in tmp_path, whatever settings.USE_SNAPSHOT
+    np = pytest.importorskip("numpy")
+    from apps._default import snapshot
+
+    monkeypatch.setattr(snapshot, "np", np, raising=False)
+    return snapshot.Snapshot(str(tmp_path / "snapshot"))
+
+
+def exist(snapshot, names):
+    return [os.path.exists(os.path.join(snapshot.folder, name)) for name in names]
+
+
+def test_replaced_files_kept_for_one_manifest(db, snapshot):
+    from apps._default.snapshot import manifest_files
+
+    snapshot.rebuild(db)
+    first = manifest_files(snapshot.read_manifest())
+    snapshot.rebuild(db)
+    # readers of the first manifest may still be loading its files
+    assert exist(snapshot, first) == [True]
+    checklist_id = db(db.checklists.sampling_event_id == "S0").select().first().id
+    snapshot.update_checklists(db, [checklist_id])
+    assert exist(snapshot, first) == [False]
+
+
+def test_reader_retries_removed_files(db, snapshot, monkeypatch):
+    snapshot.rebuild(db)
+    stale = snapshot.read_manifest()
+    snapshot.rebuild(db)
+    snapshot.rebuild(db)
+    manifests = [stale]
+    read_manifest = snapshot.read_manifest
+    monkeypatch.setattr(snapshot, "read_manifest", lambda: manifests.pop() if manifests else read_manifest())
+    parts = snapshot.parts()
+    assert len(parts[0].checklist_id) == db(db.checklists).count()
+
+
+def test_deltas_fold_into_base(db, snapshot, monkeypatch, tmp_path):
+    from conftest import save_and_edit
+    from apps._default import density_grid
+    from apps._default import snapshot as module
+    from apps._default.checklist_store import save_checklist
+
+    monkeypatch.setattr(module, "MAX_DELTA_SEGMENTS", 2)
+    monkeypatch.setattr(module, "REBUILD_DELTA_CHECKLISTS", 12)
+    snapshot.rebuild(db)
+    user = "snapshot@example.com"
+    ids = save_and_edit(db, user)
+    assert not snapshot.update_checklists(db, ids)
+    # the later versions of a checklist hide those of the earlier delta segments
+    for checklist_id in ids[1], ids[1]:
+        save_checklist(db, user, [{"common_name": "Song Sparrow", "count": 5}],
+                       checklist_id=checklist_id, latitude=47.0, longitude=4.0)
+        snapshot.update_checklists(db, [checklist_id])
+    # past MAX_DELTA_SEGMENTS the segments were compacted into one
+    manifest = snapshot.read_manifest()
+    assert len(manifest["deltas"]) == 1 and manifest["delta_checklists"] == len(ids)
+    # one more checklist in the delta than REBUILD_DELTA_CHECKLISTS
+    checklist_id = save_checklist(db, user, [{"common_name": "Mallard", "count": 1}],
+                                  latitude=52.0, longitude=5.0)
+    assert snapshot.update_checklists(db, [checklist_id])
+
+    fresh = module.Snapshot(str(tmp_path / "fresh"))
+    fresh.rebuild(db)
+    europe = (60, 40, 10, -5)
+    expected = fresh.region_stats(*europe)
+    assert snapshot.region_stats(*europe) == expected
+    assert snapshot.region_stats(*europe, date_from="2024-06-03") == fresh.region_stats(
+        *europe, date_from="2024-06-03"
+    )
+    cells = snapshot.density_cells()
+    rebuilt = {key: value for key, value in density_grid.read_cells(db).items() if value[0]}
+    assert cells.keys() == rebuilt.keys()
+    for key, value in rebuilt.items():
+        assert cells[key] == pytest.approx(value)
+
+    snapshot.rebuild(db)
+    assert snapshot.read_manifest()["deltas"] == []
+    assert snapshot.region_stats(*europe) == expected
@@ -0,0 +1,27 @@
+def in_bbox_ids(db, bbox):
+    from apps._default.spatial import in_bbox
+
+    return {row.id for row in db(in_bbox(db, *bbox)).select(db.checklists.id)}
+
+
+def test_rtree_follows_checklists(db):
+    # north, south, east, west around a place without other checklists
+    bbox = (-40.0, -41.0, 150.0, 149.0)
+    checklist_id = db.checklists.insert(latitude=-40.5, longitude=149.5)
+    assert in_bbox_ids(db, bbox) == {checklist_id}
+    db(db.checklists.id == checklist_id).update(latitude=-42.0)
+    assert in_bbox_ids(db, bbox) == set()
+    db(db.checklists.id == checklist_id).update(latitude=-40.25)
+    assert in_bbox_ids(db, bbox) == {checklist_id}
+    db(db.checklists.id == checklist_id).delete()
+    assert in_bbox_ids(db, bbox) == set()
+
+
+def test_bbox_edges_exact(db):
+    # the R*Tree rounds outwards: the exact bounds still decide
+    from conftest import CHECKLISTS
+
+    lat, lng = CHECKLISTS[0][:2]
+    ids = in_bbox_ids(db, (lat, lat, lng, lng))
+    assert len(ids) == 1
+    assert not in_bbox_ids(db, (lat - 1e-9, lat - 2e-9, lng, lng))
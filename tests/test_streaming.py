@@ -0,0 +1,33 @@
+import functools
+import json
+
+from test_region_stats import BOUNDS, SPECIES_ORDER
+
+NDJSON = {"Accept": "application/x-ndjson"}
+
+
+def lines(body):
+    return [json.loads(line) for line in body.decode().splitlines()]
+
+
+def test_region_stats_stream(call):
+    status, expected = call("POST", "/api/region_stats", BOUNDS)
+    status, body = call("POST", "/api/region_stats", BOUNDS, headers=NDJSON)
+    assert status == 200
+    assert call.headers["Content-Type"] == "application/x-ndjson"
+    species, contributors = lines(body)[:3], lines(body)[3:]
+    assert [line["species"] for line in species] == SPECIES_ORDER
+    assert {line["species"]: {"sightings": line["sightings"], "checklists": line["checklists"]}
+            for line in species} == expected["species_stats"]
+    assert contributors == expected["top_contributors"]
+
+
+def test_streamed_in_chunks(call, monkeypatch):
+    # the density cells of all the checklists, read from the cursor one at a time
+    from apps._default import controllers, streaming
+
+    monkeypatch.setattr(controllers, "stream_rows", functools.partial(streaming.stream_rows, size=1))
+    status, expected = call("GET", "/api/density?zoom=10")
+    status, body = call("GET", "/api/density?zoom=10", headers=NDJSON)
+    assert status == 200
+    assert lines(body) == expected["density"]
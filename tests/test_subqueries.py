@@ -0,0 +1,46 @@
+import time
+
+# Counts for minutes unless interrupted
+SLOW_SQL = (
+    "WITH RECURSIVE numbers(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM numbers) "
+    "SELECT COUNT(*) FROM (SELECT n FROM numbers LIMIT 10000000000);"
+)
+
+
+def test_slow_subquery_interrupted_at_deadline(db):
+    from conftest import SPECIES
+    from apps._default.subqueries import run_concurrently
+
+    started = time.perf_counter()
+    results, timed_out = run_concurrently(db, {
+        "slow": lambda: db.executesql(SLOW_SQL),
+        "species": lambda: db.executesql("SELECT COUNT(*) FROM species;"),
+    }, deadline_ms=200)
+    assert time.perf_counter() - started < 2
+    assert timed_out == ["slow"]
+    assert results == {"species": [(len(SPECIES),)]}
+
+    # the interrupted sub-query gave its thread and connection back
+    results, timed_out = run_concurrently(db, {
+        "species": lambda: db.executesql("SELECT COUNT(*) FROM species;"),
+    }, deadline_ms=2000)
+    assert (results, timed_out) == ({"species": [(len(SPECIES),)]}, [])
+
+
+def test_subqueries_counted_in_request_stats(db):
+    from conftest import SPECIES
+    from apps._default.instrumentation import RequestStats, bind_stats, fetched
+    from apps._default.subqueries import run_concurrently
+
+    stats = RequestStats("test")
+    bind_stats(stats)
+    try:
+        results, timed_out = run_concurrently(db, {
+            name: lambda: fetched(db.executesql("SELECT common_name FROM species;"))
+            for name in ("first", "second")
+        })
+    finally:
+        bind_stats(None)
+    assert timed_out == [] and len(results) == 2
+    # without the statements setting up their connections
+    assert (stats.queries, stats.rows) == (2, 2 * len(SPECIES))
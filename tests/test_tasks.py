@@ -0,0 +1,24 @@
+import subprocess
+import sys
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_orphaned_jobs_failed(db):
+    from apps._default import tasks
+
+    dead = f"{tasks.HOST}:{exited_pid()}"
+    orphaned = db.jobs.insert(name="vacuum", job_key="orphaned", status=tasks.RUNNING, owner=dead)
+    alive = db.jobs.insert(name="vacuum", job_key="alive", status=tasks.RUNNING, owner=tasks.process_owner())
+    elsewhere = db.jobs.insert(name="vacuum", job_key="elsewhere", status=tasks.QUEUED, owner="otherhost:1")
+    db.commit()
+    assert tasks.fail_orphaned_jobs() == 1
+    assert db.jobs(orphaned).status == tasks.FAILED
+    assert db.jobs(alive).status == tasks.RUNNING
+    assert db.jobs(elsewhere).status == tasks.QUEUED
+    db(db.jobs.id.belongs([orphaned, alive, elsewhere])).delete()
+    db.commit()
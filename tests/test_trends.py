@@ -0,0 +1,32 @@
+from conftest import save_and_edit
+
+
+def stored_trends(db):
+    return {
+        (row.species_id, row.observation_date, row.observer_id): (row.sightings, row.total)
+        for row in db(db.daily_trends).select()
+    }
+
+
+def test_merged_rollup_matches_rebuild(db):
+    from apps._default import trends
+
+    save_and_edit(db, "trends@example.com")
+    merged = stored_trends(db)
+    trends.rebuild(db)
+    assert merged == stored_trends(db)
+
+
+def test_query_buckets(db):
+    from apps._default import trends
+
+    crow = db(db.species.common_name == "American Crow").select().first().id
+    # S0 (3 on May 1) and S2 (1 on May 3), before the checklists saved by the tests
+    may = dict(date_from="2024-05-01", date_to="2024-05-31")
+    assert trends.query(db, crow, **may) == [
+        {"date": "2024-05-01", "count": 3}, {"date": "2024-05-03", "count": 1},
+    ]
+    assert trends.query(db, crow, bucket="month", **may) == [{"date": "2024-05-01", "count": 4}]
+    assert trends.query(db, crow, observer_id="obs1", bucket="week", **may) == [
+        {"date": "2024-04-29", "count": 4},
+    ]
@@ -0,0 +1,32 @@
+def test_search_ranks_prefixes_first(app):
+    from apps._default.typeahead import species_index
+
+    assert [name for _, name in species_index.search("mallard")] == ["Mallard"]
+    assert [name for _, name in species_index.search("s")] == ["Song Sparrow"]
+    # words are matched by prefix, anywhere in the name
+    assert [name for _, name in species_index.search("cr")] == ["American Crow"]
+
+
+def test_index_reloaded_when_species_added_only(db):
+    from apps._default.caching import species_version
+    from apps._default.checklist_store import save_checklist
+    from apps._default.typeahead import species_index
+
+    species_index.refresh()
+    data = species_index.data
+    save_checklist(db, "typeahead@example.com", [{"common_name": "Mallard", "count": 1}],
+                   latitude=48.85, longitude=2.35)
+    species_index.refresh()
+    assert species_index.data is data
+
+    species_id = db.species.insert(common_name="Mallard x Black Duck")
+    species_version.bump()
+    db.commit()
+    try:
+        assert [name for _, name in species_index.search("mallard")] == [
+            "Mallard", "Mallard x Black Duck",
+        ]
+    finally:
+        db(db.species.id == species_id).delete()
+        species_version.bump()
+        db.commit()
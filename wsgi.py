@@ -0,0 +1,18 @@
+"""
+WSGI entry point of the pre-fork launch mode, see gunicorn.conf.py.
+
+Imported once by the gunicorn master (preload_app): it loads the py4web apps and
+warms up their shared state before the workers are forked.
+"""
+import os
+
+from py4web.core import wsgi
+
+application = wsgi(
+    apps_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), "apps"),
+    password_file=None,
+)
+
+from apps._default import prefork  # noqa: E402 (the apps are importable once loaded)
+
+prefork.warm()